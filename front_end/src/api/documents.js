@@ -17,6 +17,11 @@ export async function uploadDocument({ kbId, file, onConflict }) {
   return resp.data
 }
 
+export async function getIngestionJob(jobId) {
+  const resp = await api.get(`/api/knowledge/jobs/${jobId}`)
+  return resp.data
+}
+
 export async function deleteDocument(docId) {
   await api.delete(`/api/knowledge/document/${docId}`)
 }
@@ -55,7 +55,11 @@ export async function ragChatStream({ kbId, question, session_id, onDelta }) {
     }
   }
 
-  return { answer, session_id: resp.headers.get('X-Session-ID') }
+  return {
+    answer,
+    session_id: resp.headers.get('X-Session-ID'),
+    cache_hit: resp.headers.get('X-Cache-Hit') === '1'
+  }
 }
 
 export async function getChatHistoryList() {
@@ -0,0 +1,226 @@
+from __future__ import annotations
+
+"""
+chunk 文本的二进制旁路文件（与 FAISS 索引同目录），检索命中后直接从这里取文本，不再回表查询。
+
+- <index>.textidx：int64 矩阵，每行 (chunk_id, 偏移, 字节数)；已删除的行 chunk_id 记为 -1（墓碑）
+- <index>.texts：全部 chunk 文本的 UTF-8 字节串首尾相接，按 .textidx 中的偏移切片
+
+两个文件都以 16 字节文件头开始（magic、保留字段、世代号），检索侧直接 mmap。写入策略与 chunk_vectors 一致：
+追加时先写文本再写索引行（读取端忽略越过文本末尾的行），删除只写墓碑，墓碑超过 COMPACT_RATIO 时整体重写并更换世代号。
+行带自身的 chunk id，与向量文件各自压缩、互不依赖位置。
+
+数据库仍是唯一可信来源：文件缺失或缺少某些 chunk 时由调用方回表补齐，rebuild_index / backfill_chunk_texts
+按数据库内容重写。
+"""
+
+import os
+import struct
+import threading
+from pathlib import Path
+from typing import Iterable
+
+import numpy as np
+
+_HEADER = struct.Struct("<8sII")
+HEADER_BYTES = _HEADER.size
+_INDEX_MAGIC = b"KBTXI\x00\x00\x01"
+_BLOB_MAGIC = b"KBTXT\x00\x00\x01"
+
+TOMBSTONE = -1
+COMPACT_RATIO = 0.25
+_ROW = 3
+
+
+def texts_path(index_path: Path) -> Path:
+    return index_path.with_name(f"{index_path.name}.texts")
+
+
+def text_index_path(index_path: Path) -> Path:
+    return index_path.with_name(f"{index_path.name}.textidx")
+
+
+def _new_generation() -> int:
+    return int.from_bytes(os.urandom(4), "little")
+
+
+def _atomic_write(path: Path, magic: bytes, generation: int, payload: bytes) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f"{path.name}.tmp")
+    with tmp.open("wb") as f:
+        f.write(_HEADER.pack(magic, 0, int(generation)))
+        f.write(payload)
+    os.replace(str(tmp), str(path))
+
+
+def _read_generation(f, magic: bytes) -> int | None:
+    raw = f.read(HEADER_BYTES)
+    if len(raw) != HEADER_BYTES:
+        return None
+    got, _, generation = _HEADER.unpack(raw)
+    return int(generation) if got == magic else None
+
+
+def _encode(ids: Iterable[int], texts: Iterable[str], start: int) -> tuple[np.ndarray, bytes]:
+    rows: list[tuple[int, int, int]] = []
+    parts: list[bytes] = []
+    offset = start
+    for cid, text in zip(ids, texts):
+        data = (text or "").encode("utf-8")
+        rows.append((int(cid), offset, len(data)))
+        parts.append(data)
+        offset += len(data)
+    return np.asarray(rows, dtype=np.int64).reshape(-1, _ROW), b"".join(parts)
+
+
+def _open(index_path: Path) -> tuple[np.ndarray, np.ndarray, int] | None:
+    # 返回 (行矩阵, 文本字节, 世代号)，均为 mmap，包含墓碑；文件缺失或世代号不一致时返回 None。
+    try:
+        with text_index_path(index_path).open("rb") as xf, texts_path(index_path).open("rb") as bf:
+            xg = _read_generation(xf, _INDEX_MAGIC)
+            bg = _read_generation(bf, _BLOB_MAGIC)
+            if xg is None or bg is None or xg != bg:
+                return None
+            n = (os.fstat(xf.fileno()).st_size - HEADER_BYTES) // (8 * _ROW)
+            blob_size = os.fstat(bf.fileno()).st_size - HEADER_BYTES
+            rows = (
+                np.memmap(xf, dtype=np.int64, mode="r", offset=HEADER_BYTES, shape=(n, _ROW))
+                if n > 0
+                else np.empty((0, _ROW), dtype=np.int64)
+            )
+            blob = (
+                np.memmap(bf, dtype=np.uint8, mode="r", offset=HEADER_BYTES, shape=(blob_size,))
+                if blob_size > 0
+                else np.empty((0,), dtype=np.uint8)
+            )
+    except FileNotFoundError:
+        return None
+    # 追加中断时索引行可能指向尚未写完的文本：只认文本已完整落盘的前缀。
+    # 行按写入顺序排列，文本末尾位置单调不减。
+    complete = int(np.searchsorted(rows[:, 1] + rows[:, 2], blob_size, side="right"))
+    return rows[:complete], blob, xg
+
+
+def _open_retry(index_path: Path) -> tuple[np.ndarray, np.ndarray, int] | None:
+    # 读取时恰逢整体重写（两个文件分别替换）会看到不同世代，重试一次即可。
+    for _ in range(2):
+        opened = _open(index_path)
+        if opened is not None:
+            return opened
+    return None
+
+
+def has_chunk_texts(index_path: Path) -> bool:
+    return text_index_path(index_path).exists() and texts_path(index_path).exists()
+
+
+def save_chunk_texts(index_path: Path, ids: Iterable[int], texts: Iterable[str]) -> None:
+    rows, blob = _encode(ids, texts, 0)
+    generation = _new_generation()
+    # 先写文本再写索引行：两个文件世代号一致才视为完整。
+    _atomic_write(texts_path(index_path), _BLOB_MAGIC, generation, blob)
+    _atomic_write(text_index_path(index_path), _INDEX_MAGIC, generation, rows.tobytes())
+
+
+def append_chunk_texts(index_path: Path, ids: Iterable[int], texts: Iterable[str]) -> None:
+    opened = _open_retry(index_path) if has_chunk_texts(index_path) else None
+    if opened is None:
+        save_chunk_texts(index_path, ids, texts)
+        return
+    stored_rows, _, _ = opened
+    n = int(stored_rows.shape[0])
+    end = int((stored_rows[:, 1] + stored_rows[:, 2]).max()) if n else 0
+    del opened, stored_rows
+    rows, blob = _encode(ids, texts, end)
+    if not rows.shape[0]:
+        return
+    with texts_path(index_path).open("r+b") as bf, text_index_path(index_path).open("r+b") as xf:
+        # 截掉上次中断写入留下的不完整尾部，再在末尾追加，不改写已有数据。
+        bf.truncate(HEADER_BYTES + end)
+        xf.truncate(HEADER_BYTES + n * 8 * _ROW)
+        bf.seek(0, os.SEEK_END)
+        bf.write(blob)
+        bf.flush()
+        xf.seek(0, os.SEEK_END)
+        xf.write(rows.tobytes())
+
+
+def remove_chunk_texts(index_path: Path, ids: Iterable[int]) -> int:
+    opened = _open_retry(index_path)
+    if opened is None:
+        return 0
+    rows, blob, _ = opened
+    stored_ids = rows[:, 0]
+    wanted = np.asarray(list(ids) if not isinstance(ids, np.ndarray) else ids, dtype=np.int64)
+    hit = np.isin(stored_ids, wanted) & (stored_ids != TOMBSTONE)
+    removed = int(hit.sum())
+    if not removed:
+        return 0
+
+    live = (stored_ids != TOMBSTONE) & ~hit
+    if int(live.sum()) < (1.0 - COMPACT_RATIO) * int(stored_ids.shape[0]):
+        keep = rows[live]
+        texts = [bytes(blob[o : o + ln]).decode("utf-8") for o, ln in keep[:, 1:].tolist()]
+        save_chunk_texts(index_path, keep[:, 0].tolist(), texts)
+        return removed
+
+    marker = np.int64(TOMBSTONE).tobytes()
+    with text_index_path(index_path).open("r+b") as xf:
+        for pos in np.flatnonzero(hit).tolist():
+            xf.seek(HEADER_BYTES + int(pos) * 8 * _ROW)
+            xf.write(marker)
+    return removed
+
+
+_ORDER_CACHE_LOCK = threading.Lock()
+_ORDER_CACHE: dict[str, tuple[tuple, np.ndarray, np.ndarray]] = {}
+
+
+def _sorted_id_order(index_path: Path, stored_ids: np.ndarray, generation: int) -> tuple[np.ndarray, np.ndarray]:
+    # 同 chunk_vectors：id 排序结果按文件版本缓存，检索时只做二分查找。
+    xp = text_index_path(index_path)
+    key = str(xp.resolve())
+    try:
+        st = xp.stat()
+        stamp = (generation, int(st.st_ino), int(st.st_mtime_ns), int(stored_ids.shape[0]))
+    except FileNotFoundError:
+        stamp = (generation, -1, -1, int(stored_ids.shape[0]))
+    with _ORDER_CACHE_LOCK:
+        cached = _ORDER_CACHE.get(key)
+        if cached and cached[0] == stamp:
+            return cached[1], cached[2]
+    order = np.argsort(stored_ids, kind="stable")
+    sorted_ids = np.asarray(stored_ids[order], dtype=np.int64)
+    with _ORDER_CACHE_LOCK:
+        _ORDER_CACHE[key] = (stamp, sorted_ids, order)
+    return sorted_ids, order
+
+
+def lookup_chunk_texts(index_path: Path, ids: Iterable[int]) -> dict[int, str]:
+    # 按 chunk id 取文本；未命中（文件缺失、已删除、旧知识库尚未补建）的 id 不出现在结果中。
+    opened = _open_retry(index_path)
+    if opened is None:
+        return {}
+    rows, blob, generation = opened
+    wanted = np.asarray(list(ids), dtype=np.int64)
+    wanted = wanted[wanted != TOMBSTONE]
+    if wanted.size == 0 or rows.shape[0] == 0:
+        return {}
+    sorted_ids, order = _sorted_id_order(index_path, np.asarray(rows[:, 0]), generation)
+    pos = np.clip(np.searchsorted(sorted_ids, wanted), 0, sorted_ids.shape[0] - 1)
+    hit = sorted_ids[pos] == wanted
+    out: dict[int, str] = {}
+    for cid, p in zip(wanted[hit].tolist(), order[pos[hit]].tolist()):
+        offset, length = int(rows[p, 1]), int(rows[p, 2])
+        out[int(cid)] = bytes(blob[offset : offset + length]).decode("utf-8")
+    return out
+
+
+def remove_chunk_text_files(index_path: Path) -> None:
+    for p in (texts_path(index_path), text_index_path(index_path)):
+        try:
+            p.unlink()
+        except FileNotFoundError:
+            pass
+    with _ORDER_CACHE_LOCK:
+        _ORDER_CACHE.pop(str(text_index_path(index_path).resolve()), None)
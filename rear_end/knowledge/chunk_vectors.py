@@ -0,0 +1,272 @@
+from __future__ import annotations
+
+"""
+chunk 向量与 id 映射的二进制旁路文件（与 FAISS 索引同目录）。
+
+- <index>.ids：位置 -> DocumentChunk.id 的 int64 数组；已删除的位置记为 -1（墓碑）
+- <index>.vectors：float32 矩阵，每行一个 chunk 的原始向量，与 .ids 按位置对齐
+
+两个文件都以 16 字节文件头开始（magic、向量维度、世代号），其后是原始小端数据，检索侧直接 mmap。
+追加写入只在文件末尾写新数据（先写向量再写 id，读取端取两者行数的较小值），删除只把对应位置
+改写为 -1；墓碑超过 COMPACT_RATIO 时才整体重写，重写时更换世代号，读取端发现两个文件世代号
+不一致即视为正在替换并重试。
+
+索引重建、压缩、切换索引类型时直接读取这里的向量，不再调用 embedding API。
+旧版 .vectors.npy / .vector_ids.npy 仍可读取，下一次写入时转换为新格式。
+"""
+
+import os
+import struct
+import threading
+from pathlib import Path
+from typing import Iterable
+
+import numpy as np
+
+_HEADER = struct.Struct("<8sII")
+HEADER_BYTES = _HEADER.size
+_IDS_MAGIC = b"KBIDS\x00\x00\x01"
+_VECTORS_MAGIC = b"KBVEC\x00\x00\x01"
+
+TOMBSTONE = -1
+# 墓碑占比超过该值时整体重写，回收已删除向量占用的空间。
+COMPACT_RATIO = 0.25
+
+
+def vectors_path(index_path: Path) -> Path:
+    return index_path.with_name(f"{index_path.name}.vectors")
+
+
+def vector_ids_path(index_path: Path) -> Path:
+    return index_path.with_name(f"{index_path.name}.ids")
+
+
+def _legacy_paths(index_path: Path) -> tuple[Path, Path]:
+    return (
+        index_path.with_name(f"{index_path.name}.vectors.npy"),
+        index_path.with_name(f"{index_path.name}.vector_ids.npy"),
+    )
+
+
+def _new_generation() -> int:
+    return int.from_bytes(os.urandom(4), "little")
+
+
+def _atomic_write(path: Path, magic: bytes, dim: int, generation: int, arr: np.ndarray) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f"{path.name}.tmp")
+    with tmp.open("wb") as f:
+        f.write(_HEADER.pack(magic, int(dim), int(generation)))
+        f.write(np.ascontiguousarray(arr).tobytes())
+    os.replace(str(tmp), str(path))
+
+
+def _read_header(f, magic: bytes) -> tuple[int, int] | None:
+    raw = f.read(HEADER_BYTES)
+    if len(raw) != HEADER_BYTES:
+        return None
+    got, dim, generation = _HEADER.unpack(raw)
+    if got != magic:
+        return None
+    return int(dim), int(generation)
+
+
+def _read_array(f, dtype, count: int, shape: tuple[int, ...], mmap: bool) -> np.ndarray:
+    if count == 0:
+        return np.empty(shape, dtype=dtype)
+    if mmap:
+        return np.memmap(f, dtype=dtype, mode="r", offset=HEADER_BYTES, shape=shape)
+    f.seek(HEADER_BYTES)
+    return np.fromfile(f, dtype=dtype, count=count).reshape(shape)
+
+
+def _open_binary(index_path: Path, mmap: bool) -> tuple[np.ndarray, np.ndarray, int] | None:
+    # 返回 (ids, vectors, generation)，包含墓碑；两个文件世代号不一致时返回 None。
+    try:
+        with vectors_path(index_path).open("rb") as vf, vector_ids_path(index_path).open("rb") as idf:
+            vh = _read_header(vf, _VECTORS_MAGIC)
+            ih = _read_header(idf, _IDS_MAGIC)
+            if vh is None or ih is None or vh[1] != ih[1]:
+                return None
+            dim, generation = vh
+            if dim <= 0:
+                return None
+            n_rows = (os.fstat(vf.fileno()).st_size - HEADER_BYTES) // (4 * dim)
+            n_ids = (os.fstat(idf.fileno()).st_size - HEADER_BYTES) // 8
+            n = max(0, min(n_rows, n_ids))
+            vectors = _read_array(vf, np.float32, n * dim, (n, dim), mmap)
+            ids = _read_array(idf, np.int64, n, (n,), mmap)
+    except FileNotFoundError:
+        return None
+    return ids, vectors, generation
+
+
+def _open_legacy(index_path: Path, mmap: bool) -> tuple[np.ndarray, np.ndarray] | None:
+    vp, ip = _legacy_paths(index_path)
+    if not vp.exists() or not ip.exists():
+        return None
+    try:
+        mode = "r" if mmap else None
+        vectors = np.load(str(vp), mmap_mode=mode)
+        ids = np.load(str(ip), mmap_mode=mode)
+    except Exception:
+        return None
+    if vectors.ndim != 2 or ids.ndim != 1 or int(vectors.shape[0]) != int(ids.shape[0]):
+        return None
+    return ids, vectors
+
+
+def _has_binary(index_path: Path) -> bool:
+    return vectors_path(index_path).exists() and vector_ids_path(index_path).exists()
+
+
+def _open_raw(index_path: Path, mmap: bool) -> tuple[np.ndarray, np.ndarray, int] | None:
+    if _has_binary(index_path):
+        # 读取时恰逢整体重写（两个文件分别替换）会看到不同世代，重试一次即可。
+        for _ in range(2):
+            opened = _open_binary(index_path, mmap)
+            if opened is not None:
+                return opened
+        return None
+    legacy = _open_legacy(index_path, mmap)
+    if legacy is None:
+        return None
+    return legacy[0], legacy[1], 0
+
+
+def load_chunk_vectors(index_path: Path, mmap: bool = False) -> tuple[np.ndarray, np.ndarray] | None:
+    # 返回存活的 (ids, vectors)；文件缺失或不完整视为不可用。无墓碑时 mmap 结果零拷贝。
+    opened = _open_raw(index_path, mmap)
+    if opened is None:
+        return None
+    ids, vectors, _ = opened
+    live = ids != TOMBSTONE
+    if not bool(live.all()):
+        return ids[live], vectors[live]
+    return ids, vectors
+
+
+def save_chunk_vectors(index_path: Path, ids: Iterable[int], vectors: np.ndarray) -> None:
+    ids_arr = np.asarray(list(ids) if not isinstance(ids, np.ndarray) else ids, dtype=np.int64)
+    vec_arr = np.ascontiguousarray(vectors, dtype=np.float32)
+    if vec_arr.ndim != 2 or int(vec_arr.shape[0]) != int(ids_arr.shape[0]):
+        raise ValueError("chunk 向量与 id 数量不一致")
+    generation = _new_generation()
+    dim = int(vec_arr.shape[1])
+    # 先写向量再写 id：两个文件世代号一致才视为完整。
+    _atomic_write(vectors_path(index_path), _VECTORS_MAGIC, dim, generation, vec_arr)
+    _atomic_write(vector_ids_path(index_path), _IDS_MAGIC, 0, generation, ids_arr)
+    for p in _legacy_paths(index_path):
+        try:
+            p.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def append_chunk_vectors(index_path: Path, ids: Iterable[int], vectors: np.ndarray) -> None:
+    vec_arr = np.ascontiguousarray(vectors, dtype=np.float32)
+    new_ids = np.asarray(list(ids) if not isinstance(ids, np.ndarray) else ids, dtype=np.int64)
+    if vec_arr.ndim != 2 or int(vec_arr.shape[0]) != int(new_ids.shape[0]):
+        raise ValueError("chunk 向量与 id 数量不一致")
+
+    opened = _open_binary(index_path, mmap=True) if _has_binary(index_path) else None
+    if opened is None or int(opened[1].shape[1]) != int(vec_arr.shape[1]):
+        # 无新格式文件（首次写入 / 旧版 .npy）或 embedding 维度变化：整体写入一次。
+        legacy = _open_legacy(index_path, mmap=False)
+        if legacy is not None and int(legacy[1].shape[1]) == int(vec_arr.shape[1]):
+            new_ids = np.concatenate([legacy[0], new_ids])
+            vec_arr = np.concatenate([legacy[1], vec_arr], axis=0)
+        save_chunk_vectors(index_path, new_ids, vec_arr)
+        return
+
+    n = int(opened[0].shape[0])
+    dim = int(vec_arr.shape[1])
+    del opened
+    with vectors_path(index_path).open("r+b") as vf, vector_ids_path(index_path).open("r+b") as idf:
+        # 截掉上次中断写入留下的不完整尾部，再在末尾追加，不改写已有数据。
+        vf.truncate(HEADER_BYTES + n * dim * 4)
+        idf.truncate(HEADER_BYTES + n * 8)
+        vf.seek(0, os.SEEK_END)
+        vf.write(vec_arr.tobytes())
+        vf.flush()
+        idf.seek(0, os.SEEK_END)
+        idf.write(new_ids.tobytes())
+
+
+def remove_chunk_vectors(index_path: Path, ids: Iterable[int]) -> int:
+    opened = _open_raw(index_path, mmap=True)
+    if opened is None:
+        return 0
+    stored_ids, stored_vectors, _ = opened
+    wanted = np.asarray(list(ids) if not isinstance(ids, np.ndarray) else ids, dtype=np.int64)
+    hit = np.isin(stored_ids, wanted) & (stored_ids != TOMBSTONE)
+    removed = int(hit.sum())
+    if not removed:
+        return 0
+
+    live = (stored_ids != TOMBSTONE) & ~hit
+    if not _has_binary(index_path) or int(live.sum()) < (1.0 - COMPACT_RATIO) * int(stored_ids.shape[0]):
+        save_chunk_vectors(index_path, stored_ids[live], stored_vectors[live])
+        return removed
+
+    # 原地写墓碑：只改动被删除的位置，向量文件不动。
+    marker = np.int64(TOMBSTONE).tobytes()
+    with vector_ids_path(index_path).open("r+b") as idf:
+        for pos in np.flatnonzero(hit).tolist():
+            idf.seek(HEADER_BYTES + int(pos) * 8)
+            idf.write(marker)
+    return removed
+
+
+_ORDER_CACHE_LOCK = threading.Lock()
+_ORDER_CACHE: dict[str, tuple[tuple, np.ndarray, np.ndarray]] = {}
+
+
+def _sorted_id_order(index_path: Path, stored_ids: np.ndarray, generation: int) -> tuple[np.ndarray, np.ndarray]:
+    # id 排序结果按文件版本缓存：检索时的精确重排不必每次对整库 id 排序。
+    ip = vector_ids_path(index_path)
+    key = str(ip.resolve())
+    try:
+        st = ip.stat()
+        stamp = (generation, int(st.st_ino), int(st.st_mtime_ns), int(stored_ids.shape[0]))
+    except FileNotFoundError:
+        stamp = (generation, -1, -1, int(stored_ids.shape[0]))
+    with _ORDER_CACHE_LOCK:
+        cached = _ORDER_CACHE.get(key)
+        if cached and cached[0] == stamp:
+            return cached[1], cached[2]
+    order = np.argsort(stored_ids, kind="stable")
+    sorted_ids = np.asarray(stored_ids[order], dtype=np.int64)
+    with _ORDER_CACHE_LOCK:
+        _ORDER_CACHE[key] = (stamp, sorted_ids, order)
+    return sorted_ids, order
+
+
+def lookup_chunk_vectors(index_path: Path, ids: Iterable[int]) -> dict[int, np.ndarray]:
+    # 按 chunk id 取已存储的向量；未命中的 id 不出现在结果中。
+    opened = _open_raw(index_path, mmap=True)
+    if opened is None:
+        return {}
+    stored_ids, stored_vectors, generation = opened
+    wanted = np.asarray(list(ids), dtype=np.int64)
+    wanted = wanted[wanted != TOMBSTONE]
+    if wanted.size == 0 or stored_ids.size == 0:
+        return {}
+    sorted_ids, order = _sorted_id_order(index_path, stored_ids, generation)
+    pos = np.searchsorted(sorted_ids, wanted)
+    pos = np.clip(pos, 0, sorted_ids.shape[0] - 1)
+    hit = sorted_ids[pos] == wanted
+    out: dict[int, np.ndarray] = {}
+    for cid, p in zip(wanted[hit].tolist(), order[pos[hit]].tolist()):
+        out[int(cid)] = np.array(stored_vectors[p], dtype=np.float32)
+    return out
+
+
+def remove_chunk_vector_files(index_path: Path) -> None:
+    for p in (vectors_path(index_path), vector_ids_path(index_path), *_legacy_paths(index_path)):
+        try:
+            p.unlink()
+        except FileNotFoundError:
+            pass
+    with _ORDER_CACHE_LOCK:
+        _ORDER_CACHE.pop(str(vector_ids_path(index_path).resolve()), None)
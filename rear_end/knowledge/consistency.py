@@ -0,0 +1,210 @@
+from __future__ import annotations
+
+"""
+索引一致性检查与离线修复。
+
+逐个知识库比较 FAISS 索引（主索引 + 增量段的 ntotal 与 id 映射）与 DocumentChunk 行，并检查各旁路文件：
+
+- index_missing：数据库有 chunk 但索引不存在 / 不可读
+- legacy_index：旧版位置寻址索引（.meta.json），需迁移为按 chunk id 寻址
+- duplicate_ids / ntotal_mismatch：索引内 id 重复或向量数与 id 映射不符
+- orphan_vectors：索引中有、数据库已删除的 chunk
+- missing_vectors：数据库中有、索引缺失的 chunk
+- chunk_vectors_missing / lexical_missing / texts_missing：chunk 向量、BM25、chunk 文本旁路文件缺失
+- unnormalized_vectors：向量未单位化（早于余弦检索写入），按 rebuild_index 复用已有向量单位化后重建
+
+修复在检索请求之外执行：旧版索引按 .meta.json（缺失时按入库顺序推导）迁移；缺向量或索引损坏时按数据库内容
+rebuild_index（已持久化的 chunk 向量直接复用，只对缺失部分调用 embedding）；多余向量按 id 删除；旁路文件补建。
+修复后复查，仍有问题的知识库标记为 degraded 并记录原因。有入库任务排队或执行中的知识库跳过（任务执行期间
+chunk 已入库而向量尚未写入，属于正常的中间状态）。
+"""
+
+import logging
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import numpy as np
+from django.utils import timezone
+
+from .chunk_texts import has_chunk_texts
+from .chunk_vectors import load_chunk_vectors
+from .ingestion import ACTIVE_STATUSES
+from .lexical import has_lexical_index
+from .models import DocumentChunk, IngestionJob, KnowledgeBase
+from .services import bump_content_version
+from .vectorstore import (
+    backfill_chunk_texts,
+    backfill_chunk_vectors,
+    backfill_lexical_index,
+    count_vectors,
+    is_id_mapped,
+    list_chunk_ids,
+    load_faiss_index,
+    migrate_legacy_index,
+    rebuild_index,
+    remove_vectors_from_index,
+)
+
+logger = logging.getLogger(__name__)
+
+# 需要按数据库内容重建索引的问题。
+_REBUILD_ISSUES = {"index_missing", "duplicate_ids", "ntotal_mismatch", "missing_vectors", "unnormalized_vectors"}
+# 单位化检查抽样的向量数与容差。
+_NORM_SAMPLE = 1024
+_NORM_TOLERANCE = 1e-3
+
+
+@dataclass
+class ConsistencyResult:
+    kb_id: int
+    issues: list[str] = field(default_factory=list)
+    repaired: list[str] = field(default_factory=list)
+    skipped: str = ""
+
+    @property
+    def ok(self) -> bool:
+        return not self.issues and not self.skipped
+
+
+def _db_chunk_ids(kb: KnowledgeBase) -> np.ndarray:
+    # 空文本的 chunk 不会写入索引，不参与比较。
+    ids = DocumentChunk.objects.filter(document__kb=kb).exclude(text="").values_list("id", flat=True)
+    return np.asarray(sorted(int(i) for i in ids), dtype=np.int64)
+
+
+def _is_normalized(vectors: np.ndarray) -> bool:
+    n = int(vectors.shape[0])
+    if n == 0:
+        return True
+    step = max(1, n // _NORM_SAMPLE)
+    norms = np.linalg.norm(np.asarray(vectors[::step], dtype=np.float32), axis=1)
+    norms = norms[norms > 0]
+    return bool(np.all(np.abs(norms - 1.0) <= _NORM_TOLERANCE))
+
+
+def find_index_issues(kb: KnowledgeBase, chunk_ids: np.ndarray) -> list[str]:
+    index_path = Path(kb.faiss_path)
+    index = load_faiss_index(index_path)
+    if index is None:
+        return ["index_missing"] if chunk_ids.size else []
+    if not is_id_mapped(index):
+        return ["legacy_index"]
+
+    issues: list[str] = []
+    indexed = list_chunk_ids(index_path)
+    unique = np.unique(indexed)
+    if unique.size != indexed.size:
+        issues.append(f"duplicate_ids:{int(indexed.size - unique.size)}")
+    if count_vectors(index_path) != int(indexed.size):
+        issues.append("ntotal_mismatch")
+    orphans = np.setdiff1d(unique, chunk_ids, assume_unique=True)
+    if orphans.size:
+        issues.append(f"orphan_vectors:{int(orphans.size)}")
+    missing = np.setdiff1d(chunk_ids, unique, assume_unique=True)
+    if missing.size:
+        issues.append(f"missing_vectors:{int(missing.size)}")
+    if unique.size:
+        stored = load_chunk_vectors(index_path, mmap=True)
+        if stored is None:
+            issues.append("chunk_vectors_missing")
+        elif not _is_normalized(stored[1]):
+            issues.append("unnormalized_vectors")
+        if not has_lexical_index(index_path):
+            issues.append("lexical_missing")
+        if not has_chunk_texts(index_path):
+            issues.append("texts_missing")
+    return issues
+
+
+def _issue_names(issues: list[str]) -> set[str]:
+    return {i.split(":", 1)[0] for i in issues}
+
+
+def _chunk_rows(kb: KnowledgeBase) -> list[tuple[int, str]]:
+    return list(DocumentChunk.objects.filter(document__kb=kb).order_by("id").values_list("id", "text"))
+
+
+def _repair(kb: KnowledgeBase, issues: list[str]) -> list[str]:
+    index_path = Path(kb.faiss_path)
+    names = _issue_names(issues)
+    repaired: list[str] = []
+
+    if "legacy_index" in names:
+        fallback_ids = (
+            DocumentChunk.objects.filter(document__kb=kb)
+            .order_by("document_id", "chunk_index")
+            .values_list("id", flat=True)
+        )
+        try:
+            migrate_legacy_index(index_path, fallback_ids=fallback_ids)
+            repaired.append("legacy_index")
+            names = _issue_names(find_index_issues(kb, _db_chunk_ids(kb)))
+        except ValueError:
+            # 位置与 chunk id 的对应关系无法确定：按数据库内容重建。
+            names = {"index_missing"}
+
+    if names & _REBUILD_ISSUES:
+        rows = _chunk_rows(kb)
+        rebuild_index(index_path, [t for _, t in rows], [cid for cid, _ in rows], config=kb.index_config)
+        # 重建同时重写了 chunk 向量、BM25 与 chunk 文本文件。
+        return repaired + ["rebuilt"]
+
+    if "orphan_vectors" in names:
+        orphans = np.setdiff1d(list_chunk_ids(index_path), _db_chunk_ids(kb))
+        remove_vectors_from_index(index_path, orphans.tolist(), config=kb.index_config)
+        repaired.append("orphan_vectors")
+    if "chunk_vectors_missing" in names and backfill_chunk_vectors(index_path):
+        repaired.append("chunk_vectors")
+    if names & {"lexical_missing", "texts_missing"}:
+        rows = _chunk_rows(kb)
+        if backfill_lexical_index(index_path, rows):
+            repaired.append("lexical")
+        if backfill_chunk_texts(index_path, rows):
+            repaired.append("texts")
+    return repaired
+
+
+def _record(kb: KnowledgeBase, issues: list[str]) -> None:
+    KnowledgeBase.objects.filter(id=kb.id).update(
+        index_status=KnowledgeBase.INDEX_DEGRADED if issues else KnowledgeBase.INDEX_OK,
+        index_issue=", ".join(issues)[:255],
+        index_checked_at=timezone.now(),
+    )
+
+
+def check_knowledge_base(kb: KnowledgeBase, repair: bool = True) -> ConsistencyResult:
+    result = ConsistencyResult(kb_id=kb.id)
+    if IngestionJob.objects.filter(kb=kb, status__in=ACTIVE_STATUSES).exists():
+        result.skipped = "入库任务进行中"
+        return result
+
+    result.issues = find_index_issues(kb, _db_chunk_ids(kb))
+    if repair and result.issues:
+        result.repaired = _repair(kb, result.issues)
+        result.issues = find_index_issues(kb, _db_chunk_ids(kb))
+        if result.repaired:
+            bump_content_version(kb.id)
+    _record(kb, result.issues)
+    return result
+
+
+def run_consistency_check(
+    kb_ids: list[int] | None = None, repair: bool = True, pending_only: bool = False
+) -> list[ConsistencyResult]:
+    # pending_only：只检查被请求路径标记为 degraded、尚未检查过的知识库（worker 每次空闲轮询时执行）。
+    qs = KnowledgeBase.objects.exclude(faiss_path="").order_by("id")
+    if kb_ids:
+        qs = qs.filter(id__in=kb_ids)
+    if pending_only:
+        qs = qs.filter(index_status=KnowledgeBase.INDEX_DEGRADED, index_checked_at__isnull=True)
+
+    results: list[ConsistencyResult] = []
+    for kb in qs:
+        try:
+            results.append(check_knowledge_base(kb, repair=repair))
+        except Exception as e:
+            logger.exception("consistency check for kb %s failed", kb.id)
+            issues = [f"check_failed: {e}"]
+            _record(kb, issues)
+            results.append(ConsistencyResult(kb_id=kb.id, issues=issues))
+    return results
@@ -0,0 +1,135 @@
+from __future__ import annotations
+
+"""
+embedding 请求分批与并发。
+
+按条数与估算 token 数两个上限切分批次，批次在有界线程池中并发请求，失败的批次按指数退避重试，
+结果按原始顺序拼回。各服务商的上限不同（如 DashScope text-embedding-v3/v4 每次最多 10 条），
+默认值见 _DEFAULT_PROVIDERS，按 OPENAI_BASE_URL 的域名匹配，可用 settings.KB_EMBEDDING_PROVIDERS 逐项覆盖。
+"""
+
+import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable
+from urllib.parse import urlparse
+
+import numpy as np
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_DEFAULT_PROVIDERS = {
+    "dashscope": {"batch_size": 10, "max_tokens": 8192 * 10, "concurrency": 4},
+    "openai": {"batch_size": 512, "max_tokens": 300_000, "concurrency": 4},
+    "default": {"batch_size": 64, "max_tokens": 64_000, "concurrency": 2},
+}
+
+
+@dataclass(frozen=True)
+class BatchConfig:
+    batch_size: int = 64
+    max_tokens: int = 64_000
+    concurrency: int = 2
+    max_retries: int = 3
+    backoff_seconds: float = 1.0
+
+
+def provider_name(base_url: str) -> str:
+    host = (urlparse(base_url or "").hostname or "").lower()
+    if not host or host.endswith("openai.com"):
+        return "openai"
+    if "dashscope" in host or host.endswith("aliyuncs.com"):
+        return "dashscope"
+    return "default"
+
+
+def get_batch_config(base_url: str) -> BatchConfig:
+    providers = getattr(settings, "KB_EMBEDDING_PROVIDERS", None) or _DEFAULT_PROVIDERS
+    name = provider_name(base_url)
+    values = dict(_DEFAULT_PROVIDERS["default"])
+    values.update(_DEFAULT_PROVIDERS.get(name, {}))
+    values.update(providers.get(name) or providers.get("default") or {})
+    # 全局环境变量覆盖（0 表示沿用服务商默认值）。
+    for key, setting in (
+        ("batch_size", "KB_EMBEDDING_BATCH_SIZE"),
+        ("max_tokens", "KB_EMBEDDING_BATCH_TOKENS"),
+        ("concurrency", "KB_EMBEDDING_CONCURRENCY"),
+    ):
+        override = int(getattr(settings, setting, 0) or 0)
+        if override > 0:
+            values[key] = override
+    return BatchConfig(
+        batch_size=max(1, int(values["batch_size"])),
+        max_tokens=max(1, int(values["max_tokens"])),
+        concurrency=max(1, int(values["concurrency"])),
+        max_retries=max(0, int(getattr(settings, "KB_EMBEDDING_MAX_RETRIES", 3))),
+        backoff_seconds=float(getattr(settings, "KB_EMBEDDING_RETRY_BACKOFF", 1.0)),
+    )
+
+
+def estimate_tokens(text: str) -> int:
+    # 粗略估算：CJK 字符约 1 token / 字，其余约 4 字符 / token。
+    cjk = sum(1 for ch in text or "" if "\u4e00" <= ch <= "\u9fff" or "\u3400" <= ch <= "\u4dbf")
+    other = len(text or "") - cjk
+    return cjk + (other + 3) // 4 + 1
+
+
+def plan_batches(texts: list[str], batch_size: int, max_tokens: int) -> list[list[int]]:
+    # 返回每批的原始下标；单条超过 token 上限时独占一批，由服务端决定是否截断。
+    batches: list[list[int]] = []
+    current: list[int] = []
+    tokens = 0
+    for i, t in enumerate(texts):
+        n = estimate_tokens(t)
+        if current and (len(current) >= batch_size or tokens + n > max_tokens):
+            batches.append(current)
+            current, tokens = [], 0
+        current.append(i)
+        tokens += n
+    if current:
+        batches.append(current)
+    return batches
+
+
+def _with_retry(fn: Callable[[], list], cfg: BatchConfig, label: str) -> list:
+    attempt = 0
+    while True:
+        try:
+            return fn()
+        except Exception:
+            if attempt >= cfg.max_retries:
+                raise
+            delay = cfg.backoff_seconds * (2**attempt) * (1.0 + random.random() * 0.25)
+            logger.warning("embedding batch %s failed, retry %d in %.1fs", label, attempt + 1, delay, exc_info=True)
+            time.sleep(delay)
+            attempt += 1
+
+
+def embed_in_batches(
+    texts: list[str], embed_batch: Callable[[list[str]], list], cfg: BatchConfig
+) -> np.ndarray:
+    if not texts:
+        return np.zeros((0, 0), dtype=np.float32)
+    batches = plan_batches(texts, cfg.batch_size, cfg.max_tokens)
+
+    def run(n: int) -> list:
+        idx = batches[n]
+        vectors = _with_retry(lambda: embed_batch([texts[i] for i in idx]), cfg, f"{n + 1}/{len(batches)}")
+        if len(vectors) != len(idx):
+            raise RuntimeError("embedding 返回数量与输入不一致")
+        return vectors
+
+    if len(batches) == 1 or cfg.concurrency == 1:
+        results = [run(n) for n in range(len(batches))]
+    else:
+        with ThreadPoolExecutor(max_workers=min(cfg.concurrency, len(batches)), thread_name_prefix="kb-embed") as pool:
+            results = list(pool.map(run, range(len(batches))))
+
+    out: list = [None] * len(texts)
+    for idx, vectors in zip(batches, results):
+        for i, vec in zip(idx, vectors):
+            out[i] = vec
+    return np.asarray(out, dtype=np.float32)
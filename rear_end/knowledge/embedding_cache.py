@@ -0,0 +1,115 @@
+from __future__ import annotations
+
+"""
+入库 embedding 的内容寻址缓存。
+
+键为 (embedding 模型, sha256(chunk 文本))，值为 float32 向量字节；基于 diskcache 落盘，
+多进程共享，按容量上限做 LRU 淘汰。相同文本在不同知识库或重复上传时只向量化一次。
+"""
+
+import hashlib
+import threading
+import time
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
+
+
+def cache_key(model: str, text: str) -> str:
+    digest = hashlib.sha256((text or "").encode("utf-8")).hexdigest()
+    return f"emb:{model}:{digest}"
+
+
+class EmbeddingCache:
+    def __init__(self, directory: Path, size_limit_bytes: int):
+        import diskcache
+
+        self.directory = Path(directory)
+        self.size_limit_bytes = int(size_limit_bytes)
+        self._cache = diskcache.Cache(
+            str(self.directory),
+            size_limit=self.size_limit_bytes,
+            eviction_policy="least-recently-used",
+        )
+        # 进程内计数：用于估算节省的 embedding 调用量与入库耗时。
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._hit_chars = 0
+        self._miss_seconds = 0.0
+
+    def get_or_embed(
+        self, model: str, texts: list[str], embed_fn: Callable[[list[str]], np.ndarray]
+    ) -> np.ndarray:
+        if not texts:
+            return embed_fn(texts)
+
+        keys = [cache_key(model, t) for t in texts]
+        found: dict[str, np.ndarray] = {}
+        for key in set(keys):
+            raw = self._cache.get(key)
+            if raw is not None:
+                found[key] = np.frombuffer(raw, dtype=np.float32)
+
+        # 同一批次内的重复文本只向量化一次。
+        missing: dict[str, str] = {}
+        for key, t in zip(keys, texts):
+            if key not in found and key not in missing:
+                missing[key] = t
+
+        elapsed = 0.0
+        if missing:
+            t0 = time.perf_counter()
+            embedded = np.asarray(embed_fn(list(missing.values())), dtype=np.float32)
+            elapsed = time.perf_counter() - t0
+            for key, vec in zip(missing.keys(), embedded):
+                vec = np.ascontiguousarray(vec, dtype=np.float32)
+                self._cache.set(key, vec.tobytes())
+                found[key] = vec
+
+        dims = {int(v.shape[0]) for v in found.values()}
+        if len(dims) != 1:
+            # 缓存中残留了其它维度的向量（同名模型配置变化）：整批重新向量化。
+            return np.asarray(embed_fn(texts), dtype=np.float32)
+
+        # 每个缺失键的首次出现计为 miss，其余（缓存命中或批内重复）都计为节省的调用。
+        hit_count = 0
+        hit_chars = 0
+        counted: set[str] = set()
+        for key, t in zip(keys, texts):
+            if key in missing and key not in counted:
+                counted.add(key)
+                continue
+            hit_count += 1
+            hit_chars += len(t or "")
+        with self._lock:
+            self._hits += hit_count
+            self._misses += len(missing)
+            self._hit_chars += hit_chars
+            self._miss_seconds += elapsed
+
+        return np.stack([found[k] for k in keys]).astype(np.float32, copy=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            hits, misses = self._hits, self._misses
+            hit_chars, miss_seconds = self._hit_chars, self._miss_seconds
+        total = hits + misses
+        avg_miss_ms = (miss_seconds * 1000.0 / misses) if misses else 0.0
+        return {
+            "enabled": True,
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": round(hits / total, 4) if total else 0.0,
+            "saved_chars": hit_chars,
+            "estimated_saved_ms": int(avg_miss_ms * hits),
+            "size_bytes": int(self._cache.volume()),
+            "size_limit_bytes": self.size_limit_bytes,
+        }
+
+    def clear(self) -> None:
+        self._cache.clear()
+        with self._lock:
+            self._hits = self._misses = self._hit_chars = 0
+            self._miss_seconds = 0.0
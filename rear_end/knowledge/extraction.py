@@ -0,0 +1,146 @@
+import codecs
+import logging
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import BinaryIO, Iterator
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+_BLOCK_BYTES = 1 << 20
+
+
+def _block_bytes() -> int:
+    return max(4096, int(getattr(settings, "KB_EXTRACT_BLOCK_BYTES", _BLOCK_BYTES)))
+
+
+def _is_utf8(upload_path: Path, block: int) -> bool:
+    # 逐块校验（增量解码器处理跨块的多字节字符），不保留解码结果。
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    with upload_path.open("rb") as f:
+        try:
+            while chunk := f.read(block):
+                decoder.decode(chunk)
+            decoder.decode(b"", final=True)
+        except UnicodeDecodeError:
+            return False
+    return True
+
+
+def _iter_text_blocks(upload_path: Path) -> Iterator[str]:
+    # 文本类文件：优先 utf-8，失败回退 gbk（兼容部分 Windows 文本）。
+    # 编码按整个文件判定，因此先校验一遍再按块解码产出，内存占用与文件大小无关。
+    block = _block_bytes()
+    if _is_utf8(upload_path, block):
+        decoder = codecs.getincrementaldecoder("utf-8")()
+    else:
+        decoder = codecs.getincrementaldecoder("gbk")(errors="ignore")
+    with upload_path.open("rb") as f:
+        while chunk := f.read(block):
+            text = decoder.decode(chunk)
+            if text:
+                yield text
+    tail = decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+
+def _open_pdf(f: BinaryIO):
+    if f.read(4) != b"%PDF":
+        raise ValueError("不是有效的 PDF 文件")
+    f.seek(0)
+    try:
+        from pypdf import PdfReader
+    except Exception as e:  # pragma: no cover
+        raise RuntimeError("服务端未安装 PDF 解析依赖 pypdf") from e
+    return PdfReader(f)
+
+
+def _page_text(page) -> str:
+    return page.extract_text() or ""
+
+
+def _extract_page_range(path: str, start: int, stop: int) -> list[str]:
+    # 进程池任务：子进程各自打开文件，只解析分到的页（页对象不可跨进程传递）。
+    from pypdf import PdfReader
+
+    with open(path, "rb") as f:
+        reader = PdfReader(f)
+        return [_page_text(reader.pages[i]) for i in range(start, stop)]
+
+
+def _pdf_workers() -> int:
+    configured = int(getattr(settings, "KB_PDF_WORKERS", 0) or 0)
+    return configured if configured > 0 else min(4, os.cpu_count() or 1)
+
+
+def _iter_page_texts_parallel(upload_path: Path, reader, workers: int) -> Iterator[str]:
+    # 页区间分给进程池并行抽取，按页序产出；在途任务数有上限，避免结果在内存中堆积。
+    total = len(reader.pages)
+    step = max(1, int(getattr(settings, "KB_PDF_PAGES_PER_TASK", 16)))
+    ranges = [(i, min(i + step, total)) for i in range(0, total, step)]
+    next_page = 0
+    try:
+        # spawn：调用方可能处于多线程环境（入库流水线），fork 后子进程可能继承被持有的锁。
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+            pending = deque()
+            todo = iter(ranges)
+            for r in todo:
+                pending.append(pool.submit(_extract_page_range, str(upload_path), *r))
+                if len(pending) >= workers * 2:
+                    break
+            while pending:
+                texts = pending.popleft().result()
+                r = next(todo, None)
+                if r is not None:
+                    pending.append(pool.submit(_extract_page_range, str(upload_path), *r))
+                for t in texts:
+                    next_page += 1
+                    yield t
+    except (OSError, BrokenProcessPool):
+        # 无法创建子进程（受限环境）：剩余页回退为单进程抽取。
+        logger.warning("pdf process pool unavailable, extracting %s serially", upload_path, exc_info=True)
+        for i in range(next_page, total):
+            yield _page_text(reader.pages[i])
+
+
+def _iter_pdf_pages(upload_path: Path) -> Iterator[str]:
+    # PDF 文件：通过 pypdf 逐页提取文字（扫描件/图片型 PDF 通常无文本），页与页之间以换行分隔。
+    # 直接读文件句柄而非整文件读入内存，页面内容按需解析。
+    # 页数达到 KB_PDF_PARALLEL_MIN_PAGES 时按页区间分给进程池并行解析（extract_text 为 CPU 密集）。
+    with upload_path.open("rb") as f:
+        reader = _open_pdf(f)
+        workers = _pdf_workers()
+        min_pages = int(getattr(settings, "KB_PDF_PARALLEL_MIN_PAGES", 64))
+        if workers > 1 and len(reader.pages) >= max(2, min_pages):
+            texts = _iter_page_texts_parallel(upload_path, reader, workers)
+        else:
+            texts = (_page_text(page) for page in reader.pages)
+        first = True
+        for t in texts:
+            if t.strip():
+                yield t if first else "\n" + t
+                first = False
+
+
+def iter_upload_text(upload_path: Path) -> Iterator[str]:
+    # 逐段产出文本（PDF 按页、文本按块），拼接结果与 extract_upload_text 一致，供入库流水线边抽取边分块。
+    suffix = upload_path.suffix.lower()
+    if suffix not in {".txt", ".md", ".pdf"}:
+        raise ValueError("不支持的文件类型")
+    if suffix == ".pdf":
+        yield from _iter_pdf_pages(upload_path)
+    else:
+        yield from _iter_text_blocks(upload_path)
+
+
+def extract_upload_text(upload_path: Path) -> str:
+    # 统一抽取文本入口：根据后缀选择解析方式
+    return "".join(iter_upload_text(upload_path))
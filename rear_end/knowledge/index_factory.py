@@ -0,0 +1,269 @@
+from __future__ import annotations
+
+"""
+FAISS 索引工厂：按知识库规模选择索引类型。
+
+- flat：精确检索，适合小知识库（ntotal < KB_ANN_THRESHOLD）
+- ivf：IndexIVFFlat，倒排聚类后只扫描 nprobe 个桶；训练集从已有向量中随机采样
+- hnsw：IndexHNSWFlat，图索引，查询参数为 efSearch（不支持按 id 删除，删除时从持久化向量离线重建）
+
+向量编码（compression）与索引类型正交：
+- none：float32 原始向量
+- fp16：半精度，内存减半，召回几乎无损
+- sq8：8bit 标量量化，约为 float32 的 1/4
+- pq：乘积量化（每个子空间 8bit），1024 维时约为 float32 的 1/32；样本不足 256 条时退回 sq8
+压缩索引可在检索时用持久化的 float32 向量对候选做精确重排（见 vectorstore.search_index）。
+
+实际构建出的规格（IndexSpec）写入 <index>.spec.json，与索引文件同生命周期；
+知识库级的覆盖配置来自 KnowledgeBase.index_config（index_type / nprobe / ef_search /
+compression / rerank / rerank_factor）。
+"""
+
+import json
+import math
+import os
+from dataclasses import asdict, dataclass, replace
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+
+INDEX_KINDS = ("flat", "ivf", "hnsw")
+COMPRESSIONS = ("none", "fp16", "sq8", "pq")
+
+# IVF 每个聚类中心建议的最少训练样本数（FAISS 推荐 39~256）。
+_MIN_POINTS_PER_CENTROID = 39
+_MAX_POINTS_PER_CENTROID = 64
+
+# PQ 每个子空间 8bit，即 256 个码字，训练样本至少需要 256 条。
+_PQ_NBITS = 8
+_PQ_MIN_TRAIN = 1 << _PQ_NBITS
+
+
+@dataclass(frozen=True)
+class IndexSpec:
+    kind: str = "flat"
+    nlist: int = 0
+    hnsw_m: int = 32
+    nprobe: int = 16
+    ef_search: int = 64
+    compression: str = "none"
+    pq_m: int = 0
+
+
+def _faiss():
+    import faiss
+
+    return faiss
+
+
+def spec_path(index_path: Path) -> Path:
+    return index_path.with_name(f"{index_path.name}.spec.json")
+
+
+def load_index_spec(index_path: Path) -> IndexSpec:
+    # 无 spec 文件的历史索引一律视为 flat。
+    sp = spec_path(index_path)
+    try:
+        data = json.loads(sp.read_text(encoding="utf-8"))
+    except (FileNotFoundError, ValueError):
+        return IndexSpec()
+    fields = {k: data[k] for k in IndexSpec.__dataclass_fields__ if k in data}
+    spec = IndexSpec(**fields)
+    if spec.kind not in INDEX_KINDS or spec.compression not in COMPRESSIONS:
+        return IndexSpec()
+    return spec
+
+
+def save_index_spec(index_path: Path, spec: IndexSpec) -> None:
+    sp = spec_path(index_path)
+    sp.parent.mkdir(parents=True, exist_ok=True)
+    tmp = sp.with_name(f"{sp.name}.tmp")
+    tmp.write_text(json.dumps(asdict(spec), ensure_ascii=False), encoding="utf-8")
+    os.replace(str(tmp), str(sp))
+
+
+def remove_index_spec(index_path: Path) -> None:
+    try:
+        spec_path(index_path).unlink()
+    except FileNotFoundError:
+        pass
+
+
+def _ann_threshold() -> int:
+    return max(1, int(getattr(settings, "KB_ANN_THRESHOLD", 20000)))
+
+
+def choose_index_spec(ntotal: int, config: dict | None = None, current: IndexSpec | None = None) -> IndexSpec:
+    """
+    根据向量规模与知识库配置选择索引规格。
+
+    index_type=auto 时：ntotal 达到 KB_ANN_THRESHOLD 升级为 KB_ANN_INDEX_TYPE；已是 ANN 的索引
+    在 ntotal 回落到阈值一半以下才降回 flat，避免在边界附近反复迁移。
+    """
+    config = config or {}
+    ntotal = max(0, int(ntotal))
+    kind = (config.get("index_type") or "auto").lower()
+    if kind not in INDEX_KINDS:
+        threshold = _ann_threshold()
+        ann_kind = (getattr(settings, "KB_ANN_INDEX_TYPE", "ivf") or "ivf").lower()
+        if ann_kind not in ("ivf", "hnsw"):
+            ann_kind = "ivf"
+        if current is not None and current.kind != "flat":
+            kind = current.kind if ntotal >= threshold // 2 else "flat"
+        else:
+            kind = ann_kind if ntotal >= threshold else "flat"
+
+    nlist = 0
+    if kind == "ivf":
+        # 经验值 nlist ≈ 4·sqrt(N)，同时保证每个中心至少有 39 个训练样本。
+        nlist = int(4 * math.sqrt(max(ntotal, 1)))
+        nlist = max(1, min(nlist, ntotal // _MIN_POINTS_PER_CENTROID or 1))
+        if current is not None and current.kind == "ivf" and current.nlist:
+            nlist = current.nlist
+        if ntotal < nlist:
+            # 向量数不足以训练聚类中心：退回 flat。
+            kind, nlist = "flat", 0
+
+    compression = (config.get("compression") or getattr(settings, "KB_INDEX_COMPRESSION", "none") or "none").lower()
+    if compression not in COMPRESSIONS:
+        compression = "none"
+    if compression == "pq" and ntotal < _PQ_MIN_TRAIN:
+        compression = "sq8"
+
+    spec = IndexSpec(
+        kind=kind,
+        nlist=nlist,
+        hnsw_m=int(getattr(settings, "KB_HNSW_M", 32)),
+        nprobe=int(getattr(settings, "KB_IVF_NPROBE", 16)),
+        ef_search=int(getattr(settings, "KB_HNSW_EF_SEARCH", 64)),
+        compression=compression,
+        pq_m=int(config.get("pq_m") or 0),
+    )
+    if config.get("nprobe"):
+        spec = replace(spec, nprobe=int(config["nprobe"]))
+    if config.get("ef_search"):
+        spec = replace(spec, ef_search=int(config["ef_search"]))
+    return spec
+
+
+def needs_migration(current: IndexSpec, target: IndexSpec) -> bool:
+    # 仅索引类型或向量编码变化才需要重建；nprobe / efSearch 属于查询参数，直接生效。
+    return current.kind != target.kind or current.compression != target.compression
+
+
+def needs_training(spec: IndexSpec) -> bool:
+    return spec.kind == "ivf" or spec.compression in ("sq8", "pq")
+
+
+def _training_limit(spec: IndexSpec) -> int:
+    limit = 0
+    if spec.kind == "ivf":
+        limit = max(limit, int(spec.nlist) * _MAX_POINTS_PER_CENTROID)
+    if spec.compression == "pq":
+        limit = max(limit, _PQ_MIN_TRAIN * _MAX_POINTS_PER_CENTROID)
+    if spec.compression == "sq8":
+        limit = max(limit, 10000)
+    return max(limit, 1)
+
+
+def sample_training_set(vectors: np.ndarray, limit: int, seed: int = 1234) -> np.ndarray:
+    # 训练集随机采样：避免对大知识库全量做 k-means / 量化训练。
+    n = int(vectors.shape[0])
+    if n <= limit:
+        return np.ascontiguousarray(vectors, dtype=np.float32)
+    rng = np.random.default_rng(seed)
+    picked = np.sort(rng.choice(n, size=limit, replace=False))
+    return np.ascontiguousarray(vectors[picked], dtype=np.float32)
+
+
+def pq_subquantizers(spec: IndexSpec, dim: int) -> int:
+    # 默认每 8 维一个子空间（1 字节），取不超过 dim/8 的最大约数，保证能整除维度。
+    m = int(spec.pq_m) if spec.pq_m and dim % int(spec.pq_m) == 0 else max(1, dim // 8)
+    while dim % m:
+        m -= 1
+    return m
+
+
+def _sq_type(compression: str):
+    faiss = _faiss()
+    if compression == "fp16":
+        return faiss.ScalarQuantizer.QT_fp16
+    return faiss.ScalarQuantizer.QT_8bit
+
+
+def create_index(spec: IndexSpec, dim: int, training_vectors: np.ndarray | None = None):
+    faiss = _faiss()
+    compression = spec.compression
+    if spec.kind == "ivf":
+        quantizer = faiss.IndexFlatL2(dim)
+        if compression == "none":
+            inner = faiss.IndexIVFFlat(quantizer, dim, int(spec.nlist))
+        elif compression == "pq":
+            inner = faiss.IndexIVFPQ(quantizer, dim, int(spec.nlist), pq_subquantizers(spec, dim), _PQ_NBITS)
+        else:
+            inner = faiss.IndexIVFScalarQuantizer(quantizer, dim, int(spec.nlist), _sq_type(compression))
+        inner.nprobe = int(spec.nprobe)
+    elif spec.kind == "hnsw":
+        if compression == "none":
+            inner = faiss.IndexHNSWFlat(dim, int(spec.hnsw_m))
+        elif compression == "pq":
+            inner = faiss.IndexHNSWPQ(dim, pq_subquantizers(spec, dim), int(spec.hnsw_m))
+        else:
+            inner = faiss.IndexHNSWSQ(dim, _sq_type(compression), int(spec.hnsw_m))
+        inner.hnsw.efSearch = int(spec.ef_search)
+    else:
+        if compression == "none":
+            inner = faiss.IndexFlatL2(dim)
+        elif compression == "pq":
+            inner = faiss.IndexPQ(dim, pq_subquantizers(spec, dim), _PQ_NBITS)
+        else:
+            inner = faiss.IndexScalarQuantizer(dim, _sq_type(compression))
+
+    if not inner.is_trained:
+        minimum = max(int(spec.nlist), _PQ_MIN_TRAIN if compression == "pq" else 1)
+        if training_vectors is None or int(training_vectors.shape[0]) < minimum:
+            raise ValueError("索引训练样本不足")
+        inner.train(sample_training_set(training_vectors, _training_limit(spec)))
+    return faiss.IndexIDMap2(inner)
+
+
+def build_index(spec: IndexSpec, ids: np.ndarray, vectors: np.ndarray, trained=None):
+    # trained：同规格、已训练的索引，复用其聚类中心 / 码本（清空后重新装入向量），省去重新训练。
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    if trained is not None:
+        faiss = _faiss()
+        inner = faiss.clone_index(faiss.downcast_index(trained.index))
+        inner.reset()
+        index = faiss.IndexIDMap2(inner)
+    else:
+        training = vectors if needs_training(spec) else None
+        index = create_index(spec, int(vectors.shape[1]), training_vectors=training)
+    if int(vectors.shape[0]):
+        index.add_with_ids(vectors, np.asarray(ids, dtype=np.int64))
+    return index
+
+
+def rerank_factor(spec: IndexSpec, config: dict | None = None) -> int:
+    # 压缩索引默认取 top_k × factor 个候选，再用 float32 原始向量精确重排；未压缩时无需重排。
+    config = config or {}
+    if spec.compression == "none" or config.get("rerank") is False:
+        return 1
+    return max(1, int(config.get("rerank_factor") or getattr(settings, "KB_RERANK_FACTOR", 4)))
+
+
+def index_memory_bytes(index) -> int:
+    # 以序列化后的字节数近似索引常驻内存（编码 + 聚类中心 / 图结构 + id 映射）。
+    faiss = _faiss()
+    return int(faiss.serialize_index(index).nbytes)
+
+
+def search_params(spec: IndexSpec, config: dict | None = None):
+    # 按知识库配置生成单次查询参数，不修改共享的索引对象。
+    faiss = _faiss()
+    config = config or {}
+    if spec.kind == "ivf":
+        return faiss.SearchParametersIVF(nprobe=int(config.get("nprobe") or spec.nprobe))
+    if spec.kind == "hnsw":
+        return faiss.SearchParametersHNSW(efSearch=int(config.get("ef_search") or spec.ef_search))
+    return None
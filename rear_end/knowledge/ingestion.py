@@ -0,0 +1,277 @@
+"""
+文档入库任务。
+
+上传接口只把文件落盘并创建 IngestionJob（status=queued），由 run_ingest_worker 管理命令轮询数据库、
+在本地线程池中执行 run_ingestion_job，无需外部 broker。任务经过 extract / chunk / embed / index
+四个阶段（流水线并行执行，见 process_job），进度（阶段、chunk 总数、已向量化数、各阶段吞吐）随时写回任务行，
+供状态接口查询。
+KB_INGEST_ASYNC=False 时上传接口在请求内同步执行同一流程。
+"""
+
+import logging
+import time
+from datetime import timedelta
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+
+from .extraction import iter_upload_text
+from .models import Document, DocumentChunk, IngestionJob, KnowledgeBase
+from .pipeline import Pipeline, PipelineError
+from .services import bump_content_version, safe_remove_file
+from .vectorstore import add_embedded_vectors_to_index, embed_chunk_texts, iter_chunk_text, remove_vectors_from_index
+
+logger = logging.getLogger(__name__)
+
+ACTIVE_STATUSES = (IngestionJob.STATUS_QUEUED, IngestionJob.STATUS_RUNNING)
+
+
+class IngestionError(Exception):
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+def create_ingestion_job(kb: KnowledgeBase, user, filename: str, upload_path: Path, replace_existing: bool) -> IngestionJob:
+    return IngestionJob.objects.create(
+        kb=kb,
+        user=user,
+        filename=filename,
+        file_path=str(upload_path.resolve()),
+        replace_existing=replace_existing,
+    )
+
+
+def claim_next_job(worker: str) -> IngestionJob | None:
+    # 以条件 UPDATE 抢占任务：多个 worker 进程并发轮询时同一任务只会被一个进程领取。
+    while True:
+        job_id = (
+            IngestionJob.objects.filter(status=IngestionJob.STATUS_QUEUED)
+            .order_by("id")
+            .values_list("id", flat=True)
+            .first()
+        )
+        if job_id is None:
+            return None
+        now = timezone.now()
+        claimed = IngestionJob.objects.filter(id=job_id, status=IngestionJob.STATUS_QUEUED).update(
+            status=IngestionJob.STATUS_RUNNING,
+            worker=worker[:100],
+            started_at=now,
+            heartbeat_at=now,
+            attempts=F("attempts") + 1,
+        )
+        if claimed:
+            return IngestionJob.objects.get(id=job_id)
+
+
+def requeue_stale_jobs(timeout_seconds: int | None = None) -> int:
+    # worker 异常退出后遗留的 running 任务：心跳超时后重新排队（重新执行前会清理上次写入的半成品）。
+    if timeout_seconds is None:
+        timeout_seconds = int(getattr(settings, "KB_INGEST_STALE_SECONDS", 600))
+    cutoff = timezone.now() - timedelta(seconds=max(1, int(timeout_seconds)))
+    return IngestionJob.objects.filter(status=IngestionJob.STATUS_RUNNING, heartbeat_at__lt=cutoff).update(
+        status=IngestionJob.STATUS_QUEUED, stage="queued", worker=""
+    )
+
+
+def _update(job: IngestionJob, **fields) -> None:
+    fields["heartbeat_at"] = timezone.now()
+    IngestionJob.objects.filter(id=job.id).update(**fields)
+    for k, v in fields.items():
+        setattr(job, k, v)
+
+
+def _discard_document(doc_id: int, index_path: Path, config: dict) -> None:
+    kb_id = Document.objects.filter(id=doc_id).values_list("kb_id", flat=True).first()
+    chunk_ids = list(DocumentChunk.objects.filter(document_id=doc_id).values_list("id", flat=True))
+    Document.objects.filter(id=doc_id).delete()
+    if chunk_ids:
+        remove_vectors_from_index(index_path, chunk_ids, config=config)
+    if kb_id is not None:
+        bump_content_version(kb_id)
+
+
+def _replace_previous(job: IngestionJob, doc: Document, index_path: Path, config: dict) -> None:
+    # 覆盖上传：新文档入库成功后再删除同名旧文档，失败时旧文档保持可检索。
+    existing = Document.objects.filter(kb_id=job.kb_id, filename=job.filename).exclude(id=doc.id)
+    removed_files = [fp for fp in existing.values_list("file_path", flat=True) if fp and fp != doc.file_path]
+    removed_chunk_ids = list(DocumentChunk.objects.filter(document__in=existing).values_list("id", flat=True))
+    existing.delete()
+    for fp in removed_files:
+        safe_remove_file(fp)
+    if removed_chunk_ids:
+        remove_vectors_from_index(index_path, removed_chunk_ids, config=config)
+
+
+def _write_chunks(doc: Document, start: int, texts: list[str]) -> list[int]:
+    DocumentChunk.objects.bulk_create(
+        [DocumentChunk(document=doc, chunk_index=start + i, text=t) for i, t in enumerate(texts)]
+    )
+    return list(
+        DocumentChunk.objects.filter(document=doc, chunk_index__gte=start, chunk_index__lt=start + len(texts))
+        .order_by("chunk_index")
+        .values_list("id", flat=True)
+    )
+
+
+def process_job(job: IngestionJob) -> Document:
+    """
+    以流水线执行入库：extract（抽取线程，PDF 逐页）→ chunk（当前线程，分块并分批写库）→
+    embed（向量化线程）→ index（写索引线程，攒够 KB_INGEST_INDEX_FLUSH 条写一次）。
+
+    阶段之间为有界队列，第 N 页的 chunk 在向量化时第 N+1 页已在解析。数据库只在当前线程访问；
+    各阶段吞吐统计写入 job.stage_stats。
+    """
+    kb = job.kb
+    index_path = Path(kb.faiss_path)
+    config = kb.index_config
+    if job.document_id:
+        # 上次执行中断留下的文档：先清理，保证重跑幂等。
+        _discard_document(job.document_id, index_path, config)
+        _update(job, document=None, chunk_count=0, chunks_embedded=0)
+
+    _update(job, stage="extract", stage_stats=[])
+    chunk_batch = max(1, int(getattr(settings, "KB_INGEST_EMBED_BATCH", 256)))
+    flush_size = max(1, int(getattr(settings, "KB_INGEST_INDEX_FLUSH", 1024)))
+    pipe = Pipeline(maxsize=int(getattr(settings, "KB_INGEST_QUEUE_SIZE", 4)))
+    pieces_q, embed_q, index_q = pipe.queue(), pipe.queue(), pipe.queue()
+
+    upload_path = Path(job.file_path)
+    pipe.source("extract", lambda: iter_upload_text(upload_path), pieces_q, units=len)
+
+    def embed(batch: tuple[list[int], list[str]]):
+        ids, texts = batch
+        return ids, texts, embed_chunk_texts(texts)
+
+    pipe.stage("embed", embed, embed_q, index_q, units=lambda b: len(b[0]))
+
+    pending: list[tuple[list[int], list[str], np.ndarray]] = []
+
+    def flush():
+        if not pending:
+            return None
+        ids = [cid for batch_ids, _, _ in pending for cid in batch_ids]
+        texts = [t for _, batch_texts, _ in pending for t in batch_texts]
+        vectors = np.concatenate([v for _, _, v in pending], axis=0)
+        pending.clear()
+        written = add_embedded_vectors_to_index(index_path, vectors, chunk_ids=ids, config=config, texts=texts)
+        if written != len(ids):
+            raise IngestionError(500, "向量写入失败")
+        return None
+
+    def index(batch: tuple[list[int], list[str], np.ndarray]):
+        pending.append(batch)
+        if sum(len(ids) for ids, _, _ in pending) >= flush_size:
+            flush()
+        return None
+
+    pipe.stage("index", index, index_q, units=lambda b: len(b[0]), flush=flush)
+
+    chunk_stats = pipe.stage_stats("chunk")
+    doc: Document | None = None
+    total = 0
+    t0 = time.perf_counter()
+    try:
+        texts: list[str] = []
+        # 分块：后续 RAG 检索/重建索引都以 chunk 为最小单元；每攒够一批先写库取得 chunk id，再交给向量化。
+        for text in iter_chunk_text(pipe.iter_queue(pieces_q, chunk_stats)):
+            texts.append(text)
+            if len(texts) < chunk_batch:
+                continue
+            doc, total = _flush_chunks(job, doc, total, texts, pipe, embed_q, chunk_stats)
+            texts = []
+        if texts:
+            doc, total = _flush_chunks(job, doc, total, texts, pipe, embed_q, chunk_stats)
+        if doc is None:
+            raise IngestionError(400, "文件无可用文本内容")
+        pipe.close(embed_q, chunk_stats)
+        chunk_stats.busy_seconds = max(
+            0.0, time.perf_counter() - t0 - chunk_stats.wait_in_seconds - chunk_stats.wait_out_seconds
+        )
+        Document.objects.filter(id=doc.id).update(chunk_count=total)
+        doc.chunk_count = total
+
+        _update(job, stage="embed", chunk_count=total)
+        while not pipe.wait(timeout=0.5):
+            _update(
+                job,
+                stage="index" if pipe.finished("embed") else "embed",
+                chunks_embedded=pipe.stats["embed"].units,
+            )
+    except Exception as e:
+        pipe.abort()
+        if doc is not None:
+            # 向量未完整写入：撤销本次新建的文档（连同已写入索引的部分），保持数据库与索引一致。
+            _discard_document(doc.id, index_path, config)
+            _update(job, document=None)
+        _update(job, stage_stats=pipe.report())
+        if isinstance(e, PipelineError):
+            if e.stage == "extract" and isinstance(e.error, ValueError):
+                raise IngestionError(400, str(e.error))
+            if e.stage == "extract" and isinstance(e.error, RuntimeError):
+                raise IngestionError(500, str(e.error))
+            raise e.error
+        raise
+
+    report = pipe.report()
+    logger.info("ingestion job %s stage stats: %s", job.id, report)
+    _update(job, stage="index", chunks_embedded=total, stage_stats=report)
+
+    if job.replace_existing:
+        _replace_previous(job, doc, index_path, config)
+    bump_content_version(kb.id)
+    return doc
+
+
+def _flush_chunks(job, doc, total, texts, pipe, embed_q, chunk_stats):
+    if doc is None:
+        doc = Document.objects.create(kb=job.kb, filename=job.filename, file_path=job.file_path, chunk_count=0)
+        # 文档从此出现在文档列表中，版本随之变化（条件 GET 不会返回过期列表）。
+        bump_content_version(job.kb_id)
+        _update(job, document=doc, stage="chunk")
+    ids = _write_chunks(doc, total, texts)
+    total += len(texts)
+    chunk_stats.items += 1
+    chunk_stats.units += len(texts)
+    pipe.put(embed_q, (ids, texts), chunk_stats)
+    _update(job, chunk_count=total, chunks_embedded=pipe.stats["embed"].units)
+    return doc, total
+
+
+def run_ingestion_job(job_id: int) -> IngestionJob | None:
+    job = IngestionJob.objects.select_related("kb").filter(id=job_id).first()
+    if job is None:
+        # 任务所属知识库已被删除（级联删除了任务）。
+        return None
+    if job.status != IngestionJob.STATUS_RUNNING:
+        now = timezone.now()
+        _update(job, status=IngestionJob.STATUS_RUNNING, started_at=now, attempts=job.attempts + 1)
+
+    try:
+        process_job(job)
+    except Exception as e:
+        if isinstance(e, IngestionError):
+            status_code, detail = e.status_code, e.detail
+        elif not KnowledgeBase.objects.filter(id=job.kb_id).exists():
+            return None
+        else:
+            logger.exception("ingestion job %s failed", job.id)
+            status_code, detail = 500, f"入库失败：{e}"
+        if not Document.objects.filter(file_path=job.file_path).exists():
+            safe_remove_file(job.file_path)
+        _update(
+            job,
+            status=IngestionJob.STATUS_FAILED,
+            error=detail,
+            error_status=status_code,
+            finished_at=timezone.now(),
+        )
+        return job
+
+    _update(job, status=IngestionJob.STATUS_SUCCEEDED, stage="done", finished_at=timezone.now())
+    return job
@@ -0,0 +1,660 @@
+from __future__ import annotations
+
+"""
+知识库级 BM25 倒排索引（与向量检索融合，弥补产品编号、报错原文等精确词的召回）。
+
+分词：连续的中日韩字符按字二元组（bigram，单字成段时保留单字），其余按单词（字母数字，
+允许中间带 . _ - ，如 ERR-1042、v2.3.1）并转小写。
+
+存储：<index>.lexical/ 目录下的二进制倒排分段，按 6 位序号命名（000001.bm25 …），写入后不再修改，检索侧直接 mmap。
+每个分段在 56 字节文件头之后依次为 chunk id（升序）、词项哈希（升序）、各词项的倒排区间与词文本偏移、各文档词数、
+倒排项的文档序号与词频、词文本。查询词按哈希二分定位倒排区间，只读取命中的倒排项，不把索引载入内存。
+
+- 追加：新文档写成一个新分段；序号更大的分段覆盖旧分段中相同的 chunk
+- 删除：向 deleted 文件追加 (chunk_id, 当前最大序号)，使该 chunk 在不晚于该序号的分段中失效
+- 合并：末尾分段的文档数不小于前一个分段时合并（二进制计数器式，每条倒排项只被重写 O(log N) 次）；
+  失效文档超过 COMPACT_RATIO 时整体合并为一个完整（full）分段并清空删除标记。合并结果以新序号写入后再删除旧分段，
+  中断时新旧分段同时存在也不影响结果（新分段覆盖旧分段）
+
+写入在调用方持有的索引写锁内进行（见 vectorstore._write_lock）。读取端按各文件的 inode / mtime / 大小缓存打开的分段，
+缓存未命中时只需打开分段文件、读取删除标记并按 chunk id 计算失效掩码，不回放任何日志，代价与文本量无关。
+
+旧版 <index>.bm25（JSON 日志）检索时不读取，视为尚无词法索引（退化为纯向量检索）：写路径在写入前一次性转换
+（upgrade_lexical_index），后台一致性检查按数据库内容补建。
+"""
+
+import hashlib
+import json
+import math
+import os
+import re
+import shutil
+import struct
+import threading
+from array import array
+from pathlib import Path
+from typing import Iterable
+
+import numpy as np
+from django.conf import settings
+
+from .lru import ByteBudgetLRU
+
+K1 = 1.2
+B = 0.75
+COMPACT_RATIO = 0.25
+
+# magic、标志位、世代号、文档数、词项数、倒排项数、词文本字节数、总词数
+_HEADER = struct.Struct("<8sIIqqqqq")
+HEADER_BYTES = _HEADER.size
+_MAGIC = b"KBBM25\x00\x01"
+# 完整分段：包含此前全部存活文档，更早的分段与删除标记随之作废。
+_FULL = 1
+_SUFFIX = ".bm25"
+_DEL_HEADER = struct.Struct("<8sII")
+_DEL_MAGIC = b"KBBMDEL\x01"
+
+_SHORT_TERM = 16
+_FNV_OFFSET = np.uint64(0xCBF29CE484222325)
+_FNV_PRIME = np.uint64(0x100000001B3)
+
+_CJK = r"\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff"
+_TOKEN_RE = re.compile(rf"[{_CJK}]+|[0-9a-z]+(?:[._\-][0-9a-z]+)*")
+_CJK_RE = re.compile(rf"[{_CJK}]")
+
+_CACHE: ByteBudgetLRU | None = None
+_CACHE_GUARD = threading.Lock()
+
+
+def tokenize(text: str) -> list[str]:
+    tokens: list[str] = []
+    for m in _TOKEN_RE.finditer((text or "").lower()):
+        run = m.group(0)
+        if not _CJK_RE.match(run):
+            tokens.append(run)
+        elif len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i : i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+def lexical_dir(index_path: Path) -> Path:
+    return index_path.with_name(f"{index_path.name}.lexical")
+
+
+def _legacy_path(index_path: Path) -> Path:
+    return index_path.with_name(f"{index_path.name}.bm25")
+
+
+def _deleted_path(index_path: Path) -> Path:
+    return lexical_dir(index_path) / "deleted"
+
+
+def _list_parts(index_path: Path) -> list[tuple[int, Path]]:
+    d = lexical_dir(index_path)
+    try:
+        names = [n for n in os.listdir(d) if n.endswith(_SUFFIX) and n[: -len(_SUFFIX)].isdigit()]
+    except FileNotFoundError:
+        return []
+    return sorted((int(n[: -len(_SUFFIX)]), d / n) for n in names)
+
+
+def has_lexical_index(index_path: Path) -> bool:
+    return bool(_list_parts(index_path))
+
+
+def lexical_needs_upgrade(index_path: Path) -> bool:
+    return _legacy_path(index_path).exists()
+
+
+def _term_hashes(terms: list[bytes]) -> np.ndarray:
+    # 跨进程稳定的 64 位哈希（内置 hash() 每个进程随机加盐）：不超过 16 字节的词项按字节列向量化计算 FNV-1a，
+    # 更长的（少见）逐个用 blake2b。
+    out = np.empty(len(terms), dtype=np.uint64)
+    lens = np.fromiter(map(len, terms), dtype=np.int64, count=len(terms))
+    short = np.flatnonzero(lens <= _SHORT_TERM)
+    if short.size:
+        cols = np.array([terms[i] for i in short.tolist()], dtype=f"S{_SHORT_TERM}").view(np.uint8)
+        cols = cols.reshape(short.size, _SHORT_TERM)
+        h = np.full(short.size, _FNV_OFFSET, dtype=np.uint64)
+        short_lens = lens[short]
+        for j in range(int(short_lens.max())):
+            live = short_lens > j
+            h[live] = (h[live] ^ cols[live, j]) * _FNV_PRIME
+        out[short] = h
+    for i in np.flatnonzero(lens > _SHORT_TERM).tolist():
+        out[i] = int.from_bytes(hashlib.blake2b(terms[i], digest_size=8).digest(), "little")
+    return out
+
+
+def _stamp(st: os.stat_result) -> tuple[int, int, int]:
+    return int(st.st_ino), int(st.st_mtime_ns), int(st.st_size)
+
+
+class _Part:
+    # 一个只读分段：整个文件 mmap，各段为数组视图。
+    def __init__(self, seq: int, data: np.ndarray, header: tuple):
+        _, flags, _, n_docs, n_terms, n_postings, blob_bytes, total_len = header
+        self.seq = seq
+        self.full = bool(flags & _FULL)
+        self.n_docs = int(n_docs)
+        self.total_len = int(total_len)
+        pos = HEADER_BYTES
+
+        def take(dtype, count: int) -> np.ndarray:
+            nonlocal pos
+            nbytes = int(count) * np.dtype(dtype).itemsize
+            arr = data[pos : pos + nbytes].view(dtype)
+            pos += nbytes
+            return arr
+
+        self.doc_ids = take(np.int64, n_docs)
+        self.term_hash = take(np.uint64, n_terms)
+        self.term_off = take(np.int64, n_terms + 1)
+        self.blob_off = take(np.int64, n_terms + 1)
+        self.doc_len = take(np.int32, n_docs)
+        self.post_doc = take(np.int32, n_postings)
+        self.post_tf = take(np.int32, n_postings)
+        self.blob = data[pos : pos + int(blob_bytes)]
+
+    @classmethod
+    def open(cls, seq: int, path: Path) -> "_Part | None":
+        # 文件不存在（并发合并已删除）或不完整时返回 None。
+        try:
+            with path.open("rb") as f:
+                raw = f.read(HEADER_BYTES)
+                if len(raw) != HEADER_BYTES or raw[: len(_MAGIC)] != _MAGIC:
+                    return None
+                header = _HEADER.unpack(raw)
+                _, _, _, n_docs, n_terms, n_postings, blob_bytes, _ = header
+                size = os.fstat(f.fileno()).st_size
+                if size < HEADER_BYTES + 12 * n_docs + 24 * n_terms + 16 + 8 * n_postings + blob_bytes:
+                    return None
+                data = np.memmap(f, dtype=np.uint8, mode="r", shape=(size,))
+        except FileNotFoundError:
+            return None
+        return cls(seq, data, header)
+
+    def term_range(self, raw: bytes, h: np.uint64) -> tuple[int, int]:
+        # 哈希相同的词项相邻存放，逐个比对词文本排除碰撞。
+        lo = int(np.searchsorted(self.term_hash, h, side="left"))
+        hi = int(np.searchsorted(self.term_hash, h, side="right"))
+        for i in range(lo, hi):
+            if bytes(self.blob[int(self.blob_off[i]) : int(self.blob_off[i + 1])]) == raw:
+                return int(self.term_off[i]), int(self.term_off[i + 1])
+        return 0, 0
+
+    def terms(self) -> list[bytes]:
+        blob = bytes(self.blob)
+        off = self.blob_off.tolist()
+        return [blob[off[i] : off[i + 1]] for i in range(len(off) - 1)]
+
+
+class _Arrays:
+    # 一个分段的内容：词项（UTF-8）与哈希、文档表，以及按 (词项序号, chunk id, 词频) 展开的倒排项。
+    def __init__(self, terms, hashes, doc_ids, doc_lens, post_term, post_cid, post_tf):
+        self.terms = terms
+        self.hashes = hashes
+        self.doc_ids = doc_ids
+        self.doc_lens = doc_lens
+        self.post_term = post_term
+        self.post_cid = post_cid
+        self.post_tf = post_tf
+
+
+def _postings(index: dict, doc_ids, doc_lens, entries, term_ids, counts=None) -> _Arrays:
+    # 把逐文档展开的词项序号（counts 为各条目的次数，省略时每条计 1）聚合为倒排项；entries 为每个文档展开的条目数。
+    terms = [t.encode("utf-8") for t in index]
+    doc_ids = np.asarray(doc_ids, dtype=np.int64)
+    v = max(len(terms), 1)
+    doc = np.repeat(np.arange(doc_ids.shape[0], dtype=np.int64), np.asarray(entries, dtype=np.int64))
+    uniq, inverse = np.unique(doc * v + np.asarray(term_ids, dtype=np.int64), return_inverse=True)
+    tf = np.bincount(inverse.reshape(-1), weights=counts, minlength=uniq.shape[0])
+    return _Arrays(
+        terms,
+        _term_hashes(terms),
+        doc_ids,
+        np.asarray(doc_lens, dtype=np.int32),
+        uniq % v,
+        doc_ids[uniq // v],
+        tf.astype(np.int32),
+    )
+
+
+def _docs_arrays(chunk_ids: Iterable[int], texts: Iterable[str]) -> _Arrays:
+    # 同一 chunk 出现多次时以最后一次为准。
+    latest = {int(cid): text for cid, text in zip(chunk_ids, texts)}
+    index: dict[str, int] = {}
+    lens = array("q")
+    term_ids = array("q")
+    for text in latest.values():
+        tokens = tokenize(text)
+        lens.append(len(tokens))
+        term_ids.extend([index.setdefault(t, len(index)) for t in tokens])
+    return _postings(index, list(latest), lens, lens, term_ids)
+
+
+def _rows_arrays(rows: Iterable) -> _Arrays:
+    # rows 为旧版日志中的 [chunk_id, 词数, {词: 词频}]。
+    latest = {int(cid): (int(length), tf) for cid, length, tf in rows}
+    index: dict[str, int] = {}
+    lens, entries, term_ids, counts = array("q"), array("q"), array("q"), array("d")
+    for length, tf in latest.values():
+        lens.append(length)
+        entries.append(len(tf))
+        term_ids.extend([index.setdefault(t, len(index)) for t in tf])
+        counts.extend(map(float, tf.values()))
+    return _postings(index, list(latest), lens, entries, term_ids, np.frombuffer(counts, dtype=np.float64))
+
+
+def _write_part(index_path: Path, seq: int, data: _Arrays, full: bool) -> None:
+    order = np.argsort(data.doc_ids, kind="stable")
+    doc_ids, doc_lens = data.doc_ids[order], data.doc_lens[order]
+
+    # 词项按哈希排序，只保留仍有倒排项的词项；倒排项按 (词项, 文档序号) 排序。
+    term_order = np.argsort(data.hashes, kind="stable")
+    rank = np.empty(len(data.terms), dtype=np.int64)
+    rank[term_order] = np.arange(len(data.terms), dtype=np.int64)
+    post_term = rank[data.post_term]
+    post_doc = np.searchsorted(doc_ids, data.post_cid).astype(np.int32)
+    o = np.argsort(post_term * max(int(doc_ids.shape[0]), 1) + post_doc, kind="stable")
+    post_term, post_doc, post_tf = post_term[o], post_doc[o], data.post_tf[o]
+    counts = np.bincount(post_term, minlength=len(data.terms))
+    used = counts > 0
+    term_order, counts = term_order[used], counts[used]
+
+    n_terms = int(term_order.shape[0])
+    term_off = np.zeros(n_terms + 1, dtype=np.int64)
+    term_off[1:] = np.cumsum(counts)
+    raw = [data.terms[i] for i in term_order.tolist()]
+    blob = b"".join(raw)
+    blob_off = np.zeros(n_terms + 1, dtype=np.int64)
+    blob_off[1:] = np.cumsum([len(t) for t in raw], dtype=np.int64)
+    header = _HEADER.pack(
+        _MAGIC,
+        _FULL if full else 0,
+        int.from_bytes(os.urandom(4), "little"),
+        int(doc_ids.shape[0]),
+        n_terms,
+        int(post_doc.shape[0]),
+        len(blob),
+        int(doc_lens.sum(dtype=np.int64)),
+    )
+
+    d = lexical_dir(index_path)
+    d.mkdir(parents=True, exist_ok=True)
+    path = d / f"{seq:06d}{_SUFFIX}"
+    tmp = path.with_name(f"{path.name}.tmp")
+    with tmp.open("wb") as f:
+        f.write(header)
+        for arr in (doc_ids, data.hashes[term_order], term_off, blob_off, doc_lens, post_doc, post_tf):
+            f.write(np.ascontiguousarray(arr).tobytes())
+        f.write(blob)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def _read_deleted(index_path: Path) -> np.ndarray:
+    # 返回 (n, 2) 的 (chunk_id, 序号)；忽略中断写入留下的不完整尾部。
+    try:
+        with _deleted_path(index_path).open("rb") as f:
+            raw = f.read(_DEL_HEADER.size)
+            if len(raw) != _DEL_HEADER.size or raw[: len(_DEL_MAGIC)] != _DEL_MAGIC:
+                return np.empty((0, 2), dtype=np.int64)
+            n = (os.fstat(f.fileno()).st_size - _DEL_HEADER.size) // 16
+            return np.fromfile(f, dtype=np.int64, count=n * 2).reshape(-1, 2)
+    except FileNotFoundError:
+        return np.empty((0, 2), dtype=np.int64)
+
+
+def _append_deleted(index_path: Path, ids: np.ndarray, seq: int) -> None:
+    path = _deleted_path(index_path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    rows = np.column_stack([ids, np.full(ids.shape[0], seq, dtype=np.int64)]).astype(np.int64)
+    with path.open("ab") as f:
+        size = f.tell()
+        if size < _DEL_HEADER.size:
+            f.truncate(0)
+            f.write(_DEL_HEADER.pack(_DEL_MAGIC, 0, 0))
+        else:
+            f.truncate(size - (size - _DEL_HEADER.size) % 16)
+        f.write(rows.tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+
+
+class LexicalIndex:
+    """
+    一组只读分段（序号升序）与每个分段的存活掩码。
+
+    构造后不再修改，可在多个线程中并发检索；文件变化时由 load_lexical_index 整体替换。
+    """
+
+    def __init__(self, parts: list[_Part], deleted: np.ndarray):
+        self.parts = parts
+        # 每个分段的存活掩码，全部存活时为 None。
+        self.alive: list[np.ndarray | None] = [None] * len(parts)
+        self.doc_count = 0
+        self.total_len = 0
+        self.rows = 0
+        newer: list[np.ndarray] = []
+        for i in range(len(parts) - 1, -1, -1):
+            part = parts[i]
+            ids = np.asarray(part.doc_ids)
+            dead = None
+            if part.n_docs:
+                gone = deleted[deleted[:, 1] >= part.seq, 0]
+                if gone.size:
+                    dead = np.isin(ids, gone)
+                for later in newer:
+                    # chunk id 自增，新分段的 id 区间通常与旧分段不重叠，无需逐个比对。
+                    if later.size and later[0] <= ids[-1] and later[-1] >= ids[0]:
+                        hit = np.isin(ids, later, assume_unique=True)
+                        dead = hit if dead is None else dead | hit
+            newer.append(ids)
+            self.rows += part.n_docs
+            if dead is not None and bool(dead.any()):
+                self.alive[i] = ~dead
+                self.doc_count += part.n_docs - int(dead.sum())
+                self.total_len += part.total_len - int(np.asarray(part.doc_len)[dead].sum(dtype=np.int64))
+            else:
+                self.doc_count += part.n_docs
+                self.total_len += part.total_len
+
+    @property
+    def dead(self) -> int:
+        return self.rows - self.doc_count
+
+    @property
+    def last_seq(self) -> int:
+        return self.parts[-1].seq if self.parts else 0
+
+    def alive_docs(self, i: int) -> int:
+        mask = self.alive[i]
+        return self.parts[i].n_docs if mask is None else int(mask.sum())
+
+    def search(self, query: str, top_k: int) -> list[tuple[int, float]]:
+        n = self.doc_count
+        if n == 0 or top_k <= 0:
+            return []
+        avg = self.total_len / n
+        # 每个 chunk 只在一个分段中存活，各分段分别累加得分后再合并。
+        per_part: list[tuple[list[np.ndarray], list[np.ndarray]]] = [([], []) for _ in self.parts]
+        terms = [t.encode("utf-8") for t in set(tokenize(query))]
+        for raw, h in zip(terms, _term_hashes(terms)):
+            hits = []
+            for i, part in enumerate(self.parts):
+                lo, hi = part.term_range(raw, h)
+                if hi <= lo:
+                    continue
+                docs = np.asarray(part.post_doc[lo:hi])
+                tfs = np.asarray(part.post_tf[lo:hi], dtype=np.float64)
+                mask = self.alive[i]
+                if mask is not None:
+                    keep = mask[docs]
+                    docs, tfs = docs[keep], tfs[keep]
+                if docs.size:
+                    hits.append((i, docs, tfs))
+            df = sum(int(docs.size) for _, docs, _ in hits)
+            if df == 0:
+                continue
+            idf = math.log(1.0 + (n - df + 0.5) / (df + 0.5))
+            for i, docs, tfs in hits:
+                norm = K1 * (1.0 - B + B * self.parts[i].doc_len[docs] / avg)
+                per_part[i][0].append(docs)
+                per_part[i][1].append(idf * tfs * (K1 + 1.0) / (tfs + norm))
+
+        cids: list[np.ndarray] = []
+        totals: list[np.ndarray] = []
+        for part, (docs, scores) in zip(self.parts, per_part):
+            if not docs:
+                continue
+            uniq, inverse = np.unique(np.concatenate(docs), return_inverse=True)
+            totals.append(np.bincount(inverse.reshape(-1), weights=np.concatenate(scores)))
+            cids.append(np.asarray(part.doc_ids)[uniq])
+        if not cids:
+            return []
+        all_cids, all_totals = np.concatenate(cids), np.concatenate(totals)
+        order = np.lexsort((all_cids, -all_totals))[:top_k]
+        return list(zip(all_cids[order].tolist(), all_totals[order].tolist()))
+
+    def merged(self, start: int) -> _Arrays:
+        # 把 parts[start:] 的存活文档合并为一个分段的内容（只做数组运算，词项哈希沿用各分段已存的值）。
+        term_index: dict[bytes, int] = {}
+        hashes: list[np.ndarray] = []
+        doc_ids, doc_lens, post_term, post_cid, post_tf = [], [], [], [], []
+        for i in range(start, len(self.parts)):
+            part = self.parts[i]
+            mask = self.alive[i]
+            local = part.terms()
+            before = len(term_index)
+            mapping = np.fromiter(
+                (term_index.setdefault(t, len(term_index)) for t in local), dtype=np.int64, count=len(local)
+            )
+            hashes.append(np.asarray(part.term_hash)[mapping >= before])
+
+            pdoc = np.asarray(part.post_doc)
+            pterm = np.repeat(mapping, np.diff(np.asarray(part.term_off)))
+            ptf = np.asarray(part.post_tf)
+            ids = np.asarray(part.doc_ids)
+            lens = np.asarray(part.doc_len)
+            if mask is not None:
+                keep = mask[pdoc]
+                pdoc, pterm, ptf = pdoc[keep], pterm[keep], ptf[keep]
+                ids, lens = ids[mask], lens[mask]
+            post_term.append(pterm)
+            post_cid.append(np.asarray(part.doc_ids)[pdoc])
+            post_tf.append(ptf)
+            doc_ids.append(ids)
+            doc_lens.append(lens)
+
+        def cat(chunks: list[np.ndarray], dtype) -> np.ndarray:
+            return np.concatenate(chunks).astype(dtype, copy=False) if chunks else np.empty(0, dtype=dtype)
+
+        return _Arrays(
+            list(term_index),
+            cat(hashes, np.uint64),
+            cat(doc_ids, np.int64),
+            cat(doc_lens, np.int32),
+            cat(post_term, np.int64),
+            cat(post_cid, np.int64),
+            cat(post_tf, np.int32),
+        )
+
+    def footprint(self) -> int:
+        # 分段为 mmap，由操作系统页缓存管理；只计存活掩码与对象本身。
+        return sum(m.nbytes for m in self.alive if m is not None) + 1024 * (len(self.parts) + 1)
+
+
+def _cache() -> ByteBudgetLRU:
+    global _CACHE
+    with _CACHE_GUARD:
+        if _CACHE is None:
+            _CACHE = ByteBudgetLRU(int(getattr(settings, "KB_LEXICAL_CACHE_MB", 256)) * 1024 * 1024)
+        return _CACHE
+
+
+def _active_parts(index_path: Path) -> list[tuple[int, Path]]:
+    # 最新的完整分段之前的分段已被它取代（合并 / 重建中断时可能残留）。
+    parts = _list_parts(index_path)
+    for k in range(len(parts) - 1, -1, -1):
+        with open(parts[k][1], "rb") as f:
+            raw = f.read(HEADER_BYTES)
+        if len(raw) == HEADER_BYTES and raw[: len(_MAGIC)] == _MAGIC and _HEADER.unpack(raw)[1] & _FULL:
+            return parts[k:]
+    return parts
+
+
+def _files_stamp(index_path: Path) -> tuple | None:
+    stamp = []
+    for seq, path in _list_parts(index_path):
+        try:
+            stamp.append((seq, _stamp(os.stat(path))))
+        except FileNotFoundError:
+            continue
+    if not stamp:
+        return None
+    try:
+        stamp.append((-1, _stamp(os.stat(_deleted_path(index_path)))))
+    except FileNotFoundError:
+        pass
+    return tuple(stamp)
+
+
+def _open(index_path: Path) -> LexicalIndex | None:
+    # 与合并并发时分段可能刚被删除：重新列目录再试。
+    for _ in range(3):
+        try:
+            listed = _active_parts(index_path)
+        except FileNotFoundError:
+            continue
+        parts = [_Part.open(seq, path) for seq, path in listed]
+        if all(p is not None for p in parts):
+            return LexicalIndex(parts, _read_deleted(index_path)) if parts else None
+    return None
+
+
+def load_lexical_index(index_path: Path) -> LexicalIndex | None:
+    key = str(lexical_dir(index_path).resolve())
+    cache = _cache()
+    stamp = _files_stamp(index_path)
+    if stamp is None:
+        cache.pop(key)
+        return None
+    lex = cache.get(key, stamp)
+    if lex is not None:
+        return lex
+    lex = _open(index_path)
+    if lex is not None:
+        cache.put(key, lex, lex.footprint(), stamp)
+    return lex
+
+
+def lexical_search(index_path: Path, query: str, top_k: int) -> list[tuple[int, float]]:
+    # 返回按 BM25 得分降序的 (chunk_id, score)；尚未建立（或尚未转换为新格式）词法索引时返回空列表。
+    lex = load_lexical_index(index_path)
+    if lex is None:
+        return []
+    return lex.search(query, int(top_k))
+
+
+def _replace_parts(index_path: Path, lex: LexicalIndex | None, start: int, data: _Arrays) -> None:
+    # 合并结果以新序号写入后再删除被合并的分段；从第一个分段开始合并时写成完整分段并清空删除标记。
+    full = lex is None or start == 0
+    seq = (lex.last_seq if lex is not None else 0) + 1
+    _write_part(index_path, seq, data, full=full)
+    for s, path in _list_parts(index_path):
+        if s < seq and (full or s >= lex.parts[start].seq):
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+    if full:
+        try:
+            _deleted_path(index_path).unlink()
+        except FileNotFoundError:
+            pass
+
+
+def _maintain(index_path: Path) -> None:
+    lex = load_lexical_index(index_path)
+    if lex is None or len(lex.parts) < 2 and not lex.dead:
+        return
+    if lex.dead > lex.rows * COMPACT_RATIO:
+        _replace_parts(index_path, lex, 0, lex.merged(0))
+        return
+    # 末尾连续若干分段的文档数之和不小于前一个分段时一起合并，分段大小按 2 的幂次增长。
+    start = len(lex.parts) - 1
+    total = lex.alive_docs(start)
+    while start > 0 and lex.alive_docs(start - 1) <= total:
+        start -= 1
+        total += lex.alive_docs(start)
+    if start < len(lex.parts) - 1:
+        _replace_parts(index_path, lex, start, lex.merged(start))
+
+
+def upgrade_lexical_index(index_path: Path) -> bool:
+    """
+    把旧版 JSON 日志格式的 <index>.bm25 回放一次并写成完整分段；没有旧版文件时返回 False。
+
+    代价与知识库规模成正比，只在写路径（持有写锁）中调用，检索请求不会触发。
+    """
+    legacy = _legacy_path(index_path)
+    if not legacy.exists():
+        return False
+    latest: dict[int, tuple[int, dict]] = {}
+    with legacy.open("rb") as f:
+        for line in f:
+            if not line.endswith(b"\n") or not line.strip():
+                continue
+            record = json.loads(line)
+            for cid, length, tf in record.get("add", ()):
+                latest[int(cid)] = (int(length), tf)
+            for cid in record.get("del", ()):
+                latest.pop(int(cid), None)
+    _replace_parts(index_path, load_lexical_index(index_path), 0, _rows_arrays(
+        [cid, length, tf] for cid, (length, tf) in latest.items()
+    ))
+    legacy.unlink()
+    return True
+
+
+def add_lexical_documents(index_path: Path, chunk_ids: Iterable[int], texts: Iterable[str]) -> None:
+    data = _docs_arrays(chunk_ids, texts)
+    if not data.doc_ids.size:
+        return
+    upgrade_lexical_index(index_path)
+    parts = _list_parts(index_path)
+    _write_part(index_path, (parts[-1][0] if parts else 0) + 1, data, full=not parts)
+    _maintain(index_path)
+
+
+def remove_lexical_documents(index_path: Path, chunk_ids: Iterable[int]) -> None:
+    ids = np.asarray([int(x) for x in chunk_ids], dtype=np.int64)
+    if ids.size == 0 or not (has_lexical_index(index_path) or lexical_needs_upgrade(index_path)):
+        return
+    upgrade_lexical_index(index_path)
+    lex = load_lexical_index(index_path)
+    if lex is None:
+        return
+    _append_deleted(index_path, ids, lex.last_seq)
+    _maintain(index_path)
+
+
+def rebuild_lexical_index(index_path: Path, chunk_ids: Iterable[int], texts: Iterable[str]) -> int:
+    data = _docs_arrays(chunk_ids, texts)
+    _replace_parts(index_path, load_lexical_index(index_path), 0, data)
+    try:
+        _legacy_path(index_path).unlink()
+    except FileNotFoundError:
+        pass
+    return int(data.doc_ids.shape[0])
+
+
+def remove_lexical_index(index_path: Path) -> None:
+    shutil.rmtree(lexical_dir(index_path), ignore_errors=True)
+    legacy = _legacy_path(index_path)
+    for p in (legacy, legacy.with_name(f"{legacy.name}.tmp")):
+        try:
+            p.unlink()
+        except FileNotFoundError:
+            pass
+    _cache().pop(str(lexical_dir(index_path).resolve()))
+
+
+def reciprocal_rank_scores(rankings: list[list[int]], k: int = 60) -> list[tuple[int, float]]:
+    # RRF：score(d) = Σ 1 / (k + rank)，rank 从 1 开始；只依赖名次，无需对齐向量距离与 BM25 分数的量纲。
+    # 返回按融合分降序的 (id, score)，同分时先出现者在前。
+    scores: dict[int, float] = {}
+    first_seen: dict[int, int] = {}
+    for ranking in rankings:
+        for rank, cid in enumerate(ranking, start=1):
+            scores[cid] = scores.get(cid, 0.0) + 1.0 / (k + rank)
+            first_seen.setdefault(cid, len(first_seen))
+    return [(cid, scores[cid]) for cid in sorted(scores, key=lambda cid: (-scores[cid], first_seen[cid]))]
+
+
+def reciprocal_rank_fusion(rankings: list[list[int]], k: int = 60) -> list[int]:
+    return [cid for cid, _ in reciprocal_rank_scores(rankings, k=k)]
@@ -0,0 +1,98 @@
+from __future__ import annotations
+
+"""
+按字节预算淘汰的进程内 LRU 缓存。
+
+每个条目记录调用方估算的内存占用与版本戳（stamp，通常是文件的 inode/mtime/size），
+版本戳不一致或超过存活时间（ttl_seconds，可逐条覆盖）视为未命中；总占用超过预算时从最久未使用的
+条目开始淘汰。线程安全。
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable
+
+
+class ByteBudgetLRU:
+    def __init__(self, max_bytes: int, ttl_seconds: float | None = None):
+        self.max_bytes = max(0, int(max_bytes))
+        self.ttl_seconds = ttl_seconds if ttl_seconds and ttl_seconds > 0 else None
+        self._lock = threading.Lock()
+        # key -> (stamp, value, nbytes, 过期时刻 monotonic 或 None)
+        self._data: OrderedDict[Hashable, tuple[Any, Any, int, float | None]] = OrderedDict()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expired = 0
+
+    def get(self, key: Hashable, stamp: Any = None) -> Any | None:
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[3] is not None and item[3] <= time.monotonic():
+                self._drop(key)
+                self._expired += 1
+                item = None
+            if item is None or item[0] != stamp:
+                if item is not None:
+                    # 版本已变化：旧对象不再有效，直接释放。
+                    self._drop(key)
+                self._misses += 1
+                return None
+            self._data.move_to_end(key)
+            self._hits += 1
+            return item[1]
+
+    def put(
+        self, key: Hashable, value: Any, nbytes: int, stamp: Any = None, ttl_seconds: float | None = None
+    ) -> None:
+        nbytes = max(0, int(nbytes))
+        ttl = ttl_seconds if ttl_seconds is not None else self.ttl_seconds
+        expires = time.monotonic() + ttl if ttl and ttl > 0 else None
+        with self._lock:
+            if key in self._data:
+                self._drop(key)
+            if nbytes > self.max_bytes:
+                # 单个条目超过整个预算：不缓存，调用方每次自行加载。
+                return
+            self._data[key] = (stamp, value, nbytes, expires)
+            self._bytes += nbytes
+            self._evict_to(self.max_bytes)
+
+    def pop(self, key: Hashable) -> None:
+        with self._lock:
+            self._drop(key)
+
+    def resize(self, max_bytes: int) -> None:
+        with self._lock:
+            self.max_bytes = max(0, int(max_bytes))
+            self._evict_to(self.max_bytes)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._data),
+                "bytes_resident": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+                "expired": self._expired,
+            }
+
+    def _drop(self, key: Hashable) -> None:
+        item = self._data.pop(key, None)
+        if item is not None:
+            self._bytes -= item[2]
+
+    def _evict_to(self, budget: int) -> None:
+        while self._bytes > budget and self._data:
+            _, (_, _, nbytes, _) = self._data.popitem(last=False)
+            self._bytes -= nbytes
+            self._evictions += 1
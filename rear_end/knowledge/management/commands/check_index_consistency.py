@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+
+from knowledge.consistency import run_consistency_check
+
+
+class Command(BaseCommand):
+    help = (
+        "检查知识库索引与数据库是否一致（ntotal、id 映射、DocumentChunk 行与旁路文件），"
+        "离线修复不一致并把无法修复的知识库标记为 degraded"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--kb", type=int, action="append", dest="kb_ids", help="仅检查指定知识库，可重复")
+        parser.add_argument("--dry-run", action="store_true", help="只检查并记录状态，不修复")
+        parser.add_argument("--pending", action="store_true", help="只检查被检索请求标记为待修复的知识库")
+
+    def handle(self, *args, **options):
+        results = run_consistency_check(
+            kb_ids=options.get("kb_ids"), repair=not options["dry_run"], pending_only=options["pending"]
+        )
+        ok = degraded = skipped = 0
+        for r in results:
+            if r.skipped:
+                skipped += 1
+                self.stdout.write(f"kb={r.kb_id} 跳过：{r.skipped}")
+                continue
+            if r.repaired:
+                self.stdout.write(f"kb={r.kb_id} 已修复：{', '.join(r.repaired)}")
+            if r.issues:
+                degraded += 1
+                self.stderr.write(f"kb={r.kb_id} 不一致：{', '.join(r.issues)}")
+            else:
+                ok += 1
+
+        self.stdout.write(self.style.SUCCESS(f"检查完成：ok={ok} degraded={degraded} skipped={skipped}"))
@@ -0,0 +1,52 @@
+from pathlib import Path
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from knowledge.chunk_vectors import load_chunk_vectors
+from knowledge.index_factory import choose_index_spec
+from knowledge.index_report import compare_index_variants, format_report
+from knowledge.models import KnowledgeBase
+
+
+class Command(BaseCommand):
+    help = "对比 float32 / fp16 / sq8 / pq 索引的内存占用与 recall@k（基于已持久化的 chunk 向量或随机向量）"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--kb", type=int, help="使用指定知识库的持久化向量")
+        parser.add_argument("--synthetic", type=int, default=0, help="不指定知识库时生成 N 条随机向量")
+        parser.add_argument("--dim", type=int, default=1024, help="随机向量维度（text-embedding-v4 为 1024）")
+        parser.add_argument("--k", type=int, default=10)
+        parser.add_argument("--queries", type=int, default=200)
+        parser.add_argument("--rerank-factor", type=int, default=4)
+
+    def handle(self, *args, **options):
+        if options.get("kb"):
+            kb = KnowledgeBase.objects.filter(id=options["kb"]).first()
+            if kb is None or not kb.faiss_path:
+                raise CommandError("知识库不存在")
+            stored = load_chunk_vectors(Path(kb.faiss_path))
+            if stored is None or int(stored[0].shape[0]) == 0:
+                raise CommandError("该知识库没有持久化的 chunk 向量，请先运行 migrate_faiss_indexes")
+            ids, vectors = stored
+            config = kb.index_config
+        elif options.get("synthetic"):
+            rng = np.random.default_rng(0)
+            n = int(options["synthetic"])
+            vectors = rng.normal(size=(n, int(options["dim"]))).astype(np.float32)
+            ids = np.arange(1, n + 1, dtype=np.int64)
+            config = {}
+        else:
+            raise CommandError("请指定 --kb 或 --synthetic")
+
+        spec = choose_index_spec(int(ids.shape[0]), {k: v for k, v in config.items() if k != "compression"})
+        reports = compare_index_variants(
+            ids,
+            vectors,
+            k=options["k"],
+            n_queries=options["queries"],
+            base_spec=spec,
+            rerank_factor=options["rerank_factor"],
+        )
+        self.stdout.write(f"vectors={int(ids.shape[0])} dim={int(vectors.shape[1])} index={spec.kind}")
+        self.stdout.write(format_report(reports, options["k"]))
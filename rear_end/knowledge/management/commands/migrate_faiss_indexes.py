@@ -0,0 +1,59 @@
+from pathlib import Path
+
+from django.core.management.base import BaseCommand
+
+from knowledge.models import DocumentChunk, KnowledgeBase
+from knowledge.services import bump_content_version
+from knowledge.vectorstore import (
+    backfill_chunk_texts,
+    backfill_chunk_vectors,
+    backfill_lexical_index,
+    migrate_legacy_index,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "将旧版 IndexFlatL2 + .meta.json 索引迁移为按 chunk id 寻址的 IndexIDMap2，"
+        "并补齐 chunk 向量文件、BM25 词法索引与 chunk 文本文件（不调用 embedding）"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--kb", type=int, action="append", dest="kb_ids", help="仅迁移指定知识库，可重复")
+
+    def handle(self, *args, **options):
+        qs = KnowledgeBase.objects.exclude(faiss_path="").order_by("id")
+        if options.get("kb_ids"):
+            qs = qs.filter(id__in=options["kb_ids"])
+
+        migrated = skipped = failed = 0
+        for kb in qs:
+            # .meta.json 缺失时按旧版入库顺序（document_id, chunk_index）推导 chunk id。
+            fallback_ids = (
+                DocumentChunk.objects.filter(document__kb=kb)
+                .order_by("document_id", "chunk_index")
+                .values_list("id", flat=True)
+            )
+            try:
+                index_path = Path(kb.faiss_path)
+                done = []
+                if migrate_legacy_index(index_path, fallback_ids=fallback_ids):
+                    done.append("已迁移")
+                elif backfill_chunk_vectors(index_path):
+                    done.append("已补齐 chunk 向量")
+                rows = DocumentChunk.objects.filter(document__kb=kb).order_by("id").values_list("id", "text")
+                if backfill_lexical_index(index_path, rows):
+                    done.append("已建立 BM25 索引")
+                if backfill_chunk_texts(index_path, rows):
+                    done.append("已补建 chunk 文本文件")
+                if done:
+                    bump_content_version(kb.id)
+                    migrated += 1
+                    self.stdout.write(f"kb={kb.id} {'，'.join(done)}")
+                else:
+                    skipped += 1
+            except ValueError as e:
+                failed += 1
+                self.stderr.write(f"kb={kb.id} 迁移失败：{e}")
+
+        self.stdout.write(self.style.SUCCESS(f"迁移完成：migrated={migrated} skipped={skipped} failed={failed}"))
@@ -0,0 +1,112 @@
+import os
+import socket
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from knowledge.consistency import run_consistency_check
+from knowledge.ingestion import claim_next_job, requeue_stale_jobs, run_ingestion_job
+
+
+def _run(job_id: int):
+    # 每个线程使用独立的数据库连接，任务结束后关闭，避免连接泄漏。
+    try:
+        return run_ingestion_job(job_id)
+    finally:
+        connection.close()
+
+
+class Command(BaseCommand):
+    help = "执行文档入库任务：轮询数据库中排队的任务，在本地线程池中完成抽取、分块、向量化与写索引（无需外部 broker）"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=0, help="并发任务数，默认 KB_INGEST_WORKERS")
+        parser.add_argument("--poll-interval", type=float, default=2.0, help="队列为空时的轮询间隔（秒）")
+        parser.add_argument("--once", action="store_true", help="处理完当前队列后退出")
+        parser.add_argument(
+            "--consistency-interval",
+            type=float,
+            default=None,
+            help="空闲时执行索引一致性检查的间隔（秒），默认 KB_CONSISTENCY_INTERVAL_SECONDS，0 表示关闭",
+        )
+
+    def handle(self, *args, **options):
+        workers = max(1, int(options["workers"] or getattr(settings, "KB_INGEST_WORKERS", 2)))
+        poll = max(0.1, float(options["poll_interval"]))
+        name = f"{socket.gethostname()}:{os.getpid()}"
+        interval = options["consistency_interval"]
+        if interval is None:
+            interval = float(getattr(settings, "KB_CONSISTENCY_INTERVAL_SECONDS", 3600))
+        self._sweep_interval = max(0.0, float(interval))
+        self._next_sweep = time.monotonic() + self._sweep_interval
+
+        requeued = requeue_stale_jobs()
+        if requeued:
+            self.stdout.write(f"已重新排队 {requeued} 个超时任务")
+        self.stdout.write(f"入库 worker {name} 启动：workers={workers}")
+
+        done = failed = 0
+        if workers == 1:
+            # 单 worker 直接在主线程串行执行，不占用额外的数据库连接。
+            while True:
+                job = claim_next_job(name)
+                if job is None:
+                    if options["once"]:
+                        break
+                    self._check_consistency()
+                    time.sleep(poll)
+                    continue
+                self.stdout.write(f"job={job.id} kb={job.kb_id} {job.filename} 开始入库")
+                ok = self._report(run_ingestion_job(job.id))
+                done, failed = done + int(ok is True), failed + int(ok is False)
+            self.stdout.write(self.style.SUCCESS(f"入库 worker 退出：succeeded={done} failed={failed}"))
+            return
+
+        running: set[Future] = set()
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="kb-ingest") as pool:
+            while True:
+                while len(running) < workers:
+                    job = claim_next_job(name)
+                    if job is None:
+                        break
+                    self.stdout.write(f"job={job.id} kb={job.kb_id} {job.filename} 开始入库")
+                    running.add(pool.submit(_run, job.id))
+
+                if not running:
+                    if options["once"]:
+                        break
+                    self._check_consistency()
+                    time.sleep(poll)
+                    continue
+
+                finished, running = wait(running, timeout=poll, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    ok = self._report(future.result())
+                    done, failed = done + int(ok is True), failed + int(ok is False)
+
+        self.stdout.write(self.style.SUCCESS(f"入库 worker 退出：succeeded={done} failed={failed}"))
+
+    def _check_consistency(self) -> None:
+        # 只在空闲时执行：检索请求标记的待修复知识库每次空闲都检查，全量检查按间隔执行。
+        if self._sweep_interval <= 0:
+            return
+        pending_only = time.monotonic() < self._next_sweep
+        if not pending_only:
+            self._next_sweep = time.monotonic() + self._sweep_interval
+        for r in run_consistency_check(pending_only=pending_only):
+            if r.repaired:
+                self.stdout.write(f"kb={r.kb_id} 索引已修复：{', '.join(r.repaired)}")
+            if r.issues:
+                self.stderr.write(f"kb={r.kb_id} 索引不一致：{', '.join(r.issues)}")
+
+    def _report(self, job) -> bool | None:
+        if job is None:
+            return None
+        if job.status == job.STATUS_SUCCEEDED:
+            self.stdout.write(f"job={job.id} 完成：chunks={job.chunk_count}")
+            return True
+        self.stderr.write(f"job={job.id} 失败：{job.error}")
+        return False
@@ -0,0 +1,17 @@
+# Generated by Django 6.0.2 on 2026-10-18 00:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("knowledge", "0002_document_file_path_documentchunk"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="knowledgebase",
+            name="index_config",
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
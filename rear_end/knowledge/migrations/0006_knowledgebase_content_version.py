@@ -0,0 +1,17 @@
+# Generated by Django 6.0.2 on 2026-10-18 00:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("knowledge", "0005_ingestionjob_stage_stats"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="knowledgebase",
+            name="content_version",
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
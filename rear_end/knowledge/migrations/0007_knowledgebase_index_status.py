@@ -0,0 +1,29 @@
+# Generated by Django 6.0.2 on 2026-10-18 00:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("knowledge", "0006_knowledgebase_content_version"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="knowledgebase",
+            name="index_status",
+            field=models.CharField(
+                choices=[("ok", "正常"), ("degraded", "待修复")], default="ok", max_length=20
+            ),
+        ),
+        migrations.AddField(
+            model_name="knowledgebase",
+            name="index_issue",
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name="knowledgebase",
+            name="index_checked_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
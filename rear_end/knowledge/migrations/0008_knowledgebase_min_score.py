@@ -0,0 +1,17 @@
+# Generated by Django 6.0.2 on 2026-10-18 00:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("knowledge", "0007_knowledgebase_index_status"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="knowledgebase",
+            name="min_score",
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
@@ -3,10 +3,30 @@ from django.db import models
 
 
 class KnowledgeBase(models.Model):
+    # 索引一致性：检查发现索引与数据库不一致（或检索时遇到需要迁移的旧版索引）时标记为 degraded，
+    # 由 check_index_consistency（run_ingest_worker 定时执行）离线修复后恢复为 ok。
+    INDEX_OK = "ok"
+    INDEX_DEGRADED = "degraded"
+    INDEX_STATUS_CHOICES = (
+        (INDEX_OK, "正常"),
+        (INDEX_DEGRADED, "待修复"),
+    )
+
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     name = models.CharField(max_length=100)
     description = models.TextField(blank=True)
     faiss_path = models.CharField(max_length=255)
+    # 索引配置覆盖：index_type（auto/flat/ivf/hnsw）、nprobe、ef_search、compression（none/fp16/sq8/pq）、rerank、rerank_factor
+    index_config = models.JSONField(default=dict, blank=True)
+    # 检索相关度阈值（余弦相似度，-1 ~ 1）：低于阈值的 chunk 不进入上下文；为空时沿用 RAG_MIN_SCORE。
+    min_score = models.FloatField(null=True, blank=True)
+    # 内容版本：每次上传 / 删除文档、重建索引时原子自增（见 services.bump_content_version），
+    # 作为进程内缓存的失效键与列表接口的 ETag。
+    content_version = models.BigIntegerField(default=0)
+    index_status = models.CharField(max_length=20, choices=INDEX_STATUS_CHOICES, default=INDEX_OK)
+    index_issue = models.CharField(max_length=255, blank=True)
+    # 最近一次一致性检查时间；为空的 degraded 知识库由 worker 在下一次空闲轮询时优先检查。
+    index_checked_at = models.DateTimeField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
     def __str__(self) -> str:
@@ -31,3 +51,55 @@ class DocumentChunk(models.Model):
 
     class Meta:
         unique_together = ("document", "chunk_index")
+
+
+class IngestionJob(models.Model):
+    # 文档入库任务：上传接口只落盘并创建任务，由 run_ingest_worker 管理命令异步执行。
+    STATUS_QUEUED = "queued"
+    STATUS_RUNNING = "running"
+    STATUS_SUCCEEDED = "succeeded"
+    STATUS_FAILED = "failed"
+    STATUS_CHOICES = (
+        (STATUS_QUEUED, "排队中"),
+        (STATUS_RUNNING, "执行中"),
+        (STATUS_SUCCEEDED, "已完成"),
+        (STATUS_FAILED, "失败"),
+    )
+
+    # 执行阶段依次为 extract（抽取文本）、chunk（分块入库）、embed（向量化）、index（写入索引）。
+    STAGE_CHOICES = (
+        ("queued", "排队中"),
+        ("extract", "抽取文本"),
+        ("chunk", "分块"),
+        ("embed", "向量化"),
+        ("index", "写入索引"),
+        ("done", "完成"),
+    )
+
+    kb = models.ForeignKey(KnowledgeBase, on_delete=models.CASCADE, related_name="ingestion_jobs")
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    document = models.ForeignKey(Document, on_delete=models.SET_NULL, null=True, blank=True)
+    filename = models.CharField(max_length=255)
+    file_path = models.CharField(max_length=500)
+    replace_existing = models.BooleanField(default=False)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_QUEUED, db_index=True)
+    stage = models.CharField(max_length=16, choices=STAGE_CHOICES, default="queued")
+    chunk_count = models.IntegerField(default=0)
+    chunks_embedded = models.IntegerField(default=0)
+    # 各阶段吞吐统计（条数、chunk 数、忙碌 / 等待时间），用于定位入库瓶颈。
+    stage_stats = models.JSONField(default=list, blank=True)
+    error = models.TextField(blank=True)
+    # 失败时对应的 HTTP 状态码（400 为文件内容问题，500 为服务端错误），同步模式直接作为响应码。
+    error_status = models.IntegerField(default=0)
+    attempts = models.IntegerField(default=0)
+    worker = models.CharField(max_length=100, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ("id",)
+
+    def __str__(self) -> str:
+        return f"{self.filename} ({self.status})"
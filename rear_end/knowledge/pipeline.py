@@ -0,0 +1,215 @@
+from __future__ import annotations
+
+"""
+流水线执行：各阶段运行在独立线程中，阶段之间用有界队列衔接（下游处理不过来时上游阻塞，内存占用有上限）。
+
+任一阶段抛出异常时记录首个错误并通知其它阶段尽快退出，由调用方在 iter_queue / wait 中重新抛出（PipelineError，
+带出错阶段名）。每个阶段统计处理条数、业务单位数（如 chunk 数）、忙碌时间以及等待上游 / 下游的时间，
+用于定位瓶颈：忙碌时间占比最高、且下游等待它的阶段就是瓶颈。
+"""
+
+import queue
+import threading
+import time
+from typing import Any, Callable, Iterable, Iterator
+
+_END = object()
+_POLL_SECONDS = 0.1
+
+
+class PipelineError(Exception):
+    def __init__(self, stage: str, error: BaseException):
+        super().__init__(f"{stage}: {error}")
+        self.stage = stage
+        self.error = error
+
+
+class _Stopped(Exception):
+    pass
+
+
+class StageStats:
+    def __init__(self, name: str):
+        self.name = name
+        self.items = 0
+        self.units = 0
+        self.busy_seconds = 0.0
+        self.wait_in_seconds = 0.0
+        self.wait_out_seconds = 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            "stage": self.name,
+            "items": self.items,
+            "units": self.units,
+            "busy_seconds": round(self.busy_seconds, 3),
+            "wait_in_seconds": round(self.wait_in_seconds, 3),
+            "wait_out_seconds": round(self.wait_out_seconds, 3),
+            "units_per_second": round(self.units / self.busy_seconds, 1) if self.busy_seconds > 0 else None,
+        }
+
+
+class Pipeline:
+    def __init__(self, maxsize: int = 4):
+        self.maxsize = max(1, int(maxsize))
+        self.stats: dict[str, StageStats] = {}
+        self._threads: list[threading.Thread] = []
+        self._stop = threading.Event()
+        self._error: PipelineError | None = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._finished: set[str] = set()
+
+    def queue(self) -> queue.Queue:
+        return queue.Queue(maxsize=self.maxsize)
+
+    def stage_stats(self, name: str) -> StageStats:
+        # 在调用方线程中执行的阶段也通过这里登记统计。
+        if name not in self.stats:
+            self.stats[name] = StageStats(name)
+        return self.stats[name]
+
+    def put(self, q: queue.Queue, item: Any, stats: StageStats | None = None) -> None:
+        t0 = time.perf_counter()
+        while True:
+            self._raise_if_stopped()
+            try:
+                q.put(item, timeout=_POLL_SECONDS)
+                break
+            except queue.Full:
+                continue
+        if stats is not None:
+            stats.wait_out_seconds += time.perf_counter() - t0
+
+    def close(self, q: queue.Queue, stats: StageStats | None = None) -> None:
+        self.put(q, _END, stats)
+
+    def iter_queue(self, q: queue.Queue, stats: StageStats | None = None) -> Iterator[Any]:
+        while True:
+            t0 = time.perf_counter()
+            while True:
+                self._raise_if_stopped()
+                try:
+                    item = q.get(timeout=_POLL_SECONDS)
+                    break
+                except queue.Empty:
+                    continue
+            if stats is not None:
+                stats.wait_in_seconds += time.perf_counter() - t0
+            if item is _END:
+                return
+            yield item
+
+    def source(
+        self,
+        name: str,
+        produce: Callable[[], Iterable[Any]],
+        out: queue.Queue,
+        units: Callable[[Any], int] | None = None,
+    ) -> None:
+        stats = self.stage_stats(name)
+
+        def run():
+            it = iter(produce())
+            while True:
+                t0 = time.perf_counter()
+                try:
+                    item = next(it)
+                except StopIteration:
+                    stats.busy_seconds += time.perf_counter() - t0
+                    break
+                stats.busy_seconds += time.perf_counter() - t0
+                stats.items += 1
+                stats.units += units(item) if units else 1
+                self.put(out, item, stats)
+            self.close(out, stats)
+
+        self._start(name, run)
+
+    def stage(
+        self,
+        name: str,
+        fn: Callable[[Any], Any],
+        inp: queue.Queue,
+        out: queue.Queue | None = None,
+        units: Callable[[Any], int] | None = None,
+        flush: Callable[[], Any] | None = None,
+    ) -> None:
+        # fn 返回 None 表示本条无输出（如攒批阶段）；flush 在输入结束时调用一次，用于写出剩余批次。
+        stats = self.stage_stats(name)
+
+        def run():
+            for item in self.iter_queue(inp, stats):
+                t0 = time.perf_counter()
+                result = fn(item)
+                stats.busy_seconds += time.perf_counter() - t0
+                stats.items += 1
+                stats.units += units(item) if units else 1
+                if out is not None and result is not None:
+                    self.put(out, result, stats)
+            if flush is not None:
+                t0 = time.perf_counter()
+                result = flush()
+                stats.busy_seconds += time.perf_counter() - t0
+                if out is not None and result is not None:
+                    self.put(out, result, stats)
+            if out is not None:
+                self.close(out, stats)
+
+        self._start(name, run)
+
+    def wait(self, timeout: float | None = None) -> bool:
+        # 等待全部阶段线程结束；返回 False 表示超时（调用方可借机上报进度后继续等待）。
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        for t in self._threads:
+            remaining = None if deadline is None else max(0.0, deadline - time.perf_counter())
+            t.join(remaining)
+            if t.is_alive():
+                self._raise_if_failed()
+                return False
+        self._raise_if_failed()
+        return True
+
+    def finished(self, name: str) -> bool:
+        return name in self._finished
+
+    def abort(self) -> None:
+        self._stop.set()
+        for t in self._threads:
+            t.join()
+
+    def fail(self, stage: str, error: BaseException) -> None:
+        with self._lock:
+            if self._error is None:
+                self._error = error if isinstance(error, PipelineError) else PipelineError(stage, error)
+        self._stop.set()
+
+    def report(self) -> list[dict]:
+        return [s.as_dict() for s in self.stats.values()]
+
+    def _start(self, name: str, run: Callable[[], None]) -> None:
+        def target():
+            self._local.in_stage = True
+            try:
+                run()
+                self._finished.add(name)
+            except _Stopped:
+                pass
+            except BaseException as e:  # noqa: BLE001 - 转交给调用方线程重新抛出
+                self.fail(name, e)
+
+        t = threading.Thread(target=target, name=f"kb-pipeline-{name}", daemon=True)
+        self._threads.append(t)
+        t.start()
+
+    def _raise_if_failed(self) -> None:
+        if self._error is not None:
+            raise self._error
+
+    def _raise_if_stopped(self) -> None:
+        if not self._stop.is_set():
+            return
+        # 阶段线程静默退出；调用方线程收到首个错误。
+        if getattr(self._local, "in_stage", False) or self._error is None:
+            raise _Stopped()
+        raise self._error
@@ -0,0 +1,62 @@
+from __future__ import annotations
+
+"""
+增量段（delta segment）文件布局。
+
+每次向已有索引追加向量时，新向量单独写成一个小的 IndexIDMap2(IndexFlatL2) 段文件，
+位于 <index>.segments/ 目录下，按 6 位序号命名（000001.index …），写入后不再修改（删除除外）。
+检索同时查询主索引与全部段并合并 top-k；段数达到 KB_SEGMENT_MAX_COUNT 时后台合并回主索引。
+"""
+
+import os
+from pathlib import Path
+
+from django.conf import settings
+
+_SUFFIX = ".index"
+
+
+def segments_dir(index_path: Path) -> Path:
+    return index_path.with_name(f"{index_path.name}.segments")
+
+
+def list_segments(index_path: Path) -> list[Path]:
+    d = segments_dir(index_path)
+    try:
+        names = [n for n in os.listdir(d) if n.endswith(_SUFFIX) and n[: -len(_SUFFIX)].isdigit()]
+    except FileNotFoundError:
+        return []
+    return [d / n for n in sorted(names)]
+
+
+def next_segment_path(index_path: Path) -> Path:
+    # 调用方需持有该知识库的写锁。序号在现有段之后递增，合并（compact_segments）清空段后从 1 重新开始；
+    # 索引缓存按 inode + mtime + 大小判断文件是否变化，序号复用不会命中旧段。
+    existing = list_segments(index_path)
+    seq = int(existing[-1].name[: -len(_SUFFIX)]) + 1 if existing else 1
+    d = segments_dir(index_path)
+    d.mkdir(parents=True, exist_ok=True)
+    return d / f"{seq:06d}{_SUFFIX}"
+
+
+def remove_segment_files(paths: list[Path]) -> None:
+    for p in paths:
+        try:
+            p.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def remove_segments_dir(index_path: Path) -> None:
+    d = segments_dir(index_path)
+    remove_segment_files(list_segments(index_path))
+    try:
+        for n in os.listdir(d):
+            (d / n).unlink()
+        d.rmdir()
+    except FileNotFoundError:
+        pass
+
+
+def segment_max_count() -> int:
+    return max(1, int(getattr(settings, "KB_SEGMENT_MAX_COUNT", 8)))
@@ -1,13 +1,13 @@
 from rest_framework import serializers
 
-from .models import Document, DocumentChunk, KnowledgeBase
+from .models import Document, DocumentChunk, IngestionJob, KnowledgeBase
 
 
 class KnowledgeBaseSerializer(serializers.ModelSerializer):
     # 统一对外返回字段
     class Meta:
         model = KnowledgeBase
-        fields = ("id", "name", "description", "faiss_path", "created_at")
+        fields = ("id", "name", "description", "faiss_path", "content_version", "min_score", "created_at")
 
 
 class KnowledgeBaseCreateSerializer(serializers.ModelSerializer):
@@ -46,3 +46,28 @@ class DocumentChunkSerializer(serializers.ModelSerializer):
     class Meta:
         model = DocumentChunk
         fields = ("id", "document", "chunk_index", "text")
+
+
+class IngestionJobSerializer(serializers.ModelSerializer):
+    job_id = serializers.IntegerField(source="id", read_only=True)
+    kb_id = serializers.IntegerField(read_only=True)
+    document_id = serializers.IntegerField(read_only=True, allow_null=True)
+
+    class Meta:
+        model = IngestionJob
+        fields = (
+            "job_id",
+            "kb_id",
+            "document_id",
+            "filename",
+            "status",
+            "stage",
+            "chunk_count",
+            "chunks_embedded",
+            "stage_stats",
+            "error",
+            "created_at",
+            "started_at",
+            "finished_at",
+        )
+        read_only_fields = fields
@@ -2,6 +2,9 @@ import os
 from pathlib import Path
 
 from django.conf import settings
+from django.db.models import F
+
+from .models import KnowledgeBase
 
 
 def ensure_dir(path: Path) -> None:
@@ -39,6 +42,18 @@ def build_upload_path(user_id: int, kb_id: int, filename: str) -> Path:
     return root / f"user_{user_id}" / f"kb_{kb_id}" / safe_name
 
 
+def bump_content_version(kb_id: int) -> None:
+    # 以 F() 表达式在数据库内自增，多 worker 并发写同一知识库时不会丢失更新。
+    KnowledgeBase.objects.filter(id=kb_id).update(content_version=F("content_version") + 1)
+
+
+def mark_index_degraded(kb_id: int, issue: str) -> None:
+    # 只写标记、不做修复：请求路径上不执行 O(知识库) 的工作，由后台一致性检查接手。
+    KnowledgeBase.objects.filter(id=kb_id).update(
+        index_status=KnowledgeBase.INDEX_DEGRADED, index_issue=issue[:255], index_checked_at=None
+    )
+
+
 def save_uploaded_file(upload_path: Path, file_obj) -> None:
     # 以流式方式落盘，避免一次性把大文件读入内存。
     ensure_dir(upload_path.parent)
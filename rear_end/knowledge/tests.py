@@ -1,6 +1,10 @@
+import json
 import os
 import tempfile
 from pathlib import Path
+from unittest import mock
+
+import numpy as np
 
 from django.contrib.auth import get_user_model
 from django.test import override_settings
@@ -8,6 +12,7 @@ from django.core.files.uploadedfile import SimpleUploadedFile
 from rest_framework.test import APITestCase
 
 from .models import Document, DocumentChunk, KnowledgeBase
+from . import vectorstore
 from .vectorstore import count_vectors
 
 
@@ -166,6 +171,8 @@ class KnowledgeBaseApiTests(APITestCase):
                 self.assertEqual(del_resp.status_code, 404)
 
 
+# 上传接口在请求内同步入库，便于直接断言文档与索引。
+@override_settings(KB_INGEST_ASYNC=False)
 class DocumentIngestionApiTests(APITestCase):
     def setUp(self):
         os.environ["KB_EMBEDDING_BACKEND"] = "fake"
@@ -399,3 +406,1054 @@ class DocumentIngestionApiTests(APITestCase):
                     HTTP_AUTHORIZATION=f"Bearer {access1}",
                 )
                 self.assertEqual(resp.status_code, 400)
+
+
+# 上传接口在请求内同步入库，便于直接断言文档与索引。
+@override_settings(KB_INGEST_ASYNC=False)
+class VectorIndexTests(APITestCase):
+    # 覆盖按 chunk id 原地删除向量与旧版索引迁移
+    def setUp(self):
+        os.environ["KB_EMBEDDING_BACKEND"] = "fake"
+        self.user = User.objects.create_user(username="vec_u1", password="StrongPass123!@#")
+
+    def tearDown(self):
+        os.environ.pop("KB_EMBEDDING_BACKEND", None)
+
+    def _login_and_get_access(self, username: str, password: str) -> str:
+        resp = self.client.post(
+            "/api/users/login",
+            {"username": username, "password": password},
+            format="json",
+        )
+        self.assertEqual(resp.status_code, 200)
+        return resp.data["access"]
+
+    def test_delete_document_removes_vectors_without_embedding(self):
+        with tempfile.TemporaryDirectory() as faiss_dir, tempfile.TemporaryDirectory() as upload_dir:
+            with override_settings(FAISS_INDEX_ROOT=Path(faiss_dir), KB_UPLOAD_ROOT=Path(upload_dir)):
+                access = self._login_and_get_access("vec_u1", "StrongPass123!@#")
+                kb_resp = self.client.post(
+                    "/api/knowledge/create",
+                    {"name": "kb1"},
+                    format="json",
+                    HTTP_AUTHORIZATION=f"Bearer {access}",
+                )
+                kb_id = kb_resp.data["id"]
+                kb_faiss_path = Path(kb_resp.data["faiss_path"])
+
+                doc_ids = []
+                for name, body in (("a.txt", b"a" * 3000), ("b.txt", b"b" * 3000)):
+                    r = self.client.post(
+                        "/api/knowledge/upload",
+                        {"kb_id": kb_id, "file": SimpleUploadedFile(name, body, content_type="text/plain")},
+                        format="multipart",
+                        HTTP_AUTHORIZATION=f"Bearer {access}",
+                    )
+                    self.assertEqual(r.status_code, 201)
+                    doc_ids.append(r.data["id"])
+
+                with mock.patch.object(vectorstore, "embed_texts", side_effect=AssertionError("不应调用 embedding")):
+                    del_resp = self.client.delete(
+                        f"/api/knowledge/document/{doc_ids[0]}",
+                        HTTP_AUTHORIZATION=f"Bearer {access}",
+                    )
+                self.assertEqual(del_resp.status_code, 204)
+
+                remaining = set(DocumentChunk.objects.filter(document__kb_id=kb_id).values_list("id", flat=True))
+                self.assertEqual(count_vectors(kb_faiss_path), len(remaining))
+                self.assertEqual(set(vectorstore.list_chunk_ids(kb_faiss_path).tolist()), remaining)
+
+    def test_migrate_legacy_index(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            index_path = Path(tmpdir) / "kb_1.index"
+            faiss = vectorstore._faiss()
+            legacy = faiss.IndexFlatL2(8)
+            vectors = vectorstore.embed_texts(["t1", "t2", "t3"])
+            legacy.add(vectors)
+            faiss.write_index(legacy, str(index_path))
+            Path(f"{index_path}.meta.json").write_text(json.dumps([11, 12, 13]), encoding="utf-8")
+
+            self.assertTrue(vectorstore.migrate_legacy_index(index_path))
+            self.assertFalse(Path(f"{index_path}.meta.json").exists())
+
+            index = vectorstore.load_faiss_index(index_path)
+            self.assertTrue(vectorstore.is_id_mapped(index))
+            _, idx = index.search(vectorstore.normalize_vectors(vectors[1:2]), 1)
+            self.assertEqual(int(idx[0][0]), 12)
+            self.assertFalse(vectorstore.migrate_legacy_index(index_path))
+            ids, _ = vectorstore.load_chunk_vectors(index_path)
+            self.assertEqual(ids.tolist(), [11, 12, 13])
+
+    def test_rebuild_reuses_stored_vectors(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            index_path = Path(tmpdir) / "kb_1.index"
+            vectorstore.add_vectors_to_index(index_path, ["t1", "t2", "t3"], chunk_ids=[1, 2, 3])
+
+            with mock.patch.object(vectorstore, "embed_texts", wraps=vectorstore.embed_texts) as embed:
+                n = vectorstore.rebuild_index(index_path, ["t1", "t3", "t4"], chunk_ids=[1, 3, 4])
+            self.assertEqual(n, 3)
+            embed.assert_called_once_with(["t4"])
+
+            with mock.patch.object(vectorstore, "embed_texts", side_effect=AssertionError("不应调用 embedding")):
+                self.assertEqual(vectorstore.rebuild_index_from_vectors(index_path), 3)
+            self.assertEqual(count_vectors(index_path), 3)
+
+
+class EmbeddingCacheTests(APITestCase):
+    def test_cache_hits_across_calls_and_dedupes_batch(self):
+        from .embedding_cache import EmbeddingCache
+
+        calls: list[list[str]] = []
+
+        def fake_embed(texts):
+            calls.append(list(texts))
+            return vectorstore._embed_texts_fake(texts)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = EmbeddingCache(Path(tmpdir), 16 * 1024 * 1024)
+            first = cache.get_or_embed("m1", ["a", "b", "a"], fake_embed)
+            self.assertEqual(calls, [["a", "b"]])
+            self.assertEqual(first.shape, (3, 8))
+
+            second = cache.get_or_embed("m1", ["b", "c"], fake_embed)
+            self.assertEqual(calls[-1], ["c"])
+            self.assertTrue((second[0] == first[1]).all())
+
+            cache.get_or_embed("m2", ["a"], fake_embed)
+            self.assertEqual(calls[-1], ["a"])
+
+            stats = cache.stats()
+            self.assertEqual(stats["misses"], 4)
+            self.assertEqual(stats["hits"], 2)
+
+    def test_ingestion_uses_cache_for_openai_backend(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with override_settings(KB_EMBEDDING_CACHE_DIR=Path(tmpdir) / "cache", KB_EMBEDDING_CACHE_SIZE_MB=16):
+                with mock.patch.object(
+                    vectorstore, "embed_texts", side_effect=vectorstore._embed_texts_fake
+                ) as embed:
+                    os.environ["KB_EMBEDDING_BACKEND"] = "openai"
+                    try:
+                        vectorstore.add_vectors_to_index(Path(tmpdir) / "kb_1.index", ["x", "y"], chunk_ids=[1, 2])
+                        vectorstore.add_vectors_to_index(Path(tmpdir) / "kb_2.index", ["x", "y"], chunk_ids=[3, 4])
+                    finally:
+                        os.environ.pop("KB_EMBEDDING_BACKEND", None)
+                self.assertEqual(embed.call_count, 1)
+
+
+class IndexTierTests(APITestCase):
+    def setUp(self):
+        os.environ["KB_EMBEDDING_BACKEND"] = "fake"
+
+    def tearDown(self):
+        os.environ.pop("KB_EMBEDDING_BACKEND", None)
+
+    def test_flat_index_migrates_to_ivf_past_threshold(self):
+        from .index_factory import load_index_spec, search_params
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with override_settings(KB_ANN_THRESHOLD=100, KB_ANN_INDEX_TYPE="ivf", KB_INDEX_MIGRATE_ASYNC=False):
+                index_path = Path(tmpdir) / "kb_1.index"
+                texts = [f"chunk-{i}" for i in range(120)]
+                vectorstore.add_vectors_to_index(index_path, texts[:60], chunk_ids=list(range(1, 61)))
+                self.assertEqual(load_index_spec(index_path).kind, "flat")
+
+                vectorstore.add_vectors_to_index(index_path, texts[60:], chunk_ids=list(range(61, 121)))
+                spec = load_index_spec(index_path)
+                self.assertEqual(spec.kind, "ivf")
+                self.assertEqual(count_vectors(index_path), 120)
+
+                index = vectorstore.load_faiss_index(index_path)
+                q = vectorstore.normalize_vectors(vectorstore.embed_texts([texts[7]]))
+                dist, idx = index.search(q, 1, params=search_params(spec, {"nprobe": spec.nlist}))
+                self.assertAlmostEqual(float(dist[0][0]), 0.0, places=5)
+
+    def test_hnsw_delete_rebuilds_from_stored_vectors(self):
+        from .index_factory import load_index_spec
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            config = {"index_type": "hnsw"}
+            index_path = Path(tmpdir) / "kb_1.index"
+            vectorstore.add_vectors_to_index(index_path, ["a", "b", "c"], chunk_ids=[1, 2, 3], config=config)
+            self.assertEqual(load_index_spec(index_path).kind, "hnsw")
+
+            with mock.patch.object(vectorstore, "embed_texts", side_effect=AssertionError("不应调用 embedding")):
+                self.assertEqual(vectorstore.remove_vectors_from_index(index_path, [2], config=config), 1)
+            index = vectorstore.load_faiss_index(index_path)
+            self.assertEqual(sorted(vectorstore._faiss().vector_to_array(index.id_map).tolist()), [1, 3])
+
+
+class IndexCompressionTests(APITestCase):
+    def test_sq8_index_with_exact_rerank(self):
+        from .index_factory import load_index_spec
+
+        rng = np.random.default_rng(0)
+        vectors = rng.normal(size=(300, 32)).astype(np.float32)
+        ids = np.arange(1, 301, dtype=np.int64)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            index_path = Path(tmpdir) / "kb_1.index"
+            config = {"compression": "sq8"}
+            with mock.patch.object(vectorstore, "embed_chunk_texts", return_value=vectors):
+                vectorstore.add_vectors_to_index(index_path, ["t"] * 300, chunk_ids=ids.tolist(), config=config)
+            self.assertEqual(load_index_spec(index_path).compression, "sq8")
+
+            index = vectorstore.load_faiss_index(index_path)
+            q = vectors[:5] + 0.01
+            _, found = vectorstore.search_index(index_path, index, q, 3, config=config)
+            # 向量与问题均单位化，精确结果按余弦相似度降序。
+            sims = vectorstore.normalize_vectors(q) @ vectorstore.normalize_vectors(vectors).T
+            exact = (-sims).argsort(axis=1)[:, :3] + 1
+            self.assertEqual(found.tolist(), exact.tolist())
+
+    def test_ivf_delete_keeps_ids_aligned(self):
+        from .index_factory import load_index_spec
+
+        rng = np.random.default_rng(2)
+        vectors = rng.normal(size=(600, 32)).astype(np.float32)
+        ids = np.arange(1001, 1601, dtype=np.int64)
+        for compression in ("none", "pq"):
+            with self.subTest(compression=compression), tempfile.TemporaryDirectory() as tmpdir:
+                index_path = Path(tmpdir) / "kb_1.index"
+                config = {"index_type": "ivf", "compression": compression, "nprobe": 64}
+                with mock.patch.object(vectorstore, "embed_chunk_texts", return_value=vectors):
+                    vectorstore.add_vectors_to_index(index_path, ["t"] * 600, chunk_ids=ids.tolist(), config=config)
+                spec = load_index_spec(index_path)
+                self.assertEqual((spec.kind, spec.compression), ("ivf", compression))
+
+                with mock.patch.object(vectorstore, "embed_texts", side_effect=AssertionError("不应调用 embedding")):
+                    removed = vectorstore.remove_vectors_from_index(index_path, ids[:100].tolist(), config=config)
+                self.assertEqual(removed, 100)
+                self.assertEqual(count_vectors(index_path), 500)
+
+                # 删除前排的向量后，其余向量仍应命中自己的 id（remove_ids 会让 id 整体错位）。
+                index = vectorstore.load_faiss_index(index_path)
+                _, found = vectorstore.search_index(index_path, index, vectors[200:210], 1, config=config)
+                self.assertEqual(found[:, 0].tolist(), ids[200:210].tolist())
+                _, found = vectorstore.search_index(index_path, index, vectors[:5], 5, config=config)
+                self.assertFalse(set(found.ravel().tolist()) & set(ids[:100].tolist()))
+
+    def test_compression_report_shrinks_memory(self):
+        from .index_report import compare_index_variants
+
+        rng = np.random.default_rng(1)
+        vectors = rng.normal(size=(400, 64)).astype(np.float32)
+        reports = {r.compression: r for r in compare_index_variants(np.arange(400), vectors, k=5, n_queries=20)}
+        self.assertEqual(reports["none"].recall, 1.0)
+        self.assertLess(reports["sq8"].memory_ratio, 0.5)
+        self.assertGreaterEqual(reports["sq8"].recall_reranked, reports["sq8"].recall)
+
+
+class IndexMmapTests(APITestCase):
+    def setUp(self):
+        os.environ["KB_EMBEDDING_BACKEND"] = "fake"
+
+    def tearDown(self):
+        os.environ.pop("KB_EMBEDDING_BACKEND", None)
+
+    def test_readers_share_mmap_index_and_writers_use_private_copy(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with override_settings(KB_INDEX_MMAP=True):
+                index_path = Path(tmpdir) / "kb_1.index"
+                vectorstore.add_vectors_to_index(index_path, ["a", "b"], chunk_ids=[1, 2])
+
+                reader = vectorstore.load_faiss_index(index_path)
+                self.assertIs(vectorstore.load_faiss_index(index_path), reader)
+                self.assertEqual(int(reader.ntotal), 2)
+
+                vectorstore.add_vectors_to_index(index_path, ["c"], chunk_ids=[3])
+                # 已映射的旧索引保持不变，新读者看到替换后的文件。
+                self.assertEqual(int(reader.ntotal), 2)
+                self.assertEqual(count_vectors(index_path), 3)
+
+                vectorstore.remove_vectors_from_index(index_path, [1])
+                _, idx = vectorstore.search_index(
+                    index_path, vectorstore.load_faiss_index(index_path), vectorstore.embed_texts(["c"]), 3
+                )
+                self.assertEqual(sorted(i for i in idx[0].tolist() if i >= 0), [2, 3])
+
+
+class IndexCacheTests(APITestCase):
+    def setUp(self):
+        os.environ["KB_EMBEDDING_BACKEND"] = "fake"
+
+    def tearDown(self):
+        os.environ.pop("KB_EMBEDDING_BACKEND", None)
+
+    def test_byte_budget_evicts_least_recently_used(self):
+        from .lru import ByteBudgetLRU
+
+        cache = ByteBudgetLRU(100)
+        cache.put("a", "A", 40, stamp=1)
+        cache.put("b", "B", 40, stamp=1)
+        self.assertEqual(cache.get("a", 1), "A")
+        cache.put("c", "C", 40, stamp=1)
+
+        self.assertIsNone(cache.get("b", 1))
+        self.assertEqual(cache.get("a", 1), "A")
+        self.assertIsNone(cache.get("a", 2))
+        cache.put("huge", "H", 1000)
+        stats = cache.stats()
+        self.assertEqual(stats["entries"], 1)
+        self.assertEqual(stats["bytes_resident"], 40)
+        self.assertEqual(stats["evictions"], 1)
+        self.assertEqual(stats["hits"], 2)
+        self.assertEqual(stats["misses"], 2)
+
+    def test_entries_expire_after_ttl(self):
+        from .lru import ByteBudgetLRU
+
+        cache = ByteBudgetLRU(100, ttl_seconds=10)
+        with mock.patch("knowledge.lru.time.monotonic", return_value=1000.0):
+            cache.put("a", "A", 10)
+            cache.put("b", "B", 10, ttl_seconds=60)
+        with mock.patch("knowledge.lru.time.monotonic", return_value=1011.0):
+            self.assertIsNone(cache.get("a"))
+            self.assertEqual(cache.get("b"), "B")
+        stats = cache.stats()
+        self.assertEqual((stats["entries"], stats["expired"]), (1, 1))
+
+    def test_deleted_kb_index_is_dropped_from_cache(self):
+        with tempfile.TemporaryDirectory() as tmpdir, override_settings(KB_INDEX_MMAP=False):
+            index_path = Path(tmpdir) / "kb_1.index"
+            vectorstore.add_vectors_to_index(index_path, ["a", "b"], chunk_ids=[1, 2])
+            self.assertIsNotNone(vectorstore.load_faiss_index(index_path))
+            before = vectorstore.index_cache_stats()["index"]
+            self.assertGreater(before["bytes_resident"], 0)
+
+            vectorstore.remove_index_files(index_path)
+            after = vectorstore.index_cache_stats()["index"]
+            self.assertEqual(after["entries"], before["entries"] - 1)
+            self.assertLess(after["bytes_resident"], before["bytes_resident"])
+
+
+class ChunkVectorStoreTests(APITestCase):
+    def test_appends_extend_files_and_deletes_write_tombstones(self):
+        from . import chunk_vectors
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            index_path = Path(tmpdir) / "kb_1.index"
+            vecs = np.arange(40, dtype=np.float32).reshape(10, 4)
+            chunk_vectors.append_chunk_vectors(index_path, range(1, 6), vecs[:5])
+            ids_file = chunk_vectors.vector_ids_path(index_path)
+            inode = ids_file.stat().st_ino
+
+            chunk_vectors.append_chunk_vectors(index_path, range(6, 11), vecs[5:])
+            self.assertEqual(ids_file.stat().st_ino, inode)
+            ids, stored = chunk_vectors.load_chunk_vectors(index_path, mmap=True)
+            self.assertEqual(ids.tolist(), list(range(1, 11)))
+            np.testing.assert_array_equal(stored, vecs)
+
+            self.assertEqual(chunk_vectors.remove_chunk_vectors(index_path, [3]), 1)
+            self.assertEqual(ids_file.stat().st_ino, inode)
+            ids, stored = chunk_vectors.load_chunk_vectors(index_path)
+            self.assertNotIn(3, ids.tolist())
+            np.testing.assert_array_equal(chunk_vectors.lookup_chunk_vectors(index_path, [4])[4], vecs[3])
+            self.assertEqual(chunk_vectors.lookup_chunk_vectors(index_path, [3]), {})
+
+            # 墓碑超过阈值后整体重写，新文件世代号一致。
+            chunk_vectors.remove_chunk_vectors(index_path, [1, 2, 5])
+            self.assertNotEqual(ids_file.stat().st_ino, inode)
+            ids, _ = chunk_vectors.load_chunk_vectors(index_path)
+            self.assertEqual(ids.tolist(), [4, 6, 7, 8, 9, 10])
+
+    def test_legacy_npy_sidecars_are_converted_on_append(self):
+        from . import chunk_vectors
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            index_path = Path(tmpdir) / "kb_1.index"
+            np.save(str(Path(f"{index_path}.vectors.npy")), np.ones((2, 4), dtype=np.float32))
+            np.save(str(Path(f"{index_path}.vector_ids.npy")), np.array([7, 8], dtype=np.int64))
+            self.assertEqual(chunk_vectors.load_chunk_vectors(index_path)[0].tolist(), [7, 8])
+
+            chunk_vectors.append_chunk_vectors(index_path, [9], np.zeros((1, 4), dtype=np.float32))
+            self.assertFalse(Path(f"{index_path}.vectors.npy").exists())
+            self.assertEqual(chunk_vectors.load_chunk_vectors(index_path)[0].tolist(), [7, 8, 9])
+
+
+class ChunkTextStoreTests(APITestCase):
+    def setUp(self):
+        os.environ["KB_EMBEDDING_BACKEND"] = "fake"
+        self.user = User.objects.create_user(username="txt_u1", password="StrongPass123!@#")
+
+    def tearDown(self):
+        os.environ.pop("KB_EMBEDDING_BACKEND", None)
+
+    def test_appends_deletes_and_torn_tail(self):
+        from . import chunk_texts
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            index_path = Path(tmpdir) / "kb_1.index"
+            chunk_texts.append_chunk_texts(index_path, [1, 2, 3], ["甲乙", "", "abc"])
+            chunk_texts.append_chunk_texts(index_path, [4, 5], ["错误码 E-1", "第五段"])
+            self.assertEqual(
+                chunk_texts.lookup_chunk_texts(index_path, [5, 1, 2, 9]), {5: "第五段", 1: "甲乙", 2: ""}
+            )
+
+            # 模拟追加中断：索引行已写入但文本未落盘，读取端忽略该行，下次追加覆盖。
+            with chunk_texts.text_index_path(index_path).open("ab") as f:
+                f.write(np.array([6, 10**6, 4], dtype=np.int64).tobytes())
+            self.assertEqual(chunk_texts.lookup_chunk_texts(index_path, [6]), {})
+            chunk_texts.append_chunk_texts(index_path, [7], ["七"])
+            self.assertEqual(chunk_texts.lookup_chunk_texts(index_path, [4, 7]), {4: "错误码 E-1", 7: "七"})
+
+            inode = chunk_texts.text_index_path(index_path).stat().st_ino
+            self.assertEqual(chunk_texts.remove_chunk_texts(index_path, [4]), 1)
+            self.assertEqual(chunk_texts.text_index_path(index_path).stat().st_ino, inode)
+            self.assertEqual(chunk_texts.lookup_chunk_texts(index_path, [4]), {})
+
+            # 墓碑超过阈值后整体重写。
+            chunk_texts.remove_chunk_texts(index_path, [1, 2])
+            self.assertNotEqual(chunk_texts.text_index_path(index_path).stat().st_ino, inode)
+            self.assertEqual(chunk_texts.lookup_chunk_texts(index_path, [3, 5, 7]), {3: "abc", 5: "第五段", 7: "七"})
+
+    def test_retrieval_reads_texts_without_db_queries(self):
+        from rag.services import retrieve_contexts
+
+        from .chunk_texts import remove_chunk_text_files
+
+        with tempfile.TemporaryDirectory() as faiss_dir:
+            kb = KnowledgeBase.objects.create(user=self.user, name="kb1", faiss_path=str(Path(faiss_dir) / "kb.index"))
+            doc = Document.objects.create(kb=kb, filename="a.txt", file_path="", chunk_count=5)
+            texts = [f"第 {i} 段：知识库文本旁路文件。" for i in range(5)]
+            DocumentChunk.objects.bulk_create(
+                [DocumentChunk(document=doc, chunk_index=i, text=t) for i, t in enumerate(texts)]
+            )
+            ids = list(DocumentChunk.objects.filter(document=doc).order_by("chunk_index").values_list("id", flat=True))
+            vectorstore.add_vectors_to_index(Path(kb.faiss_path), texts, chunk_ids=ids)
+
+            with self.assertNumQueries(0):
+                contexts = retrieve_contexts(kb, texts[2], top_k=2)
+            self.assertIn(texts[2], contexts)
+
+            # 文件缺失时回表取文本；迁移命令按数据库内容补建后重新零查询。
+            remove_chunk_text_files(Path(kb.faiss_path))
+            self.assertIn(texts[3], retrieve_contexts(kb, texts[3], top_k=2))
+            rows = DocumentChunk.objects.filter(document__kb=kb).values_list("id", "text")
+            self.assertTrue(vectorstore.backfill_chunk_texts(Path(kb.faiss_path), rows))
+            with self.assertNumQueries(0):
+                self.assertIn(texts[4], retrieve_contexts(kb, texts[4], top_k=2))
+
+
+class IndexSegmentTests(APITestCase):
+    def setUp(self):
+        os.environ["KB_EMBEDDING_BACKEND"] = "fake"
+
+    def tearDown(self):
+        os.environ.pop("KB_EMBEDDING_BACKEND", None)
+
+    def test_appends_write_segments_searched_with_base(self):
+        from .segments import list_segments
+
+        with tempfile.TemporaryDirectory() as tmpdir, override_settings(KB_SEGMENT_MAX_COUNT=8):
+            index_path = Path(tmpdir) / "kb_1.index"
+            vectorstore.add_vectors_to_index(index_path, ["a", "b"], chunk_ids=[1, 2])
+            base_stamp = vectorstore._file_stamp(index_path)
+            vectorstore.add_vectors_to_index(index_path, ["c"], chunk_ids=[3])
+            vectorstore.add_vectors_to_index(index_path, ["d"], chunk_ids=[4])
+
+            self.assertEqual(vectorstore._file_stamp(index_path), base_stamp)
+            self.assertEqual(len(list_segments(index_path)), 2)
+            self.assertEqual(count_vectors(index_path), 4)
+
+            base = vectorstore.load_faiss_index(index_path)
+            _, idx = vectorstore.search_index(index_path, base, vectorstore.embed_texts(["c", "a"]), 1)
+            self.assertEqual(idx[:, 0].tolist(), [3, 1])
+
+            self.assertEqual(vectorstore.remove_vectors_from_index(index_path, [3]), 1)
+            self.assertEqual(len(list_segments(index_path)), 1)
+            self.assertEqual(sorted(vectorstore.list_chunk_ids(index_path).tolist()), [1, 2, 4])
+
+    def test_segments_are_compacted_into_base(self):
+        from .segments import list_segments
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with override_settings(KB_SEGMENT_MAX_COUNT=3, KB_INDEX_MIGRATE_ASYNC=False):
+                index_path = Path(tmpdir) / "kb_1.index"
+                vectorstore.add_vectors_to_index(index_path, ["t0"], chunk_ids=[10])
+                for i in range(1, 4):
+                    vectorstore.add_vectors_to_index(index_path, [f"t{i}"], chunk_ids=[10 + i])
+
+                self.assertEqual(list_segments(index_path), [])
+                base = vectorstore.load_faiss_index(index_path)
+                self.assertEqual(int(base.ntotal), 4)
+                _, idx = vectorstore.search_index(index_path, base, vectorstore.embed_texts(["t3"]), 1)
+                self.assertEqual(int(idx[0][0]), 13)
+
+    def test_concurrent_appends_keep_every_vector(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        with tempfile.TemporaryDirectory() as tmpdir, override_settings(KB_SEGMENT_MAX_COUNT=100):
+            index_path = Path(tmpdir) / "kb_1.index"
+            vectorstore.add_vectors_to_index(index_path, ["seed"], chunk_ids=[1])
+            with ThreadPoolExecutor(max_workers=4) as pool:
+                list(pool.map(lambda i: vectorstore.add_vectors_to_index(index_path, [f"x{i}"], chunk_ids=[i]), range(2, 14)))
+
+            self.assertEqual(sorted(vectorstore.list_chunk_ids(index_path).tolist()), list(range(1, 14)))
+            ids, _ = vectorstore.load_chunk_vectors(index_path)
+            self.assertEqual(sorted(ids.tolist()), list(range(1, 14)))
+
+
+class EmbeddingBatcherTests(APITestCase):
+    def test_batches_respect_limits_retry_and_keep_order(self):
+        from .embedding_batcher import BatchConfig, embed_in_batches, get_batch_config
+
+        calls: list[list[str]] = []
+        failed: set[str] = set()
+
+        def embed_batch(batch):
+            calls.append(list(batch))
+            if batch[0] == "t4" and "t4" not in failed:
+                failed.add("t4")
+                raise RuntimeError("rate limited")
+            return [[float(t[1:]), 0.0] for t in batch]
+
+        texts = [f"t{i}" for i in range(25)]
+        cfg = BatchConfig(batch_size=4, max_tokens=10_000, concurrency=3, max_retries=2, backoff_seconds=0)
+        vectors = embed_in_batches(texts, embed_batch, cfg)
+
+        self.assertEqual(vectors[:, 0].tolist(), [float(i) for i in range(25)])
+        self.assertTrue(all(len(batch) <= 4 for batch in calls))
+        self.assertEqual(len(calls), 8)
+
+        with override_settings(KB_EMBEDDING_BATCH_SIZE=0):
+            self.assertEqual(get_batch_config("https://dashscope.aliyuncs.com/compatible-mode/v1").batch_size, 10)
+
+    def test_token_budget_splits_long_texts(self):
+        from .embedding_batcher import plan_batches
+
+        texts = ["中" * 600, "中" * 600, "short", "中" * 1500]
+        self.assertEqual(plan_batches(texts, batch_size=10, max_tokens=1300), [[0, 1, 2], [3]])
+
+
+class IngestionJobTests(APITestCase):
+    def setUp(self):
+        os.environ["KB_EMBEDDING_BACKEND"] = "fake"
+        self.user1 = User.objects.create_user(username="job_u1", password="StrongPass123!@#")
+        self.user2 = User.objects.create_user(username="job_u2", password="StrongPass123!@#")
+
+    def tearDown(self):
+        os.environ.pop("KB_EMBEDDING_BACKEND", None)
+
+    def _login_and_get_access(self, username: str, password: str) -> str:
+        resp = self.client.post(
+            "/api/users/login",
+            {"username": username, "password": password},
+            format="json",
+        )
+        self.assertEqual(resp.status_code, 200)
+        return resp.data["access"]
+
+    def _upload(self, access: str, kb_id: int, name: str, body: bytes):
+        return self.client.post(
+            "/api/knowledge/upload",
+            {"kb_id": kb_id, "file": SimpleUploadedFile(name, body)},
+            format="multipart",
+            HTTP_AUTHORIZATION=f"Bearer {access}",
+        )
+
+    def test_upload_returns_job_and_worker_ingests_it(self):
+        from io import StringIO
+
+        from django.core.management import call_command
+
+        with tempfile.TemporaryDirectory() as faiss_dir, tempfile.TemporaryDirectory() as upload_dir:
+            with override_settings(
+                FAISS_INDEX_ROOT=Path(faiss_dir), KB_UPLOAD_ROOT=Path(upload_dir), KB_INGEST_ASYNC=True
+            ):
+                access = self._login_and_get_access("job_u1", "StrongPass123!@#")
+                kb_resp = self.client.post(
+                    "/api/knowledge/create", {"name": "kb1"}, format="json", HTTP_AUTHORIZATION=f"Bearer {access}"
+                )
+                kb_id = kb_resp.data["id"]
+
+                r = self._upload(access, kb_id, "a.txt", b"hello world\n" * 300)
+                self.assertEqual(r.status_code, 202)
+                job_id = r.data["job_id"]
+                self.assertEqual(r.data["status"], "queued")
+                self.assertEqual(Document.objects.filter(kb_id=kb_id).count(), 0)
+
+                bad = self._upload(access, kb_id, "b.pdf", b"not a pdf")
+                self.assertEqual(bad.status_code, 202)
+
+                call_command("run_ingest_worker", "--once", "--workers", "1", stdout=StringIO(), stderr=StringIO())
+
+                s = self.client.get(f"/api/knowledge/jobs/{job_id}", HTTP_AUTHORIZATION=f"Bearer {access}")
+                self.assertEqual(s.status_code, 200)
+                self.assertEqual(s.data["status"], "succeeded")
+                self.assertEqual(s.data["stage"], "done")
+                doc = Document.objects.get(id=s.data["document_id"])
+                self.assertEqual(s.data["chunk_count"], doc.chunk_count)
+                self.assertEqual(s.data["chunks_embedded"], doc.chunk_count)
+                self.assertEqual(count_vectors(Path(kb_resp.data["faiss_path"])), doc.chunk_count)
+
+                s = self.client.get(f"/api/knowledge/jobs/{bad.data['job_id']}", HTTP_AUTHORIZATION=f"Bearer {access}")
+                self.assertEqual(s.data["status"], "failed")
+                self.assertEqual(s.data["stage"], "extract")
+                self.assertTrue(s.data["error"])
+
+                other = self._login_and_get_access("job_u2", "StrongPass123!@#")
+                s = self.client.get(f"/api/knowledge/jobs/{job_id}", HTTP_AUTHORIZATION=f"Bearer {other}")
+                self.assertEqual(s.status_code, 404)
+
+    def test_stale_running_job_is_requeued_and_rerun_cleanly(self):
+        from .ingestion import claim_next_job, requeue_stale_jobs, run_ingestion_job
+        from .models import IngestionJob
+
+        with tempfile.TemporaryDirectory() as faiss_dir, tempfile.TemporaryDirectory() as upload_dir:
+            with override_settings(FAISS_INDEX_ROOT=Path(faiss_dir), KB_UPLOAD_ROOT=Path(upload_dir)):
+                access = self._login_and_get_access("job_u1", "StrongPass123!@#")
+                kb_resp = self.client.post(
+                    "/api/knowledge/create", {"name": "kb1"}, format="json", HTTP_AUTHORIZATION=f"Bearer {access}"
+                )
+                kb_id = kb_resp.data["id"]
+                job_id = self._upload(access, kb_id, "a.txt", b"hello world\n" * 300).data["job_id"]
+
+                job = claim_next_job("w1")
+                self.assertEqual(job.id, job_id)
+                self.assertIsNone(claim_next_job("w2"))
+                run_ingestion_job(job_id)
+                # 模拟 worker 在写完之后、上报前崩溃：任务回到 running 且心跳过期。
+                IngestionJob.objects.filter(id=job_id).update(status="running", heartbeat_at="2000-01-01T00:00:00Z")
+                self.assertEqual(requeue_stale_jobs(60), 1)
+
+                job = run_ingestion_job(claim_next_job("w2").id)
+                self.assertEqual(job.status, "succeeded")
+                self.assertEqual(Document.objects.filter(kb_id=kb_id).count(), 1)
+                self.assertEqual(count_vectors(Path(kb_resp.data["faiss_path"])), job.chunk_count)
+
+
+class IngestionPipelineTests(APITestCase):
+    def setUp(self):
+        os.environ["KB_EMBEDDING_BACKEND"] = "fake"
+        self.user = User.objects.create_user(username="pipe_u1", password="StrongPass123!@#")
+
+    def tearDown(self):
+        os.environ.pop("KB_EMBEDDING_BACKEND", None)
+
+    def test_streaming_chunker_matches_chunk_text(self):
+        import random
+
+        rng = random.Random(7)
+        for _ in range(200):
+            text = "".join(rng.choice("ab \n") for _ in range(rng.randint(0, 400)))
+            cuts = sorted(rng.sample(range(len(text) + 1), min(len(text) + 1, rng.randint(0, 6))))
+            pieces = [text[i:j] for i, j in zip([0] + cuts, cuts + [len(text)])]
+            self.assertEqual(
+                list(vectorstore.iter_chunk_text(pieces, chunk_size=40, chunk_overlap=10)),
+                vectorstore.chunk_text(text, chunk_size=40, chunk_overlap=10),
+            )
+
+    def test_stage_error_surfaces_with_stage_name(self):
+        from .pipeline import Pipeline, PipelineError
+
+        pipe = Pipeline(maxsize=1)
+        src, out = pipe.queue(), pipe.queue()
+        pipe.source("extract", lambda: iter(range(100)), src)
+
+        def boom(item):
+            if item == 3:
+                raise ValueError("bad item")
+            return item
+
+        pipe.stage("embed", boom, src, out)
+        with self.assertRaises(PipelineError) as ctx:
+            list(pipe.iter_queue(out))
+        pipe.abort()
+        self.assertEqual(ctx.exception.stage, "embed")
+        self.assertIsInstance(ctx.exception.error, ValueError)
+
+    def test_job_flushes_index_in_batches_and_reports_stage_stats(self):
+        from .ingestion import create_ingestion_job, run_ingestion_job
+
+        with tempfile.TemporaryDirectory() as faiss_dir, tempfile.TemporaryDirectory() as upload_dir:
+            with override_settings(
+                FAISS_INDEX_ROOT=Path(faiss_dir),
+                KB_UPLOAD_ROOT=Path(upload_dir),
+                KB_INGEST_EMBED_BATCH=2,
+                KB_INGEST_INDEX_FLUSH=4,
+                KB_INGEST_QUEUE_SIZE=1,
+            ):
+                kb = KnowledgeBase.objects.create(
+                    user=self.user, name="kb1", faiss_path=str(Path(faiss_dir) / "kb1.index")
+                )
+                upload = Path(upload_dir) / "a.txt"
+                upload.write_text("hello world\n" * 600, encoding="utf-8")
+                job = create_ingestion_job(kb, self.user, "a.txt", upload, False)
+
+                with mock.patch(
+                    "knowledge.ingestion.add_embedded_vectors_to_index",
+                    wraps=vectorstore.add_embedded_vectors_to_index,
+                ) as add:
+                    job = run_ingestion_job(job.id)
+
+                self.assertEqual(job.status, "succeeded")
+                doc = Document.objects.get(id=job.document_id)
+                self.assertGreater(doc.chunk_count, 4)
+                self.assertEqual(count_vectors(Path(kb.faiss_path)), doc.chunk_count)
+                self.assertEqual(add.call_count, (doc.chunk_count + 3) // 4)
+                stats = {s["stage"]: s for s in job.stage_stats}
+                self.assertEqual(set(stats), {"extract", "chunk", "embed", "index"})
+                self.assertEqual(stats["embed"]["units"], doc.chunk_count)
+                self.assertEqual(stats["index"]["units"], doc.chunk_count)
+
+
+class StreamingExtractionTests(APITestCase):
+    def test_text_blocks_decode_across_boundaries_with_gbk_fallback(self):
+        from .extraction import extract_upload_text, iter_upload_text
+
+        text = "知识库 RAG 检索增强\n" * 500
+        with tempfile.TemporaryDirectory() as d, override_settings(KB_EXTRACT_BLOCK_BYTES=4096):
+            utf8 = Path(d) / "a.txt"
+            utf8.write_bytes(text.encode("utf-8"))
+            pieces = list(iter_upload_text(utf8))
+            self.assertGreater(len(pieces), 1)
+            # 跨块的多字节字符会并入下一块，单块最多多出 3 个字节。
+            self.assertTrue(all(len(p.encode("utf-8")) <= 4096 + 3 for p in pieces))
+            self.assertEqual("".join(pieces), text)
+
+            gbk = Path(d) / "b.md"
+            gbk.write_bytes(text.encode("gbk"))
+            self.assertEqual(extract_upload_text(gbk), text)
+
+    def test_pdf_is_read_from_file_handle(self):
+        from .extraction import iter_upload_text
+
+        with tempfile.TemporaryDirectory() as d:
+            pdf = Path(d) / "a.pdf"
+            pdf.write_bytes(_build_simple_pdf_bytes("Hello PDF"))
+            with mock.patch.object(Path, "read_bytes", side_effect=AssertionError("read_bytes")):
+                self.assertIn("Hello PDF", "".join(iter_upload_text(pdf)))
+
+            bad = Path(d) / "b.pdf"
+            bad.write_bytes(b"not a pdf")
+            with self.assertRaises(ValueError):
+                list(iter_upload_text(bad))
+
+    def test_large_pdf_pages_are_extracted_in_process_pool_in_order(self):
+        from io import BytesIO
+
+        from pypdf import PdfReader, PdfWriter
+
+        from . import extraction
+
+        writer = PdfWriter()
+        for i in range(6):
+            page = PdfReader(BytesIO(_build_simple_pdf_bytes(f"Page {i}"))).pages[0]
+            writer.add_page(page)
+        buf = BytesIO()
+        writer.write(buf)
+
+        with tempfile.TemporaryDirectory() as d:
+            pdf = Path(d) / "manual.pdf"
+            pdf.write_bytes(buf.getvalue())
+            with override_settings(KB_PDF_WORKERS=1):
+                serial = extraction.extract_upload_text(pdf)
+            with override_settings(KB_PDF_WORKERS=2, KB_PDF_PARALLEL_MIN_PAGES=4, KB_PDF_PAGES_PER_TASK=2), mock.patch(
+                "knowledge.extraction._iter_page_texts_parallel",
+                wraps=extraction._iter_page_texts_parallel,
+            ) as parallel:
+                self.assertEqual(extraction.extract_upload_text(pdf), serial)
+                self.assertEqual(parallel.call_count, 1)
+        self.assertEqual([line.strip() for line in serial.splitlines()], [f"Page {i}" for i in range(6)])
+
+
+class LexicalIndexTests(APITestCase):
+    def setUp(self):
+        os.environ["KB_EMBEDDING_BACKEND"] = "fake"
+        self.user = User.objects.create_user(username="lex_u1", password="StrongPass123!@#")
+
+    def tearDown(self):
+        os.environ.pop("KB_EMBEDDING_BACKEND", None)
+
+    def test_tokenizer_uses_cjk_bigrams_and_words(self):
+        from .lexical import tokenize
+
+        self.assertEqual(tokenize("报错 ERR-1042 见 v2.3"), ["报错", "err-1042", "见", "v2.3"])
+        self.assertEqual(tokenize("知识库"), ["知识", "识库"])
+
+    def test_incremental_updates_are_persisted_and_compacted(self):
+        from . import lexical
+
+        with tempfile.TemporaryDirectory() as d:
+            index_path = Path(d) / "kb.index"
+            lexical.add_lexical_documents(index_path, [1, 2], ["安装失败 ERR-1042", "知识库 上传 文档"])
+            self.assertEqual(lexical.lexical_search(index_path, "err-1042", 5)[0][0], 1)
+
+            # 追加写成新分段；末尾分段的存活文档数不小于前一分段时合并，同一 chunk 以新分段为准。
+            lexical.add_lexical_documents(index_path, [3], ["上传 ERR-1042 超时"])
+            self.assertEqual(len(lexical._list_parts(index_path)), 2)
+            lexical.add_lexical_documents(index_path, [2], ["知识库 文档 更新"])
+            self.assertEqual(len(lexical._list_parts(index_path)), 1)
+            self.assertEqual({cid for cid, _ in lexical.lexical_search(index_path, "ERR-1042", 5)}, {1, 3})
+            self.assertEqual(lexical.lexical_search(index_path, "上传", 5)[0][0], 3)
+            self.assertEqual(lexical.load_lexical_index(index_path).doc_count, 3)
+
+            lexical.remove_lexical_documents(index_path, [1, 3])
+            self.assertEqual(lexical.lexical_search(index_path, "ERR-1042", 5), [])
+            # 删除超过 COMPACT_RATIO 后合并为一个完整分段，删除标记清空。
+            self.assertEqual(len(lexical._list_parts(index_path)), 1)
+            self.assertFalse(lexical._deleted_path(index_path).exists())
+            lex = lexical.load_lexical_index(index_path)
+            self.assertEqual(lex.parts[0].doc_ids.tolist(), [2])
+            self.assertEqual(lexical.lexical_search(index_path, "知识库", 5)[0][0], 2)
+
+            lexical.remove_lexical_index(index_path)
+            self.assertFalse(lexical.lexical_dir(index_path).exists())
+            self.assertEqual(lexical.lexical_search(index_path, "知识库", 5), [])
+
+    @override_settings(KB_LEXICAL_CACHE_MB=0)
+    def test_search_reads_postings_without_replay(self):
+        from . import lexical
+
+        with tempfile.TemporaryDirectory() as d:
+            index_path = Path(d) / "kb.index"
+            texts = [f"文档 {i} 编号 ERR-{i:04d}" for i in range(200)]
+            for start in range(0, 200, 50):
+                lexical.add_lexical_documents(index_path, range(start, start + 50), texts[start : start + 50])
+            lexical.remove_lexical_documents(index_path, [7])
+
+            # 缓存预算为 0 时每次检索都重新打开分段，也不解析任何日志。
+            with mock.patch.object(lexical.json, "loads", side_effect=AssertionError("replay")):
+                self.assertEqual(lexical.lexical_search(index_path, "err-0042", 3)[0][0], 42)
+                self.assertEqual(lexical.lexical_search(index_path, "err-0007", 3), [])
+                self.assertEqual(len(lexical.lexical_search(index_path, "文档", 500)), 199)
+
+    def test_legacy_log_is_converted_on_write(self):
+        from . import lexical
+
+        with tempfile.TemporaryDirectory() as d:
+            index_path = Path(d) / "kb.index"
+            legacy = lexical._legacy_path(index_path)
+            rows = []
+            for cid, text in [(1, "安装失败 ERR-1042"), (2, "知识库 上传 文档")]:
+                tokens = lexical.tokenize(text)
+                rows.append([cid, len(tokens), {t: tokens.count(t) for t in tokens}])
+            records = [{"add": rows}, {"del": [2]}]
+            legacy.write_text("".join(json.dumps(r, ensure_ascii=False) + "\n" for r in records), encoding="utf-8")
+
+            # 检索不回放旧格式，视为尚无词法索引。
+            self.assertTrue(lexical.lexical_needs_upgrade(index_path))
+            self.assertFalse(lexical.has_lexical_index(index_path))
+            self.assertEqual(lexical.lexical_search(index_path, "ERR-1042", 5), [])
+
+            lexical.add_lexical_documents(index_path, [3], ["上传 ERR-1042 超时"])
+            self.assertFalse(legacy.exists())
+            self.assertEqual({cid for cid, _ in lexical.lexical_search(index_path, "ERR-1042", 5)}, {1, 3})
+            self.assertEqual([cid for cid, _ in lexical.lexical_search(index_path, "知识库", 5)], [])
+
+    def test_rrf_fuses_rankings(self):
+        from .lexical import reciprocal_rank_fusion
+
+        self.assertEqual(reciprocal_rank_fusion([[1, 2, 3], [3, 4]], k=60), [3, 1, 2, 4])
+
+    def test_hybrid_retrieval_recalls_exact_codes(self):
+        from rag.services import retrieve_contexts
+
+        from .lexical import lexical_search
+
+        with tempfile.TemporaryDirectory() as faiss_dir:
+            kb = KnowledgeBase.objects.create(user=self.user, name="kb1", faiss_path=str(Path(faiss_dir) / "kb.index"))
+            doc = Document.objects.create(kb=kb, filename="a.txt", file_path="", chunk_count=40)
+            texts = [f"常见问题第 {i} 条：请检查网络连接与账号权限。" for i in range(40)]
+            texts[27] = "错误码 E-7781 表示授权证书已过期，需要重新签发。"
+            DocumentChunk.objects.bulk_create(
+                [DocumentChunk(document=doc, chunk_index=i, text=t) for i, t in enumerate(texts)]
+            )
+            ids = list(DocumentChunk.objects.filter(document=doc).order_by("chunk_index").values_list("id", flat=True))
+            vectorstore.add_vectors_to_index(Path(kb.faiss_path), texts, chunk_ids=ids)
+
+            contexts = retrieve_contexts(kb, "E-7781 是什么错误", top_k=2)
+            self.assertIn(texts[27], contexts)
+
+            # 删除文档时词法索引同步删除。
+            vectorstore.remove_vectors_from_index(Path(kb.faiss_path), [ids[27]])
+            self.assertNotIn(ids[27], [cid for cid, _ in lexical_search(Path(kb.faiss_path), "E-7781", 5)])
+
+
+@override_settings(KB_INGEST_ASYNC=False)
+class ContentVersionTests(APITestCase):
+    def setUp(self):
+        os.environ["KB_EMBEDDING_BACKEND"] = "fake"
+        User.objects.create_user(username="ver_u1", password="StrongPass123!@#")
+        resp = self.client.post(
+            "/api/users/login", {"username": "ver_u1", "password": "StrongPass123!@#"}, format="json"
+        )
+        self.auth = {"HTTP_AUTHORIZATION": f"Bearer {resp.data['access']}"}
+
+    def tearDown(self):
+        os.environ.pop("KB_EMBEDDING_BACKEND", None)
+
+    def test_writes_bump_version_and_conditional_gets_return_304(self):
+        with tempfile.TemporaryDirectory() as faiss_dir, tempfile.TemporaryDirectory() as upload_dir:
+            with override_settings(FAISS_INDEX_ROOT=Path(faiss_dir), KB_UPLOAD_ROOT=Path(upload_dir)):
+                kb_id = self.client.post("/api/knowledge/create", {"name": "kb1"}, format="json", **self.auth).data["id"]
+                self.assertEqual(KnowledgeBase.objects.get(id=kb_id).content_version, 0)
+
+                up = self.client.post(
+                    "/api/knowledge/upload",
+                    {"kb_id": kb_id, "file": SimpleUploadedFile("a.txt", b"hello world\n" * 50)},
+                    format="multipart",
+                    **self.auth,
+                )
+                self.assertEqual(up.status_code, 201)
+                v1 = KnowledgeBase.objects.get(id=kb_id).content_version
+                self.assertGreater(v1, 0)
+
+                docs = self.client.get(f"/api/knowledge/{kb_id}/documents", **self.auth)
+                self.assertEqual(docs.status_code, 200)
+                etag = docs["ETag"]
+                again = self.client.get(f"/api/knowledge/{kb_id}/documents", HTTP_IF_NONE_MATCH=etag, **self.auth)
+                self.assertEqual(again.status_code, 304)
+                self.assertEqual(again["ETag"], etag)
+
+                kbs = self.client.get("/api/knowledge/list", **self.auth)
+                self.assertEqual(kbs.data["items"][0]["content_version"], v1)
+                kbs_etag = kbs["ETag"]
+                self.assertEqual(
+                    self.client.get("/api/knowledge/list", HTTP_IF_NONE_MATCH=kbs_etag, **self.auth).status_code, 304
+                )
+
+                self.assertEqual(
+                    self.client.delete(f"/api/knowledge/document/{up.data['id']}", **self.auth).status_code, 204
+                )
+                self.assertGreater(KnowledgeBase.objects.get(id=kb_id).content_version, v1)
+                after = self.client.get(f"/api/knowledge/{kb_id}/documents", HTTP_IF_NONE_MATCH=etag, **self.auth)
+                self.assertEqual(after.status_code, 200)
+                self.assertNotEqual(after["ETag"], etag)
+                self.assertEqual(after.data["items"], [])
+                self.assertNotEqual(
+                    self.client.get("/api/knowledge/list", HTTP_IF_NONE_MATCH=kbs_etag, **self.auth).status_code, 304
+                )
+
+
+class IndexConsistencyTests(APITestCase):
+    def setUp(self):
+        os.environ["KB_EMBEDDING_BACKEND"] = "fake"
+        self.user = User.objects.create_user(username="chk_u1", password="StrongPass123!@#")
+
+    def tearDown(self):
+        os.environ.pop("KB_EMBEDDING_BACKEND", None)
+
+    def _kb_with_chunks(self, faiss_dir: str, n: int):
+        kb = KnowledgeBase.objects.create(user=self.user, name="kb1", faiss_path=str(Path(faiss_dir) / "kb.index"))
+        doc = Document.objects.create(kb=kb, filename="a.txt", file_path="", chunk_count=n)
+        texts = [f"一致性检查第 {i} 段" for i in range(n)]
+        DocumentChunk.objects.bulk_create(
+            [DocumentChunk(document=doc, chunk_index=i, text=t) for i, t in enumerate(texts)]
+        )
+        ids = list(DocumentChunk.objects.filter(document=doc).order_by("chunk_index").values_list("id", flat=True))
+        return kb, doc, texts, ids
+
+    def test_unnormalized_vectors_are_rebuilt_without_embedding(self):
+        from .chunk_vectors import load_chunk_vectors, save_chunk_vectors
+        from .consistency import check_knowledge_base
+
+        with tempfile.TemporaryDirectory() as faiss_dir:
+            kb, _, texts, ids = self._kb_with_chunks(faiss_dir, 4)
+            index_path = Path(kb.faiss_path)
+            vectorstore.add_vectors_to_index(index_path, texts, chunk_ids=ids)
+            _, stored = load_chunk_vectors(index_path)
+            np.testing.assert_allclose(np.linalg.norm(stored, axis=1), 1.0, rtol=1e-5)
+
+            # 模拟余弦检索之前写入的索引：旁路文件中的向量未单位化。
+            save_chunk_vectors(index_path, ids, vectorstore._embed_texts_fake(texts))
+            with mock.patch.object(vectorstore, "embed_texts", side_effect=AssertionError("不应调用 embedding")):
+                result = check_knowledge_base(kb)
+            self.assertEqual(result.repaired, ["rebuilt"])
+            self.assertEqual(result.issues, [])
+            _, stored = load_chunk_vectors(index_path)
+            np.testing.assert_allclose(np.linalg.norm(stored, axis=1), 1.0, rtol=1e-5)
+
+    def test_detects_and_repairs_orphan_and_missing_vectors(self):
+        from io import StringIO
+
+        from django.core.management import call_command
+
+        from .consistency import run_consistency_check
+
+        with tempfile.TemporaryDirectory() as faiss_dir:
+            kb, doc, texts, ids = self._kb_with_chunks(faiss_dir, 6)
+            index_path = Path(kb.faiss_path)
+            vectorstore.add_vectors_to_index(index_path, texts[:5], chunk_ids=ids[:5])
+            DocumentChunk.objects.filter(id=ids[0]).delete()
+
+            [result] = run_consistency_check(repair=False)
+            self.assertEqual(result.issues, ["orphan_vectors:1", "missing_vectors:1"])
+            kb.refresh_from_db()
+            self.assertEqual(kb.index_status, KnowledgeBase.INDEX_DEGRADED)
+
+            version = kb.content_version
+            with mock.patch.object(vectorstore, "embed_texts", wraps=vectorstore.embed_texts) as embed:
+                call_command("check_index_consistency", stdout=StringIO(), stderr=StringIO())
+            # 重建复用已持久化的向量，只对缺失的 chunk 调用 embedding。
+            embed.assert_called_once_with([texts[5]])
+            kb.refresh_from_db()
+            self.assertEqual(kb.index_status, KnowledgeBase.INDEX_OK)
+            self.assertIsNotNone(kb.index_checked_at)
+            self.assertGreater(kb.content_version, version)
+            self.assertEqual(sorted(vectorstore.list_chunk_ids(index_path).tolist()), ids[1:])
+
+    def test_legacy_index_is_migrated_offline_not_in_request(self):
+        from rag.services import RagError, retrieve_contexts
+
+        from .consistency import run_consistency_check
+
+        with tempfile.TemporaryDirectory() as faiss_dir:
+            kb, _, texts, ids = self._kb_with_chunks(faiss_dir, 3)
+            faiss = vectorstore._faiss()
+            legacy = faiss.IndexFlatL2(8)
+            legacy.add(vectorstore.embed_texts(texts))
+            faiss.write_index(legacy, kb.faiss_path)
+
+            with self.assertRaises(RagError) as ctx:
+                retrieve_contexts(kb, texts[1], top_k=1)
+            self.assertEqual(ctx.exception.status_code, 503)
+            self.assertFalse(vectorstore.is_id_mapped(vectorstore.load_faiss_index(Path(kb.faiss_path))))
+            kb.refresh_from_db()
+            self.assertEqual((kb.index_status, kb.index_checked_at), (KnowledgeBase.INDEX_DEGRADED, None))
+
+            # worker 空闲时只处理待修复的知识库；.meta.json 缺失时按入库顺序推导 chunk id。
+            [result] = run_consistency_check(pending_only=True)
+            self.assertTrue(result.ok)
+            self.assertIn("legacy_index", result.repaired)
+            self.assertEqual(run_consistency_check(pending_only=True), [])
+            kb.refresh_from_db()
+            self.assertEqual(kb.index_status, KnowledgeBase.INDEX_OK)
+            self.assertEqual(retrieve_contexts(kb, texts[1], top_k=1), [texts[1]])
+
+    def test_legacy_index_is_served_read_only_until_migrated(self):
+        from rag.services import retrieve_contexts
+
+        from .consistency import run_consistency_check
+
+        with tempfile.TemporaryDirectory() as faiss_dir:
+            kb, _, texts, ids = self._kb_with_chunks(faiss_dir, 3)
+            index_path = Path(kb.faiss_path)
+            faiss = vectorstore._faiss()
+            legacy = faiss.IndexFlatL2(8)
+            legacy.add(vectorstore.embed_texts(texts))
+            faiss.write_index(legacy, kb.faiss_path)
+            vectorstore._meta_path(index_path).write_text(json.dumps(ids), encoding="utf-8")
+
+            # 有 .meta.json 映射时请求内照常检索，只标记待迁移，不改动索引文件。
+            self.assertEqual(retrieve_contexts(kb, texts[1], top_k=1), [texts[1]])
+            self.assertFalse(vectorstore.is_id_mapped(vectorstore.load_faiss_index(index_path)))
+            kb.refresh_from_db()
+            self.assertEqual((kb.index_status, kb.index_issue), (KnowledgeBase.INDEX_DEGRADED, "legacy_index"))
+
+            [result] = run_consistency_check(pending_only=True)
+            self.assertIn("legacy_index", result.repaired)
+            kb.refresh_from_db()
+            self.assertEqual(kb.index_status, KnowledgeBase.INDEX_OK)
+            self.assertEqual(retrieve_contexts(kb, texts[2], top_k=1), [texts[2]])
+
+    def test_kb_with_active_ingestion_is_skipped(self):
+        from .consistency import run_consistency_check
+        from .models import IngestionJob
+
+        with tempfile.TemporaryDirectory() as faiss_dir:
+            kb, _, _, _ = self._kb_with_chunks(faiss_dir, 2)
+            IngestionJob.objects.create(kb=kb, user=self.user, filename="b.txt", file_path="/tmp/b.txt")
+            [result] = run_consistency_check()
+            self.assertTrue(result.skipped)
+            self.assertFalse(Path(kb.faiss_path).exists())
@@ -8,12 +8,14 @@ from .views import (
     KnowledgeBaseUploadView,
     DocumentDeleteView,
     DocumentPreviewView,
+    IngestionJobStatusView,
 )
 
 urlpatterns = [
     path("create", KnowledgeBaseCreateView.as_view(), name="kb-create"),
     path("list", KnowledgeBaseListView.as_view(), name="kb-list"),
     path("upload", KnowledgeBaseUploadView.as_view(), name="kb-upload"),
+    path("jobs/<int:job_id>", IngestionJobStatusView.as_view(), name="kb-ingestion-job"),
     path("<int:kb_id>/documents", KnowledgeBaseDocumentsView.as_view(), name="kb-documents"),
     path("<int:kb_id>", KnowledgeBaseDeleteView.as_view(), name="kb-delete"),
     path("document/<int:doc_id>", DocumentDeleteView.as_view(), name="document-delete"),
@@ -3,22 +3,90 @@ from __future__ import annotations
 """
 文档入库向量化与 FAISS 索引读写。
 
+- chunk_text / iter_chunk_text：按字符窗口分块（后者逐段消费文本、流式产出）
 - embed_texts：统一向量化入口（支持 openai / fake 两种后端）
-- add_vectors_to_index：追加写入向量
-- rebuild_index：按文本集合重建索引（用于删除文档后的同步）
+- embed_chunk_texts：入库向量化入口，openai 后端下经过内容寻址的 embedding 缓存
+- add_vectors_to_index / add_embedded_vectors_to_index：向量化并追加写入 / 追加写入已向量化的 chunk
+- remove_vectors_from_index：按 chunk id 原地删除向量（删除文档时无需重新向量化）
+- rebuild_index：按文本集合重建索引（已持久化的 chunk 向量直接复用，仅对缺失部分向量化）
+- backfill_lexical_index / backfill_chunk_texts：为旧知识库补建 BM25 词法索引 / chunk 文本文件
+- rebuild_index_from_vectors：仅用已持久化的 chunk 向量重建索引（零 API 调用）
+- migrate_legacy_index：将旧版 IndexFlatL2 + .meta.json 索引迁移为按 chunk id 寻址的索引
+- migrate_index_tier / schedule_index_tier_migration：知识库规模跨过阈值或配置变化时切换索引类型 / 向量编码
+- search_index：按知识库配置检索主索引与全部增量段并合并 top-k；压缩索引用持久化的 float32 向量对候选做精确重排；
+  旧版索引在迁移前经 .meta.json 映射只读检索
+- normalize_vectors / cosine_similarities：向量单位化 / 按持久化向量计算问题与 chunk 的余弦相似度
+- compact_segments / schedule_segment_compaction：把增量段合并回主索引
+
+索引统一为 IndexIDMap2 包装，FAISS 内部 id 即 DocumentChunk.id，检索结果可直接回表。
+写入索引与检索的向量都先单位化：单位向量的 L2 距离平方 = 2 - 2·cos，按 L2 检索与按内积（余弦）检索的排序一致，
+flat / ivf / hnsw 与各种压缩编码沿用同一度量，已有索引无需更换类型。
+索引类型由 index_factory 按规模选择，实际规格记录在 <index>.spec.json。
+向已有索引追加时只写一个小的增量段（见 segments），写入开销与知识库规模无关；
+同一知识库的写操作由进程内锁 + <index>.lock 文件锁串行化，多 worker 并发上传不会互相覆盖。
+追加 / 删除 / 重建时在同一把写锁内同步维护 BM25 词法索引（见 lexical）与 chunk 文本文件（见 chunk_texts）。
 """
 
 import os
 import json
+import logging
 import threading
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass
 from functools import lru_cache
 from pathlib import Path
-from typing import Iterable
+from typing import Iterable, Iterator
 
 import numpy as np
 from django.conf import settings
 
+from .chunk_texts import (
+    append_chunk_texts,
+    has_chunk_texts,
+    remove_chunk_text_files,
+    remove_chunk_texts,
+    save_chunk_texts,
+)
+from .chunk_vectors import (
+    append_chunk_vectors,
+    load_chunk_vectors,
+    lookup_chunk_vectors,
+    remove_chunk_vector_files,
+    remove_chunk_vectors,
+    save_chunk_vectors,
+)
+from .embedding_batcher import embed_in_batches, get_batch_config
+from .index_factory import (
+    IndexSpec,
+    build_index,
+    choose_index_spec,
+    create_index,
+    load_index_spec,
+    needs_migration,
+    remove_index_spec,
+    rerank_factor,
+    save_index_spec,
+    search_params,
+)
+from .lexical import (
+    add_lexical_documents,
+    has_lexical_index,
+    rebuild_lexical_index,
+    remove_lexical_documents,
+    remove_lexical_index,
+)
+from .lru import ByteBudgetLRU
+from .segments import (
+    list_segments,
+    next_segment_path,
+    remove_segment_files,
+    remove_segments_dir,
+    segment_max_count,
+)
+
+logger = logging.getLogger(__name__)
+
 
 @dataclass(frozen=True)
 class EmbeddingConfig:
@@ -27,6 +95,16 @@ class EmbeddingConfig:
 
 
 def chunk_text(text: str, chunk_size: int = 1000, chunk_overlap: int = 200) -> list[str]:
+    return list(iter_chunk_text([text or ""], chunk_size=chunk_size, chunk_overlap=chunk_overlap))
+
+
+def iter_chunk_text(pieces: Iterable[str], chunk_size: int = 1000, chunk_overlap: int = 200) -> Iterator[str]:
+    """
+    流式分块：逐段消费文本（如 PDF 逐页），边读边产出 chunk，结果与对拼接后的全文调用 chunk_text 一致。
+
+    只保留尚未切出的尾部文本；窗口之后还有非空白字符时才能确定这不是最后一个窗口，因此按整段全文的
+    strip 语义切分。
+    """
     if chunk_size <= 0:
         raise ValueError("chunk_size must be > 0")
     if chunk_overlap < 0:
@@ -34,23 +112,32 @@ def chunk_text(text: str, chunk_size: int = 1000, chunk_overlap: int = 200) -> l
     if chunk_overlap >= chunk_size:
         raise ValueError("chunk_overlap must be < chunk_size")
 
-    text = (text or "").strip()
-    if not text:
-        return []
-
-    chunks: list[str] = []
-    start = 0
-    while start < len(text):
-        end = min(len(text), start + chunk_size)
-        chunk = text[start:end].strip()
-        if chunk:
-            chunks.append(chunk)
-        start = end - chunk_overlap
-        if start < 0:
-            start = 0
-        if end == len(text):
-            break
-    return chunks
+    step = chunk_size - chunk_overlap
+    buf = ""
+    started = False
+    for piece in pieces:
+        if not piece:
+            continue
+        if not started:
+            # 全文开头的空白不参与切分（等价于 text.strip()）。
+            piece = piece.lstrip()
+            if not piece:
+                continue
+            started = True
+        buf += piece
+        last = len(buf.rstrip())
+        pos = 0
+        while last > pos + chunk_size:
+            chunk = buf[pos : pos + chunk_size].strip()
+            if chunk:
+                yield chunk
+            pos += step
+        if pos:
+            buf = buf[pos:]
+
+    tail = buf.rstrip().strip()
+    if tail:
+        yield tail
 
 
 def _get_embedding_config() -> EmbeddingConfig:
@@ -78,6 +165,40 @@ def embed_texts(texts: list[str]) -> np.ndarray:
     return embed_texts_langchain_openai(texts)
 
 
+def get_embedding_cache():
+    # 入库 embedding 缓存：fake 后端（向量依赖进程内 hash）或容量配置为 0 时关闭。
+    backend = (os.getenv("KB_EMBEDDING_BACKEND", "") or "openai").lower()
+    if backend == "fake":
+        return None
+    size_mb = int(getattr(settings, "KB_EMBEDDING_CACHE_SIZE_MB", 0) or 0)
+    directory = getattr(settings, "KB_EMBEDDING_CACHE_DIR", None)
+    if size_mb <= 0 or not directory:
+        return None
+    return _open_embedding_cache(str(directory), size_mb * 1024 * 1024)
+
+
+@lru_cache(maxsize=4)
+def _open_embedding_cache(directory: str, size_limit_bytes: int):
+    from .embedding_cache import EmbeddingCache
+
+    return EmbeddingCache(Path(directory), size_limit_bytes)
+
+
+def embedding_cache_stats() -> dict:
+    cache = get_embedding_cache()
+    if cache is None:
+        return {"enabled": False}
+    return cache.stats()
+
+
+def embed_chunk_texts(texts: list[str]) -> np.ndarray:
+    # 入库/重建索引使用：相同 (模型, 文本) 只调用一次 embedding API。
+    cache = get_embedding_cache()
+    if cache is None:
+        return embed_texts(texts)
+    return cache.get_or_embed(_get_embedding_config().model, texts, embed_texts)
+
+
 def embed_texts_langchain_openai(texts: list[str]) -> np.ndarray:
     api_key = os.getenv("OPENAI_API_KEY", "") or os.getenv("DASHSCOPE_API_KEY", "")
     if not api_key:
@@ -88,8 +209,8 @@ def embed_texts_langchain_openai(texts: list[str]) -> np.ndarray:
         raise RuntimeError("OPENAI_EMBEDDING_MODEL 未配置")
 
     embeddings = _get_openai_embeddings(cfg.model, cfg.base_url, api_key)
-    vectors = embeddings.embed_documents(texts)
-    return np.asarray(vectors, dtype=np.float32)
+    # 按服务商的条数 / token 上限分批并发请求，结果保持输入顺序。
+    return embed_in_batches(texts, embeddings.embed_documents, get_batch_config(cfg.base_url))
 
 
 @lru_cache(maxsize=4)
@@ -108,133 +229,776 @@ def _faiss():
     return faiss
 
 
-_INDEX_CACHE_LOCK = threading.Lock()
-_INDEX_CACHE: dict[str, tuple[float, object]] = {}
+# 进程内索引 / 旧版 meta 缓存：按估算的常驻字节数做 LRU 淘汰，预算见 KB_INDEX_CACHE_MB / KB_META_CACHE_MB。
+_INDEX_CACHE = ByteBudgetLRU(0)
+_META_CACHE = ByteBudgetLRU(0)
+
+# IndexIDMap2 加载后在内存中重建的反向映射（id -> 位置）每条约占的字节数。
+_REV_MAP_BYTES_PER_ID = 40
+
+
+def _budget_bytes(name: str, default_mb: int) -> int:
+    return max(0, int(getattr(settings, name, default_mb))) * 1024 * 1024
+
+
+def _index_cache() -> ByteBudgetLRU:
+    budget = _budget_bytes("KB_INDEX_CACHE_MB", 1024)
+    if _INDEX_CACHE.max_bytes != budget:
+        _INDEX_CACHE.resize(budget)
+    return _INDEX_CACHE
+
+
+def _meta_cache() -> ByteBudgetLRU:
+    budget = _budget_bytes("KB_META_CACHE_MB", 64)
+    if _META_CACHE.max_bytes != budget:
+        _META_CACHE.resize(budget)
+    return _META_CACHE
+
 
-_META_CACHE_LOCK = threading.Lock()
-_META_CACHE: dict[str, tuple[float, list[int]]] = {}
+def _index_footprint(index, file_size: int, mmapped: bool) -> int:
+    """
+    估算缓存中一个索引占用的进程私有内存。
+
+    堆内加载时约等于序列化大小；mmap 加载时向量编码（IVF 还包括倒排表中的 id）位于共享页缓存，
+    只计入其余部分（聚类中心、HNSW 图、id 映射）。两者都加上 IndexIDMap2 的反向映射。
+    """
+    ntotal = int(getattr(index, "ntotal", 0))
+    footprint = int(file_size)
+    if mmapped:
+        try:
+            faiss = _faiss()
+            inner = faiss.downcast_index(index.index) if hasattr(index, "index") else index
+            storage = faiss.downcast_index(inner.storage) if hasattr(inner, "storage") else inner
+            code_size = int(getattr(storage, "code_size", 0))
+            mapped = ntotal * code_size
+            if hasattr(inner, "invlists"):
+                mapped += ntotal * 8
+            footprint = max(0, footprint - mapped)
+        except Exception:
+            pass
+    return footprint + ntotal * _REV_MAP_BYTES_PER_ID
+
+
+def index_cache_stats() -> dict:
+    return {"index": _index_cache().stats(), "meta": _meta_cache().stats()}
 
 
 def _meta_path(index_path: Path) -> Path:
     return index_path.with_name(f"{index_path.name}.meta.json")
 
 
-def load_faiss_index(index_path: Path):
+def _file_stamp(path: Path) -> tuple[int, int, int]:
+    # 原子替换会更换 inode，配合纳秒 mtime 与大小判断文件是否变化。
+    st = path.stat()
+    return int(st.st_ino), int(st.st_mtime_ns), int(st.st_size)
+
+
+def _index_mmap_enabled() -> bool:
+    return bool(getattr(settings, "KB_INDEX_MMAP", False))
+
+
+def _read_index_mmap(index_path: Path):
+    """
+    只读 mmap 方式加载：向量编码由操作系统按需换页，多个 worker 进程共享同一份物理内存。
+
+    IVF 使用 IO_FLAG_MMAP（倒排表映射为 OnDiskInvertedLists）；flat / SQ / PQ / HNSW 的编码
+    使用 IO_FLAG_MMAP_IFC。当前 FAISS 版本不支持时退回普通加载。
+    """
+    from .index_factory import load_index_spec
+
     faiss = _faiss()
+    read_only = int(getattr(faiss, "IO_FLAG_READ_ONLY", 0))
+    flags: list[int] = []
+    ifc = getattr(faiss, "IO_FLAG_MMAP_IFC", None)
+    mmap = getattr(faiss, "IO_FLAG_MMAP", None)
+    if load_index_spec(index_path).kind == "ivf":
+        flags = [f for f in (mmap, ifc) if f is not None]
+    else:
+        flags = [f for f in (ifc, mmap) if f is not None]
+    for flag in flags:
+        try:
+            return faiss.read_index(str(index_path), int(flag) | read_only)
+        except Exception:
+            continue
+    return faiss.read_index(str(index_path))
+
+
+def load_faiss_index(index_path: Path):
+    # 检索用的共享只读索引；写操作请使用 _load_index_for_write 取得私有副本。
     if not index_path.exists() or index_path.stat().st_size == 0:
         return None
     key = str(index_path.resolve())
-    mtime = float(index_path.stat().st_mtime)
-    with _INDEX_CACHE_LOCK:
-        cached = _INDEX_CACHE.get(key)
-        if cached and cached[0] == mtime:
-            return cached[1]
+    stamp = _file_stamp(index_path)
+    cache = _index_cache()
+    cached = cache.get(key, stamp)
+    if cached is not None:
+        return cached
     try:
-        index = faiss.read_index(str(index_path))
-        with _INDEX_CACHE_LOCK:
-            _INDEX_CACHE[key] = (mtime, index)
+        mmapped = _index_mmap_enabled()
+        if mmapped:
+            index = _read_index_mmap(index_path)
+        else:
+            index = _faiss().read_index(str(index_path))
+        cache.put(key, index, _index_footprint(index, stamp[2], mmapped), stamp)
         return index
     except Exception:
         return None
 
 
+def _load_index_for_write(index_path: Path):
+    # 写路径读取私有的堆内副本：mmap 只读索引不可修改，也不能影响正在检索的共享对象。
+    if not index_path.exists() or index_path.stat().st_size == 0:
+        return None
+    try:
+        return _faiss().read_index(str(index_path))
+    except Exception:
+        return None
+
+
 def save_faiss_index(index, index_path: Path) -> None:
     faiss = _faiss()
     index_path.parent.mkdir(parents=True, exist_ok=True)
-    faiss.write_index(index, str(index_path))
+    # 先写临时文件再原子替换：后台迁移或并发读取不会看到写了一半的索引；
+    # 已 mmap 旧文件的读者仍持有旧 inode，不受影响。
+    tmp = index_path.with_name(f"{index_path.name}.tmp")
+    faiss.write_index(index, str(tmp))
+    os.replace(str(tmp), str(index_path))
+    key = str(index_path.resolve())
+    cache = _index_cache()
+    if _index_mmap_enabled():
+        # mmap 模式下丢弃缓存，下次检索重新映射新文件（而不是保留这份私有堆内副本）。
+        cache.pop(key)
+    else:
+        stamp = _file_stamp(index_path)
+        cache.put(key, index, _index_footprint(index, stamp[2], False), stamp)
 
 
-def load_faiss_meta(index_path: Path) -> list[int] | None:
+def load_faiss_meta(index_path: Path) -> np.ndarray | None:
+    # 仅用于读取旧版 .meta.json（位置 -> chunk id），新索引的 id 已内嵌在 IndexIDMap2 中。
+    # 返回只读 int64 数组，缓存命中时零拷贝。
     mp = _meta_path(index_path)
     if not mp.exists() or mp.stat().st_size == 0:
         return None
     key = str(mp.resolve())
-    mtime = float(mp.stat().st_mtime)
-    with _META_CACHE_LOCK:
-        cached = _META_CACHE.get(key)
-        if cached and cached[0] == mtime:
-            return list(cached[1])
+    stamp = _file_stamp(mp)
+    cache = _meta_cache()
+    cached = cache.get(key, stamp)
+    if cached is not None:
+        return cached
     try:
         data = json.loads(mp.read_text(encoding="utf-8"))
         if not isinstance(data, list):
             return None
-        ids = [int(x) for x in data]
-        with _META_CACHE_LOCK:
-            _META_CACHE[key] = (mtime, ids)
-        return list(ids)
+        ids = np.asarray([int(x) for x in data], dtype=np.int64)
+        ids.setflags(write=False)
+        cache.put(key, ids, int(ids.nbytes), stamp)
+        return ids
     except Exception:
         return None
 
 
-def save_faiss_meta(index_path: Path, chunk_ids: list[int]) -> None:
+def legacy_id_map(index_path: Path, index) -> np.ndarray | None:
+    # 旧版索引的位置 -> chunk id 映射；.meta.json 缺失或与向量数不一致（无法可靠映射）时返回 None。
+    ids = load_faiss_meta(index_path)
+    if ids is None or len(ids) != int(index.ntotal):
+        return None
+    return ids
+
+
+def _remove_faiss_meta(index_path: Path) -> None:
     mp = _meta_path(index_path)
-    mp.parent.mkdir(parents=True, exist_ok=True)
-    tmp = mp.with_name(f"{mp.name}.tmp")
-    tmp.write_text(json.dumps([int(x) for x in chunk_ids], ensure_ascii=False), encoding="utf-8")
-    os.replace(str(tmp), str(mp))
-    key = str(mp.resolve())
-    mtime = float(mp.stat().st_mtime)
-    with _META_CACHE_LOCK:
-        _META_CACHE[key] = (mtime, list(chunk_ids))
+    try:
+        mp.unlink()
+    except FileNotFoundError:
+        pass
+    _meta_cache().pop(str(mp.resolve()))
+
+
+def _new_index(dim: int):
+    return create_index(IndexSpec(), dim)
+
+
+_WRITE_LOCKS_GUARD = threading.Lock()
+_WRITE_LOCKS: dict[str, tuple[threading.RLock, object]] = {}
+
+
+def _lock_path(index_path: Path) -> Path:
+    return index_path.with_name(f"{index_path.name}.lock")
+
+
+@contextmanager
+def _write_lock(index_path: Path):
+    # 同一索引的写操作（追加、删除、重建、迁移、合并段）串行执行：
+    # 进程内用 RLock，跨进程（多个 gunicorn worker / 管理命令）用文件锁，两者均可重入。
+    from filelock import FileLock
+
+    key = str(index_path.resolve())
+    with _WRITE_LOCKS_GUARD:
+        locks = _WRITE_LOCKS.get(key)
+        if locks is None:
+            index_path.parent.mkdir(parents=True, exist_ok=True)
+            locks = (threading.RLock(), FileLock(str(_lock_path(index_path)), thread_local=False))
+            _WRITE_LOCKS[key] = locks
+    with locks[0], locks[1]:
+        yield
+
+
+def is_id_mapped(index) -> bool:
+    faiss = _faiss()
+    return isinstance(index, faiss.IndexIDMap)
+
+
+def _as_id_array(chunk_ids: Iterable[int]) -> np.ndarray:
+    return np.asarray([int(x) for x in chunk_ids], dtype=np.int64)
 
 
-def add_vectors_to_index(index_path: Path, texts: list[str], chunk_ids: list[int] | None = None) -> int:
+def migrate_legacy_index(index_path: Path, fallback_ids: Iterable[int] | None = None) -> bool:
+    """
+    将旧版索引（IndexFlatL2，位置与 chunk id 的对应关系存放在 .meta.json）原地迁移为 IndexIDMap2。
+
+    向量直接从旧索引 reconstruct 出来并单位化，不会调用 embedding。.meta.json 缺失或长度不符时使用
+    fallback_ids（通常为按 document_id, chunk_index 排序的 chunk id）。已是新格式时返回 False。
+    """
+    index = load_faiss_index(index_path)
+    if index is None or is_id_mapped(index):
+        return False
+
+    ntotal = int(index.ntotal)
+    ids = load_faiss_meta(index_path)
+    if ids is None or len(ids) != ntotal:
+        ids = _as_id_array(fallback_ids) if fallback_ids is not None else None
+    if ids is None or len(ids) != ntotal:
+        raise ValueError(f"无法确定旧索引的 chunk id 映射：{index_path}")
+
+    migrated = _new_index(int(index.d))
+    vectors = np.zeros((0, int(index.d)), dtype=np.float32)
+    if ntotal:
+        vectors = normalize_vectors(index.reconstruct_n(0, ntotal))
+        migrated.add_with_ids(vectors, np.ascontiguousarray(ids, dtype=np.int64))
+    save_faiss_index(migrated, index_path)
+    save_index_spec(index_path, IndexSpec())
+    save_chunk_vectors(index_path, ids, vectors)
+    _remove_faiss_meta(index_path)
+    return True
+
+
+def backfill_chunk_vectors(index_path: Path) -> bool:
+    # 为尚无向量旁路文件的索引补齐：从 IndexIDMap2(IndexFlatL2) 中 reconstruct，不调用 embedding。
+    if load_chunk_vectors(index_path) is not None:
+        return False
+    index = load_faiss_index(index_path)
+    if index is None or not is_id_mapped(index) or load_index_spec(index_path).kind != "flat":
+        return False
+    faiss = _faiss()
+    ntotal = int(index.ntotal)
+    ids = faiss.vector_to_array(index.id_map).astype(np.int64)
+    vectors = np.zeros((0, int(index.d)), dtype=np.float32)
+    if ntotal:
+        vectors = np.asarray(index.index.reconstruct_n(0, ntotal), dtype=np.float32)
+    save_chunk_vectors(index_path, ids, vectors)
+    return True
+
+
+def backfill_lexical_index(index_path: Path, rows: Iterable[tuple[int, str]]) -> bool:
+    # 为早于混合检索的知识库补建 BM25 索引（rows 为 (chunk_id, text)，旧版 JSON 格式同样按数据库内容重建）；
+    # 已存在或索引不存在时返回 False。
+    if has_lexical_index(index_path) or load_faiss_index(index_path) is None:
+        return False
+    with _write_lock(index_path):
+        if has_lexical_index(index_path):
+            return False
+        pairs = [(int(cid), t or "") for cid, t in rows if (t or "").strip()]
+        rebuild_lexical_index(index_path, [cid for cid, _ in pairs], [t for _, t in pairs])
+    return True
+
+
+def backfill_chunk_texts(index_path: Path, rows: Iterable[tuple[int, str]]) -> bool:
+    # 按数据库内容补建 chunk 文本文件（rows 为 (chunk_id, text)）；已存在或索引不存在时返回 False。
+    if has_chunk_texts(index_path) or load_faiss_index(index_path) is None:
+        return False
+    with _write_lock(index_path):
+        if has_chunk_texts(index_path):
+            return False
+        pairs = [(int(cid), t or "") for cid, t in rows if (t or "").strip()]
+        save_chunk_texts(index_path, [cid for cid, _ in pairs], [t for _, t in pairs])
+    return True
+
+
+def _save_built_index(index_path: Path, index, spec: IndexSpec) -> None:
+    # 整体构建的索引已包含全部向量，原有增量段随之作废。
+    save_faiss_index(index, index_path)
+    save_index_spec(index_path, spec)
+    _drop_segments(index_path, list_segments(index_path))
+
+
+def _drop_segments(index_path: Path, paths: list[Path]) -> None:
+    remove_segment_files(paths)
+    cache = _index_cache()
+    for p in paths:
+        cache.pop(str(p.resolve()))
+
+
+def normalize_vectors(vectors: np.ndarray) -> np.ndarray:
+    # 按行单位化（返回新的 float32 数组）；零向量保持不变。
+    out = np.array(vectors, dtype=np.float32, copy=True, order="C")
+    if out.ndim != 2 or out.size == 0:
+        return out
+    norms = np.linalg.norm(out, axis=1, keepdims=True)
+    np.divide(out, norms, out=out, where=norms > 0)
+    return out
+
+
+def cosine_similarities(index_path: Path, q_vec: np.ndarray, chunk_ids: Iterable[int]) -> dict[int, float]:
+    # 用持久化的 float32 向量精确计算余弦相似度（不受压缩编码与缓存影响）；缺少向量的 chunk 不出现在结果中。
+    q = normalize_vectors(np.asarray(q_vec, dtype=np.float32).reshape(1, -1))[0]
+    out: dict[int, float] = {}
+    for cid, vec in lookup_chunk_vectors(index_path, list(chunk_ids)).items():
+        if int(vec.shape[0]) != int(q.shape[0]):
+            continue
+        norm = float(np.linalg.norm(vec))
+        out[int(cid)] = float(np.dot(vec, q) / norm) if norm > 0 else 0.0
+    return out
+
+
+def add_vectors_to_index(
+    index_path: Path,
+    texts: list[str],
+    chunk_ids: list[int] | None = None,
+    config: dict | None = None,
+) -> int:
     if not texts:
         return 0
-    vectors = embed_texts(texts)
+    return add_embedded_vectors_to_index(
+        index_path, embed_chunk_texts(texts), chunk_ids=chunk_ids, config=config, texts=texts
+    )
+
+
+def add_embedded_vectors_to_index(
+    index_path: Path,
+    vectors: np.ndarray,
+    chunk_ids: list[int] | None = None,
+    config: dict | None = None,
+    texts: list[str] | None = None,
+) -> int:
+    # 写入已向量化的 chunk（入库任务分阶段执行时先向量化、再写索引）；传入 texts 时同步写入 BM25 索引与 chunk 文本文件。
+    vectors = normalize_vectors(vectors)
+    if vectors.ndim != 2 or int(vectors.shape[0]) == 0:
+        return 0
     dim = int(vectors.shape[1])
 
-    index = load_faiss_index(index_path)
-    if index is None or int(index.d) != dim:
-        faiss = _faiss()
-        index = faiss.IndexFlatL2(dim)
-
-    index.add(vectors)
-    save_faiss_index(index, index_path)
-    if chunk_ids is not None:
-        existing = load_faiss_meta(index_path) or []
-        existing.extend([int(x) for x in chunk_ids])
-        save_faiss_meta(index_path, existing)
+    with _write_lock(index_path):
+        # 只读共享索引即可判断格式与维度，追加路径不再整库读入内存。
+        index = load_faiss_index(index_path)
+        if index is not None and not is_id_mapped(index):
+            migrate_legacy_index(index_path)
+            index = load_faiss_index(index_path)
+        if index is not None and int(index.d) != dim:
+            # embedding 维度变化：旧索引与旧向量都不可再用。
+            index = None
+            remove_chunk_vector_files(index_path)
+
+        if chunk_ids is None:
+            start = count_vectors(index_path) if index is not None else 0
+            chunk_ids = list(range(start, start + int(vectors.shape[0])))
+        if len(chunk_ids) != int(vectors.shape[0]):
+            raise ValueError("chunk_ids 与文本数量不一致")
+
+        ids = _as_id_array(chunk_ids)
+        if index is None:
+            # 首次写入直接按本批规模选择索引类型。
+            spec = choose_index_spec(int(ids.shape[0]), config)
+            _save_built_index(index_path, build_index(spec, ids, vectors), spec)
+        else:
+            # 已有索引：本批向量写成一个不可变的增量段，主索引文件保持不动。
+            save_faiss_index(build_index(IndexSpec(), ids, vectors), next_segment_path(index_path))
+        append_chunk_vectors(index_path, ids, vectors)
+        if texts is not None:
+            add_lexical_documents(index_path, ids.tolist(), texts)
+            append_chunk_texts(index_path, ids.tolist(), texts)
+        ntotal = count_vectors(index_path)
+
+    if schedule_segment_compaction(index_path, config) is None:
+        schedule_index_tier_migration(index_path, config, ntotal=ntotal)
     return int(vectors.shape[0])
 
 
-def rebuild_index(index_path: Path, texts: Iterable[str], chunk_ids: Iterable[int] | None = None) -> int:
+def remove_vectors_from_index(index_path: Path, chunk_ids: Iterable[int], config: dict | None = None) -> int:
+    # 按 chunk id 原地删除向量并回写索引：删除文档不再触发整库重新向量化。
+    ids = _as_id_array(chunk_ids)
+    if ids.size == 0:
+        return 0
+    with _write_lock(index_path):
+        index = _load_index_for_write(index_path)
+        if index is None:
+            return 0
+        if not is_id_mapped(index):
+            migrate_legacy_index(index_path)
+            index = _load_index_for_write(index_path)
+        kind = load_index_spec(index_path).kind
+        if kind in ("hnsw", "ivf"):
+            # HNSW 不支持按 id 删除；IVF 经 IndexIDMap2 包装后 remove_ids 只压缩 id_map、不动倒排表中的位置，
+            # 删除后 id 会整体错位。两者都从持久化向量中剔除后离线重建（同时吸收全部增量段），IVF 复用已训练的聚类中心。
+            removed = remove_chunk_vectors(index_path, ids)
+            if removed:
+                rebuild_index_from_vectors(index_path, config, trained=index if kind == "ivf" else None)
+        else:
+            removed = int(index.remove_ids(ids))
+            if removed:
+                save_faiss_index(index, index_path)
+            removed += _remove_ids_from_segments(index_path, ids)
+            remove_chunk_vectors(index_path, ids)
+        remove_lexical_documents(index_path, ids.tolist())
+        remove_chunk_texts(index_path, ids)
+        ntotal = count_vectors(index_path)
+
+    schedule_index_tier_migration(index_path, config, ntotal=ntotal)
+    return removed
+
+
+def _remove_ids_from_segments(index_path: Path, ids: np.ndarray) -> int:
+    # 段文件很小，命中时直接重写；删空的段整个移除。
+    removed = 0
+    for seg_path in list_segments(index_path):
+        seg = _load_index_for_write(seg_path)
+        if seg is None:
+            continue
+        n = int(seg.remove_ids(ids))
+        if not n:
+            continue
+        removed += n
+        if int(seg.ntotal) == 0:
+            _drop_segments(index_path, [seg_path])
+        else:
+            save_faiss_index(seg, seg_path)
+    return removed
+
+
+def rebuild_index(
+    index_path: Path,
+    texts: Iterable[str],
+    chunk_ids: Iterable[int] | None = None,
+    config: dict | None = None,
+) -> int:
     texts_list: list[str] = []
     ids_list: list[int] = []
     if chunk_ids is None:
         texts_list = [t for t in texts if (t or "").strip()]
+        ids_list = list(range(len(texts_list)))
     else:
         for cid, t in zip(chunk_ids, texts):
             if (t or "").strip():
                 texts_list.append(t)
                 ids_list.append(int(cid))
-    if not texts_list:
+
+    with _write_lock(index_path):
+        _remove_faiss_meta(index_path)
+        if not texts_list:
+            try:
+                index_path.unlink()
+            except FileNotFoundError:
+                pass
+            index_path.parent.mkdir(parents=True, exist_ok=True)
+            index_path.open("wb").close()
+            remove_chunk_vector_files(index_path)
+            remove_index_spec(index_path)
+            _drop_segments(index_path, list_segments(index_path))
+            rebuild_lexical_index(index_path, [], [])
+            save_chunk_texts(index_path, [], [])
+            return 0
+
+        # 已持久化的 chunk 向量直接复用，只对缺失的 chunk 调用 embedding。
+        stored = lookup_chunk_vectors(index_path, ids_list) if chunk_ids is not None else {}
+        missing = [i for i, cid in enumerate(ids_list) if cid not in stored]
+        embedded = embed_chunk_texts([texts_list[i] for i in missing]) if missing else None
+        dim = int(embedded.shape[1]) if embedded is not None else int(next(iter(stored.values())).shape[0])
+        if any(int(v.shape[0]) != dim for v in stored.values()):
+            # 已存向量维度与当前 embedding 不一致（模型已更换）：全部重新向量化。
+            missing = list(range(len(ids_list)))
+            embedded = embed_chunk_texts(texts_list)
+            dim = int(embedded.shape[1])
+
+        vectors = np.empty((len(ids_list), dim), dtype=np.float32)
+        for i, cid in enumerate(ids_list):
+            if cid in stored:
+                vectors[i] = stored[cid]
+        if embedded is not None:
+            vectors[missing] = embedded
+        # 旧版本写入的未单位化向量在重建时一并单位化。
+        vectors = normalize_vectors(vectors)
+
+        ids = _as_id_array(ids_list)
+        spec = choose_index_spec(int(ids.shape[0]), config)
+        _save_built_index(index_path, build_index(spec, ids, vectors), spec)
+        save_chunk_vectors(index_path, ids, vectors)
+        rebuild_lexical_index(index_path, ids_list, texts_list)
+        save_chunk_texts(index_path, ids_list, texts_list)
+        return int(vectors.shape[0])
+
+
+def rebuild_index_from_vectors(
+    index_path: Path, config: dict | None = None, spec: IndexSpec | None = None, trained=None
+) -> int:
+    # 仅用持久化的 chunk 向量重建索引（压缩、切换索引类型等），不调用 embedding API。
+    # trained 为当前已训练的索引：重建后规格不变时复用其训练结果，规格变化则重新训练。
+    with _write_lock(index_path):
+        stored = load_chunk_vectors(index_path, mmap=True)
+        if stored is None:
+            raise ValueError(f"缺少 chunk 向量文件，无法离线重建：{index_path}")
+        ids, vectors = stored
+        current = load_index_spec(index_path)
+        if spec is None:
+            spec = choose_index_spec(int(ids.shape[0]), config, current=current)
+        if spec != current:
+            trained = None
+        _save_built_index(index_path, build_index(spec, ids, normalize_vectors(vectors), trained=trained), spec)
+        return int(ids.shape[0])
+
+
+def migrate_index_tier(index_path: Path, config: dict | None = None) -> bool:
+    """
+    知识库规模跨过分级阈值时，用持久化向量重建为目标类型的索引（flat <-> ivf / hnsw）。
+    无需迁移或缺少向量文件时返回 False。
+    """
+    with _write_lock(index_path):
+        index = load_faiss_index(index_path)
+        if index is None or not is_id_mapped(index):
+            return False
+        current = load_index_spec(index_path)
+        target = choose_index_spec(count_vectors(index_path), config, current=current)
+        if not needs_migration(current, target):
+            return False
+        backfill_chunk_vectors(index_path)
+        if load_chunk_vectors(index_path) is None:
+            return False
+        rebuild_index_from_vectors(index_path, config, spec=target)
+    logger.info("faiss index %s migrated %s -> %s", index_path, current.kind, target.kind)
+    return True
+
+
+_BACKGROUND_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="kb-index-maint")
+_BACKGROUND_PENDING_LOCK = threading.Lock()
+_BACKGROUND_PENDING: dict[str, Future] = {}
+
+
+def _submit_background(key: str, name: str, fn) -> Future:
+    # 同一索引的同类后台任务只排队一个；KB_INDEX_MIGRATE_ASYNC=False 时在当前线程同步执行。
+    def run():
         try:
-            index_path.unlink()
-        except FileNotFoundError:
-            pass
-        index_path.parent.mkdir(parents=True, exist_ok=True)
-        index_path.open("wb").close()
-        mp = _meta_path(index_path)
+            return fn()
+        except Exception:
+            logger.exception("faiss index %s failed: %s", name, key)
+            return False
+
+    if not getattr(settings, "KB_INDEX_MIGRATE_ASYNC", True):
+        future: Future = Future()
+        future.set_result(run())
+        return future
+
+    pending_key = f"{name}:{key}"
+    with _BACKGROUND_PENDING_LOCK:
+        pending = _BACKGROUND_PENDING.get(pending_key)
+        if pending is not None and not pending.done():
+            return pending
+        future = _BACKGROUND_EXECUTOR.submit(run)
+        _BACKGROUND_PENDING[pending_key] = future
+    future.add_done_callback(lambda f: _forget_background_future(pending_key, f))
+    return future
+
+
+def _forget_background_future(key: str, future: Future) -> None:
+    with _BACKGROUND_PENDING_LOCK:
+        if _BACKGROUND_PENDING.get(key) is future:
+            _BACKGROUND_PENDING.pop(key, None)
+
+
+def schedule_index_tier_migration(
+    index_path: Path, config: dict | None = None, ntotal: int | None = None
+) -> Future | None:
+    # 写入后检查是否跨过分级阈值；需要迁移时交给后台线程，不阻塞上传/删除请求。
+    if ntotal is None:
+        ntotal = count_vectors(index_path)
+    current = load_index_spec(index_path)
+    if not needs_migration(current, choose_index_spec(ntotal, config, current=current)):
+        return None
+    return _submit_background(
+        str(index_path.resolve()), "tier migration", lambda: migrate_index_tier(index_path, config)
+    )
+
+
+def compact_segments(index_path: Path) -> int:
+    """
+    把全部增量段合并进主索引并删除段文件，返回合并的向量数。
+
+    段内向量直接从段索引 reconstruct，不读取旁路文件也不调用 embedding；主索引为 IVF / HNSW /
+    压缩索引时按其自身编码追加。合并完成前检索仍同时查询主索引与段，结果不缺失。
+    """
+    faiss = _faiss()
+    with _write_lock(index_path):
+        segs = list_segments(index_path)
+        if not segs:
+            return 0
+        base = _load_index_for_write(index_path)
+        if base is None or not is_id_mapped(base):
+            return 0
+        merged = 0
+        for seg_path in segs:
+            seg = _load_index_for_write(seg_path)
+            if seg is None or int(seg.ntotal) == 0 or int(seg.d) != int(base.d):
+                continue
+            n = int(seg.ntotal)
+            ids = faiss.vector_to_array(seg.id_map).astype(np.int64)
+            vecs = np.asarray(seg.index.reconstruct_n(0, n), dtype=np.float32)
+            base.add_with_ids(vecs, ids)
+            merged += n
+        # 先替换主索引再删除段：并发检索可能短暂看到重复的 id（合并时去重），但不会漏掉向量。
+        save_faiss_index(base, index_path)
+        _drop_segments(index_path, segs)
+    logger.info("faiss index %s compacted %d segments (%d vectors)", index_path, len(segs), merged)
+    return merged
+
+
+def schedule_segment_compaction(index_path: Path, config: dict | None = None) -> Future | None:
+    # 段数达到 KB_SEGMENT_MAX_COUNT 时后台合并，合并后顺带检查索引分级。
+    if len(list_segments(index_path)) < segment_max_count():
+        return None
+
+    def run():
+        merged = compact_segments(index_path)
+        migrate_index_tier(index_path, config)
+        return merged
+
+    return _submit_background(str(index_path.resolve()), "segment compaction", run)
+
+
+def _rerank_exact(
+    index_path: Path, q_vecs: np.ndarray, distances: np.ndarray, ids: np.ndarray, top_k: int
+) -> tuple[np.ndarray, np.ndarray]:
+    # 用 float32 原始向量重新计算候选的精确 L2 距离；旁路文件缺失的候选保留近似距离。
+    out_d = np.full((ids.shape[0], top_k), np.finfo(np.float32).max, dtype=np.float32)
+    out_i = np.full((ids.shape[0], top_k), -1, dtype=np.int64)
+    stored = lookup_chunk_vectors(index_path, {int(i) for i in ids.ravel().tolist() if int(i) >= 0})
+    for row in range(ids.shape[0]):
+        cand = [(float(d), int(i)) for d, i in zip(distances[row].tolist(), ids[row].tolist()) if int(i) >= 0]
+        scored = []
+        for approx, cid in cand:
+            vec = stored.get(cid)
+            if vec is not None and int(vec.shape[0]) == int(q_vecs.shape[1]):
+                diff = vec - q_vecs[row]
+                scored.append((float(np.dot(diff, diff)), cid))
+            else:
+                scored.append((approx, cid))
+        scored.sort()
+        for col, (d, cid) in enumerate(scored[:top_k]):
+            out_d[row, col] = d
+            out_i[row, col] = cid
+    return out_d, out_i
+
+
+def search_index(
+    index_path: Path, index, q_vecs: np.ndarray, top_k: int, config: dict | None = None
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    检索并返回 (distances, chunk_ids)，形状均为 (nq, top_k)，不足处 id 为 -1。
+
+    查询参数（nprobe / efSearch）按知识库配置逐次传入，不修改共享的索引对象；
+    压缩索引（fp16 / sq8 / pq）默认先取 top_k × rerank_factor 个候选再精确重排。
+    """
+    if not is_id_mapped(index):
+        return _search_legacy(index_path, index, q_vecs, int(top_k))
+    q_vecs = normalize_vectors(q_vecs)
+    spec = load_index_spec(index_path)
+    params = search_params(spec, config)
+    factor = rerank_factor(spec, config)
+    k = int(top_k) * factor
+    distances, ids = index.search(q_vecs, k, params=params)
+    if factor > 1:
+        distances, ids = _rerank_exact(index_path, q_vecs, distances, ids, int(top_k))
+
+    parts = [(distances, ids)]
+    for seg_path in list_segments(index_path):
+        seg = load_faiss_index(seg_path)
+        if seg is None or int(seg.ntotal) == 0 or int(seg.d) != int(q_vecs.shape[1]):
+            continue
+        parts.append(seg.search(q_vecs, min(int(top_k), int(seg.ntotal))))
+    if len(parts) == 1:
+        return distances, ids
+    return _merge_topk(parts, int(top_k))
+
+
+def _search_legacy(index_path: Path, index, q_vecs: np.ndarray, top_k: int) -> tuple[np.ndarray, np.ndarray]:
+    # 旧版索引迁移前只读检索：向量写入时未单位化，问题向量同样保持原样；位置经缓存的 .meta.json 转为 chunk id。
+    ids = legacy_id_map(index_path, index)
+    if ids is None:
+        raise ValueError(f"无法确定旧索引的 chunk id 映射：{index_path}")
+    distances, pos = index.search(np.ascontiguousarray(q_vecs, dtype=np.float32), top_k)
+    return distances, np.where(pos >= 0, ids[np.maximum(pos, 0)], -1)
+
+
+def _merge_topk(parts: list[tuple[np.ndarray, np.ndarray]], top_k: int) -> tuple[np.ndarray, np.ndarray]:
+    # 合并主索引与各段的结果：按距离升序取 top_k，同一 id 只保留最近的一次。
+    nq = int(parts[0][1].shape[0])
+    out_d = np.full((nq, top_k), np.finfo(np.float32).max, dtype=np.float32)
+    out_i = np.full((nq, top_k), -1, dtype=np.int64)
+    all_d = np.concatenate([d for d, _ in parts], axis=1)
+    all_i = np.concatenate([i for _, i in parts], axis=1)
+    for row in range(nq):
+        order = np.argsort(all_d[row], kind="stable")
+        seen: set[int] = set()
+        col = 0
+        for pos in order.tolist():
+            cid = int(all_i[row, pos])
+            if cid < 0 or cid in seen:
+                continue
+            seen.add(cid)
+            out_d[row, col] = all_d[row, pos]
+            out_i[row, col] = cid
+            col += 1
+            if col >= top_k:
+                break
+    return out_d, out_i
+
+
+def remove_index_files(index_path: Path) -> None:
+    # 删除知识库时清理索引及其所有旁路文件。
+    for p in (index_path, _meta_path(index_path)):
         try:
-            mp.unlink()
+            p.unlink()
         except FileNotFoundError:
             pass
-        return 0
-
-    vectors = embed_texts(texts_list)
-    dim = int(vectors.shape[1])
-    faiss = _faiss()
-    index = faiss.IndexFlatL2(dim)
-    index.add(vectors)
-    save_faiss_index(index, index_path)
-    if chunk_ids is not None:
-        save_faiss_meta(index_path, ids_list)
-    return int(vectors.shape[0])
+    remove_chunk_vector_files(index_path)
+    remove_index_spec(index_path)
+    remove_lexical_index(index_path)
+    remove_chunk_text_files(index_path)
+    segs = list_segments(index_path)
+    _drop_segments(index_path, segs)
+    remove_segments_dir(index_path)
+    # 已删除知识库的缓存条目立即释放，不必等 LRU 淘汰。
+    _index_cache().pop(str(index_path.resolve()))
+    _meta_cache().pop(str(_meta_path(index_path).resolve()))
+    with _WRITE_LOCKS_GUARD:
+        _WRITE_LOCKS.pop(str(index_path.resolve()), None)
+    try:
+        _lock_path(index_path).unlink()
+    except FileNotFoundError:
+        pass
 
 
 def count_vectors(index_path: Path) -> int:
-    index = load_faiss_index(index_path)
-    if index is None:
-        return 0
-    return int(index.ntotal)
+    # 主索引与全部增量段的向量总数。
+    total = 0
+    for p in (index_path, *list_segments(index_path)):
+        index = load_faiss_index(p)
+        if index is not None:
+            total += int(index.ntotal)
+    return total
+
+
+def list_chunk_ids(index_path: Path) -> np.ndarray:
+    # 主索引与全部增量段中的 chunk id（仅 IndexIDMap2 格式；旧版索引返回空数组）。
+    faiss = _faiss()
+    parts = []
+    for p in (index_path, *list_segments(index_path)):
+        index = load_faiss_index(p)
+        if index is not None and is_id_mapped(index):
+            parts.append(faiss.vector_to_array(index.id_map).astype(np.int64))
+    return np.concatenate(parts) if parts else np.zeros((0,), dtype=np.int64)
@@ -1,28 +1,34 @@
+import hashlib
 import uuid
-import io
 from pathlib import Path
 
+from django.conf import settings
 from django.db import transaction
+from django.utils.http import parse_etags
 from rest_framework import status
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from .models import Document, DocumentChunk, KnowledgeBase
+from .extraction import extract_upload_text
+from .ingestion import ACTIVE_STATUSES, create_ingestion_job, run_ingestion_job
+from .models import Document, IngestionJob, KnowledgeBase
 from users.models import UserSubscription
 from .serializers import (
     DocumentUploadSerializer,
+    IngestionJobSerializer,
     KnowledgeBaseCreateSerializer,
     KnowledgeBaseSerializer,
 )
 from .services import (
     build_kb_index_path,
+    bump_content_version,
     build_upload_path,
     create_empty_index_file,
     safe_remove_file,
     save_uploaded_file,
 )
-from .vectorstore import add_vectors_to_index, chunk_text, rebuild_index
+from .vectorstore import remove_index_files, remove_vectors_from_index
 
 
 def check_kb_limit(user):
@@ -46,43 +52,6 @@ def check_kb_limit(user):
     return True, max_kbs
 
 
-def _decode_text_bytes(raw: bytes) -> str:
-    # 文本类文件：优先 utf-8，失败回退 gbk（兼容部分 Windows 文本）
-    try:
-        return raw.decode("utf-8")
-    except UnicodeDecodeError:
-        return raw.decode("gbk", errors="ignore")
-
-
-def _extract_pdf_text(raw: bytes) -> str:
-    # PDF 文件：通过 pypdf 提取每页文字（扫描件/图片型 PDF 通常无文本）
-    if not raw.startswith(b"%PDF"):
-        raise ValueError("不是有效的 PDF 文件")
-    try:
-        from pypdf import PdfReader
-    except Exception as e:  # pragma: no cover
-        raise RuntimeError("服务端未安装 PDF 解析依赖 pypdf") from e
-
-    reader = PdfReader(io.BytesIO(raw))
-    texts: list[str] = []
-    for page in reader.pages:
-        t = page.extract_text() or ""
-        if t.strip():
-            texts.append(t)
-    return "\n".join(texts)
-
-
-def _extract_upload_text(upload_path: Path) -> str:
-    # 统一抽取文本入口：根据后缀选择解析方式
-    suffix = upload_path.suffix.lower()
-    raw = upload_path.read_bytes()
-    if suffix in {".txt", ".md"}:
-        return _decode_text_bytes(raw)
-    if suffix == ".pdf":
-        return _extract_pdf_text(raw)
-    raise ValueError("不支持的文件类型")
-
-
 class KnowledgeBaseCreateView(APIView):
     # 创建知识库：必须登录
     permission_classes = [IsAuthenticated]
@@ -120,13 +89,34 @@ class KnowledgeBaseCreateView(APIView):
         return Response(KnowledgeBaseSerializer(kb).data, status=status.HTTP_201_CREATED)
 
 
+def _not_modified(request, etag: str) -> Response | None:
+    # 条件 GET：If-None-Match 与当前 ETag 一致时返回 304，不再序列化列表。
+    if etag in parse_etags(request.headers.get("If-None-Match", "")):
+        return _with_etag(Response(status=status.HTTP_304_NOT_MODIFIED), etag)
+    return None
+
+
+def _with_etag(resp: Response, etag: str) -> Response:
+    resp["ETag"] = etag
+    # 允许浏览器缓存但每次携带 If-None-Match 重新验证。
+    resp["Cache-Control"] = "private, no-cache"
+    return resp
+
+
 class KnowledgeBaseListView(APIView):
     # 获取我的知识库列表：必须登录
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
         items = KnowledgeBase.objects.filter(user=request.user).order_by("-created_at")
-        return Response({"items": KnowledgeBaseSerializer(items, many=True).data})
+        # ETag 由各知识库的 (id, 内容版本, 名称, 描述) 计算，只查询这几列。
+        rows = items.values_list("id", "content_version", "name", "description")
+        digest = hashlib.sha1(repr(list(rows)).encode("utf-8")).hexdigest()
+        etag = f'"kbs-{digest}"'
+        not_modified = _not_modified(request, etag)
+        if not_modified is not None:
+            return not_modified
+        return _with_etag(Response({"items": KnowledgeBaseSerializer(items, many=True).data}), etag)
 
 
 class KnowledgeBaseDeleteView(APIView):
@@ -141,7 +131,7 @@ class KnowledgeBaseDeleteView(APIView):
         faiss_path = kb.faiss_path
         kb.delete()
         if faiss_path:
-            safe_remove_file(faiss_path)
+            remove_index_files(Path(faiss_path))
 
         return Response(status=status.HTTP_204_NO_CONTENT)
 
@@ -161,8 +151,11 @@ class KnowledgeBaseUploadView(APIView):
 
         file_obj = serializer.validated_data["file"]
         original_name = Path(file_obj.name).name
-        existing = Document.objects.filter(kb=kb, filename=original_name)
-        has_conflict = existing.exists()
+        # 同名冲突既包括已入库的文档，也包括尚在排队 / 执行中的入库任务。
+        has_conflict = (
+            Document.objects.filter(kb=kb, filename=original_name).exists()
+            or IngestionJob.objects.filter(kb=kb, filename=original_name, status__in=ACTIVE_STATUSES).exists()
+        )
 
         filename = original_name
         if has_conflict and on_conflict == "keep":
@@ -176,64 +169,20 @@ class KnowledgeBaseUploadView(APIView):
         upload_path = build_upload_path(request.user.id, kb.id, filename)
         save_uploaded_file(upload_path, file_obj)
 
-        # 按文件类型抽取文本：txt/md 直接解码，pdf 走解析器
-        try:
-            text = _extract_upload_text(upload_path)
-        except ValueError as e:
-            safe_remove_file(upload_path)
-            return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
-        except RuntimeError as e:
-            safe_remove_file(upload_path)
-            return Response({"detail": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-
-        # 分块：后续 RAG 检索/重建索引都以 chunk 为最小单元。
-        chunks = chunk_text(text)
-        if not chunks:
-            safe_remove_file(upload_path)
-            return Response({"detail": "文件无可用文本内容"}, status=status.HTTP_400_BAD_REQUEST)
-
-        removed_files: list[str] = []
-
-        # 先写入数据库（Document + Chunk），保证后续可重建索引。
-        with transaction.atomic():
-            if has_conflict and on_conflict == "replace":
-                removed_files = [
-                    fp for fp in existing.values_list("file_path", flat=True) if fp
-                ]
-                existing.delete()
-
-            doc = Document.objects.create(
-                kb=kb,
-                filename=filename,
-                file_path=str(upload_path.resolve()),
-                chunk_count=len(chunks),
-            )
-            DocumentChunk.objects.bulk_create(
-                [DocumentChunk(document=doc, chunk_index=i, text=t) for i, t in enumerate(chunks)]
-            )
-
-        chunk_ids = list(
-            DocumentChunk.objects.filter(document=doc).order_by("chunk_index").values_list("id", flat=True)
+        # 抽取、分块、向量化、写索引交给入库任务：默认由 run_ingest_worker 异步执行，接口立即返回任务 ID。
+        job = create_ingestion_job(
+            kb, request.user, filename, upload_path, replace_existing=has_conflict and on_conflict == "replace"
         )
+        if getattr(settings, "KB_INGEST_ASYNC", True):
+            return Response(IngestionJobSerializer(job).data, status=status.HTTP_202_ACCEPTED)
 
-        faiss_path = Path(kb.faiss_path)
-        if has_conflict and on_conflict == "replace":
-            for fp in removed_files:
-                safe_remove_file(fp)
-
-            remaining_ids = DocumentChunk.objects.filter(document__kb=kb).order_by(
-                "document_id", "chunk_index"
-            ).values_list("id", flat=True)
-            remaining_texts = DocumentChunk.objects.filter(document__kb=kb).order_by(
-                "document_id", "chunk_index"
-            ).values_list("text", flat=True)
-            rebuild_index(faiss_path, remaining_texts, chunk_ids=remaining_ids)
-        else:
-            # 向量写入 FAISS：写入到该知识库的 kb.faiss_path。
-            added = add_vectors_to_index(faiss_path, chunks, chunk_ids=chunk_ids)
-            if added != len(chunks):
-                return Response({"detail": "向量写入失败"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        job = run_ingestion_job(job.id)
+        if job is None or job.status != IngestionJob.STATUS_SUCCEEDED:
+            detail = job.error if job is not None else "入库失败"
+            code = (job.error_status if job is not None else 0) or status.HTTP_500_INTERNAL_SERVER_ERROR
+            return Response({"detail": detail}, status=code)
 
+        doc = job.document
         return Response(
             {
                 "id": doc.id,
@@ -241,11 +190,23 @@ class KnowledgeBaseUploadView(APIView):
                 "filename": doc.filename,
                 "chunk_count": doc.chunk_count,
                 "uploaded_at": doc.uploaded_at,
+                "job_id": job.id,
             },
             status=status.HTTP_201_CREATED,
         )
 
 
+class IngestionJobStatusView(APIView):
+    # 入库任务进度：阶段（extract / chunk / embed / index / done）、chunk 总数与已向量化数量。
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, job_id: int):
+        job = IngestionJob.objects.filter(id=job_id, user=request.user).first()
+        if job is None:
+            return Response(status=status.HTTP_404_NOT_FOUND)
+        return Response(IngestionJobSerializer(job).data, status=status.HTTP_200_OK)
+
+
 class KnowledgeBaseDocumentsView(APIView):
     permission_classes = [IsAuthenticated]
 
@@ -254,6 +215,11 @@ class KnowledgeBaseDocumentsView(APIView):
         if kb is None:
             return Response(status=status.HTTP_404_NOT_FOUND)
 
+        etag = f'"kb-{kb.id}-v{kb.content_version}"'
+        not_modified = _not_modified(request, etag)
+        if not_modified is not None:
+            return not_modified
+
         docs = Document.objects.filter(kb=kb).order_by("-uploaded_at")
         items = [
             {
@@ -264,7 +230,7 @@ class KnowledgeBaseDocumentsView(APIView):
             }
             for d in docs
         ]
-        return Response({"items": items}, status=status.HTTP_200_OK)
+        return _with_etag(Response({"items": items}, status=status.HTTP_200_OK), etag)
 
 
 class DocumentDeleteView(APIView):
@@ -278,20 +244,17 @@ class DocumentDeleteView(APIView):
         kb = doc.kb
         faiss_path = kb.faiss_path
         file_path = doc.file_path
+        chunk_ids = list(doc.chunks.values_list("id", flat=True))
 
         doc.delete()
 
         if file_path:
             safe_remove_file(file_path)
 
-        # 删除文档后通过“重建索引”保持 FAISS 与数据库一致。
-        remaining_ids = DocumentChunk.objects.filter(document__kb=kb).order_by(
-            "document_id", "chunk_index"
-        ).values_list("id", flat=True)
-        remaining_texts = DocumentChunk.objects.filter(document__kb=kb).order_by(
-            "document_id", "chunk_index"
-        ).values_list("text", flat=True)
-        rebuild_index(Path(faiss_path), remaining_texts, chunk_ids=remaining_ids)
+        # 删除文档后按 chunk id 原地移除向量，保持 FAISS 与数据库一致（不触发重新向量化）。
+        if faiss_path:
+            remove_vectors_from_index(Path(faiss_path), chunk_ids, config=kb.index_config)
+        bump_content_version(kb.id)
 
         return Response(status=status.HTTP_204_NO_CONTENT)
 
@@ -310,7 +273,7 @@ class DocumentPreviewView(APIView):
 
         try:
             # 提取文档内容
-            content = _extract_upload_text(Path(file_path))
+            content = extract_upload_text(Path(file_path))
             return Response({"content": content, "filename": doc.filename}, status=status.HTTP_200_OK)
         except Exception as e:
             return Response({"detail": f"预览失败：{str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -0,0 +1,166 @@
+from __future__ import annotations
+
+"""
+问答结果缓存：同一知识库（同一内容版本）下重复提问时直接返回已生成的回答，不再调用 LLM。
+
+查找顺序：
+1. 精确匹配：sha256(模型 + 完整 prompt)，prompt 包含问题与检索到的资料；
+2. 语义匹配：在该知识库近期问题向量（归一化后）中做暴力余弦检索，相似度不低于
+   RAG_ANSWER_CACHE_THRESHOLD 即视为同一问题。
+
+每个 (知识库, 内容版本) 一组条目（联合检索时知识库 id 与版本均为逗号连接的字符串），最多 RAG_ANSWER_CACHE_MAX_ENTRIES 条（超出淘汰最早写入的），
+条目超过 RAG_ANSWER_CACHE_TTL_SECONDS 失效；各组放在按字节预算淘汰的进程内 LRU 中。
+知识库内容变化后版本不同，旧组不会再被命中。
+"""
+
+import hashlib
+import threading
+import time
+from dataclasses import dataclass
+
+import numpy as np
+from django.conf import settings
+
+from knowledge.lru import ByteBudgetLRU
+
+_CACHE: ByteBudgetLRU | None = None
+_CACHE_GUARD = threading.Lock()
+_STATS_LOCK = threading.Lock()
+_STATS = {"exact_hits": 0, "semantic_hits": 0, "misses": 0, "stores": 0}
+
+
+@dataclass(frozen=True)
+class CachedAnswer:
+    answer: str
+    token_usage: dict | None
+    match: str
+    similarity: float
+
+
+class _AnswerGroup:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # prompt_hash -> (answer, token_usage, 单位向量或 None, 过期时刻)
+        self.entries: dict[str, tuple[str, dict | None, np.ndarray | None, float]] = {}
+        self._matrix: np.ndarray | None = None
+        self._keys: list[str] = []
+
+    def footprint(self) -> int:
+        total = 0
+        for answer, _, vec, _ in self.entries.values():
+            total += len(answer.encode("utf-8")) + 256
+            if vec is not None:
+                total += int(vec.nbytes)
+        return total
+
+    def add(self, key: str, answer: str, usage: dict | None, vec: np.ndarray | None, ttl: float, limit: int) -> None:
+        self.entries.pop(key, None)
+        self.entries[key] = (answer, usage, vec, time.monotonic() + ttl)
+        while len(self.entries) > limit:
+            self.entries.pop(next(iter(self.entries)))
+        self._matrix = None
+
+    def exact(self, key: str) -> CachedAnswer | None:
+        item = self.entries.get(key)
+        if item is None or item[3] <= time.monotonic():
+            return None
+        return CachedAnswer(item[0], item[1], "exact", 1.0)
+
+    def nearest(self, vec: np.ndarray, threshold: float) -> CachedAnswer | None:
+        if self._matrix is None:
+            self._keys = [k for k, item in self.entries.items() if item[2] is not None and item[2].shape == vec.shape]
+            self._matrix = (
+                np.stack([self.entries[k][2] for k in self._keys]) if self._keys else np.zeros((0, vec.shape[0]))
+            )
+        if not self._keys:
+            return None
+        sims = self._matrix @ vec
+        now = time.monotonic()
+        for pos in np.argsort(-sims).tolist():
+            if float(sims[pos]) < threshold:
+                return None
+            item = self.entries.get(self._keys[pos])
+            if item is not None and item[3] > now:
+                return CachedAnswer(item[0], item[1], "semantic", float(sims[pos]))
+        return None
+
+
+def answer_cache_enabled() -> bool:
+    return bool(getattr(settings, "RAG_ANSWER_CACHE", True)) and _ttl() > 0
+
+
+def _ttl() -> int:
+    return int(getattr(settings, "RAG_ANSWER_CACHE_TTL_SECONDS", 3600) or 0)
+
+
+def _cache() -> ByteBudgetLRU:
+    global _CACHE
+    with _CACHE_GUARD:
+        if _CACHE is None:
+            _CACHE = ByteBudgetLRU(int(getattr(settings, "RAG_ANSWER_CACHE_MB", 32)) * 1024 * 1024)
+        return _CACHE
+
+
+def _unit(vec: np.ndarray | None) -> np.ndarray | None:
+    if vec is None:
+        return None
+    v = np.asarray(vec, dtype=np.float32).reshape(-1)
+    norm = float(np.linalg.norm(v))
+    return v / norm if norm > 0 else None
+
+
+def _count(name: str) -> None:
+    with _STATS_LOCK:
+        _STATS[name] += 1
+
+
+def prompt_hash(model: str, prompt: str) -> str:
+    return hashlib.sha256(f"{model}\n{prompt}".encode("utf-8")).hexdigest()
+
+
+def lookup_answer(kb_id: int | str, content_version: str, key: str, q_vec: np.ndarray | None) -> CachedAnswer | None:
+    if not answer_cache_enabled():
+        return None
+    group = _cache().get((kb_id, content_version))
+    hit = None
+    if group is not None:
+        with group.lock:
+            hit = group.exact(key)
+            unit = _unit(q_vec)
+            if hit is None and unit is not None:
+                threshold = float(getattr(settings, "RAG_ANSWER_CACHE_THRESHOLD", 0.95))
+                hit = group.nearest(unit, threshold)
+    _count(f"{hit.match}_hits" if hit else "misses")
+    return hit
+
+
+def store_answer(
+    kb_id: int | str, content_version: str, key: str, q_vec: np.ndarray | None, answer: str, token_usage: dict | None
+) -> None:
+    if not answer_cache_enabled() or not (answer or "").strip():
+        return
+    cache = _cache()
+    group = cache.get((kb_id, content_version))
+    if group is None:
+        group = _AnswerGroup()
+    limit = max(1, int(getattr(settings, "RAG_ANSWER_CACHE_MAX_ENTRIES", 256)))
+    with group.lock:
+        group.add(key, answer, token_usage, _unit(q_vec), _ttl(), limit)
+        nbytes = group.footprint()
+    # 重新放入以更新字节占用（同时刷新 LRU 位置）。
+    cache.put((kb_id, content_version), group, nbytes)
+    _count("stores")
+
+
+def answer_cache_stats() -> dict:
+    with _STATS_LOCK:
+        stats = dict(_STATS)
+    stats["memory"] = _cache().stats()
+    return stats
+
+
+def clear_answer_cache() -> None:
+    _cache().clear()
+    with _STATS_LOCK:
+        for k in _STATS:
+            _STATS[k] = 0
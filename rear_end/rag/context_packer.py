@@ -0,0 +1,166 @@
+from __future__ import annotations
+
+"""
+上下文打包：把检索到的 chunk 按 token 预算组装为 prompt 中的资料。
+
+- 同一文档中 chunk_index 相邻的 chunk 拼接为一段，去掉分块时相邻窗口之间的重叠文本（chunk_text 默认 200 字符）
+- 内容完全相同的片段只保留一份
+- 按相关度（余弦相似度，同分或无分数时按检索名次）从高到低装入，直到 token / 字符预算用完；放不下的片段跳过，
+  继续尝试后面更短的片段。最相关的片段单独就超出预算时在句子边界处截断，不会截在句子中间
+- token 数用本地 tokenizer（tiktoken，编码由 RAG_TOKENIZER_ENCODING 指定）计算；未安装 tiktoken 或编码文件
+  不可用（离线环境）时按字符估算
+"""
+
+import logging
+import os
+import re
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Hashable
+
+from knowledge.embedding_batcher import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+SEPARATOR = "\n\n---\n\n"
+# 相邻 chunk 的公共前后缀短于该长度时不视为重叠，避免偶然相同的几个字符被误删。
+_MIN_OVERLAP = 8
+_SENTENCE_END_RE = re.compile(r"[。！？!?；;…\n]+|\.(?=\s)")
+
+
+@dataclass(frozen=True)
+class ContextPiece:
+    # key 由调用方决定（如 (kb_id, chunk_id)），用于回查哪些 chunk 进入了 prompt；rank 为检索名次。
+    key: Hashable
+    document_id: int
+    chunk_index: int
+    text: str
+    score: float | None
+    rank: int
+
+
+@dataclass
+class PackedContext:
+    text: str
+    keys: list = field(default_factory=list)
+    score: float | None = None
+    rank: int = 0
+
+
+@lru_cache(maxsize=4)
+def _encoding(name: str):
+    try:
+        import tiktoken
+
+        return tiktoken.get_encoding(name)
+    except Exception as e:
+        logger.warning("tokenizer %s unavailable, using estimate: %s", name, e)
+        return None
+
+
+def count_tokens(text: str) -> int:
+    enc = _encoding(os.getenv("RAG_TOKENIZER_ENCODING", "cl100k_base") or "cl100k_base")
+    if enc is None:
+        return estimate_tokens(text)
+    return len(enc.encode(text or "", disallowed_special=()))
+
+
+def _overlap(a: str, b: str) -> int:
+    # a 的后缀与 b 的前缀的最长公共部分（长度）；从最靠前的候选位置开始匹配，先找到的即最长。
+    if len(b) < _MIN_OVERLAP:
+        return 0
+    head = b[:_MIN_OVERLAP]
+    i = a.find(head, max(0, len(a) - len(b)))
+    while i != -1:
+        if b.startswith(a[i:]):
+            return len(a) - i
+        i = a.find(head, i + 1)
+    return 0
+
+
+def stitch(a: str, b: str) -> str:
+    k = _overlap(a, b)
+    return a + b[k:] if k else f"{a}\n{b}"
+
+
+def merge_adjacent(pieces: list[ContextPiece]) -> list[PackedContext]:
+    # 按 (文档, chunk_index) 排序后把连续的 chunk 拼为一段，分数取段内最高、名次取段内最靠前。
+    blocks: list[PackedContext] = []
+    last: tuple[int, int] | None = None
+    for p in sorted(pieces, key=lambda p: (p.document_id, p.chunk_index)):
+        text = (p.text or "").strip()
+        if not text:
+            continue
+        if last is not None and last == (p.document_id, p.chunk_index - 1):
+            block = blocks[-1]
+            block.text = stitch(block.text, text)
+            block.keys.append(p.key)
+            if p.score is not None and (block.score is None or p.score > block.score):
+                block.score = p.score
+            block.rank = min(block.rank, p.rank)
+        else:
+            blocks.append(PackedContext(text=text, keys=[p.key], score=p.score, rank=p.rank))
+        last = (p.document_id, p.chunk_index)
+    return blocks
+
+
+def _fits(text: str, max_tokens: int, max_chars: int) -> bool:
+    return len(text) <= max_chars and count_tokens(text) <= max_tokens
+
+
+def truncate_at_sentence(text: str, max_tokens: int, max_chars: int) -> str:
+    # 取不超过预算的最长前缀，优先截在句末；整段连一句都放不下时才按字符截断。
+    if _fits(text, max_tokens, max_chars):
+        return text
+    ends = [m.end() for m in _SENTENCE_END_RE.finditer(text) if m.end() <= max_chars]
+    lo, hi = 0, len(ends)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if count_tokens(text[: ends[mid - 1]]) <= max_tokens:
+            lo = mid
+        else:
+            hi = mid - 1
+    if lo:
+        return text[: ends[lo - 1]].rstrip()
+    lo, hi = 0, min(len(text), max_chars)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if count_tokens(text[:mid]) <= max_tokens:
+            lo = mid
+        else:
+            hi = mid - 1
+    return text[:lo].rstrip()
+
+
+def pack_contexts(pieces: list[ContextPiece], max_tokens: int, max_chars: int) -> list[PackedContext]:
+    """
+    按相关度装入预算内的资料段落，返回顺序即 prompt 中的顺序（最相关在前）。
+
+    预算按以 SEPARATOR 连接后的总长计算，与 _build_prompt 的拼接方式一致。
+    """
+    if max_tokens <= 0 or max_chars <= 0:
+        return []
+    blocks = sorted(
+        merge_adjacent(pieces), key=lambda b: (b.score is None, -(b.score or 0.0), b.rank)
+    )
+    sep_tokens = count_tokens(SEPARATOR)
+    packed: list[PackedContext] = []
+    seen: set[str] = set()
+    used_tokens = used_chars = 0
+    for block in blocks:
+        if block.text in seen:
+            continue
+        seen.add(block.text)
+        extra_tokens = sep_tokens if packed else 0
+        extra_chars = len(SEPARATOR) if packed else 0
+        n = count_tokens(block.text)
+        if used_tokens + extra_tokens + n <= max_tokens and used_chars + extra_chars + len(block.text) <= max_chars:
+            packed.append(block)
+            used_tokens += extra_tokens + n
+            used_chars += extra_chars + len(block.text)
+        elif not packed:
+            text = truncate_at_sentence(block.text, max_tokens, max_chars)
+            if text:
+                packed.append(PackedContext(text=text, keys=block.keys, score=block.score, rank=block.rank))
+                used_tokens, used_chars = count_tokens(text), len(text)
+    return packed
@@ -29,11 +29,13 @@ class ChatHistoryView(APIView):
                 return Response({
                     'id': history.id,
                     'kb_id': history.kb_id,
+                    'kb_ids': history.kb_ids or [history.kb_id],
                     'question': history.question,
                     'answer': history.answer,
                     'created_at': history.created_at,
                     'token_usage': history.token_usage,
                     'elapsed_ms': history.elapsed_ms,
+                    'cache_hit': history.cache_hit,
                     'knowledge_base_name': kb_name,
                 })
             except ChatHistory.DoesNotExist:
@@ -62,11 +64,13 @@ class ChatHistoryView(APIView):
             data.append({
                 'id': history.id,
                 'kb_id': history.kb_id,
+                'kb_ids': history.kb_ids or [history.kb_id],
                 'question': history.question,
                 'answer': history.answer,
                 'created_at': history.created_at,
                 'token_usage': history.token_usage,
                 'elapsed_ms': history.elapsed_ms,
+                'cache_hit': history.cache_hit,
                 'knowledge_base_name': kb_name_map.get(history.kb_id),
             })
         
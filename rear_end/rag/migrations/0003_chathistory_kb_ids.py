@@ -0,0 +1,17 @@
+# Generated by Django 6.0.2 on 2026-10-18 00:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("rag", "0002_chathistory_cache_hit"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="chathistory",
+            name="kb_ids",
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
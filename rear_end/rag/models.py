@@ -7,12 +7,16 @@ class ChatHistory(models.Model):
     """聊天历史记录模型"""
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     kb_id = models.IntegerField()
+    # 联合检索时的全部知识库 id（kb_id 为其中第一个）；单库问答为空
+    kb_ids = models.JSONField(null=True, blank=True)
     session_id = models.UUIDField(default=uuid.uuid4, editable=False)
     question = models.TextField()
     answer = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
     token_usage = models.JSONField(null=True, blank=True)
     elapsed_ms = models.IntegerField(null=True, blank=True)
+    # 回答来自问答缓存（未调用 LLM）
+    cache_hit = models.BooleanField(default=False)
     
     class Meta:
         ordering = ['-created_at']
@@ -0,0 +1,187 @@
+from __future__ import annotations
+
+"""
+检索缓存：问题向量与 top-k 结果的两级缓存。
+
+- 问题向量：(embedding 模型, 规范化后的问题) -> float32 向量，省去重复的远程 embedding 调用
+- top-k：(知识库, 内容版本, 问题向量哈希, top_k, 检索参数) -> chunk id 列表，省去重复的索引检索
+
+L1 为进程内按字节预算淘汰的 LRU（带 TTL）；配置 RAG_CACHE_DIR 时启用 L2（diskcache，多进程共享，
+同样按 TTL 过期）。内容版本即 KnowledgeBase.content_version，随知识库的每次写入自增，旧条目不会再被命中，
+只等 TTL / LRU 自然淘汰。
+"""
+
+import hashlib
+import re
+import threading
+import unicodedata
+from typing import Callable
+
+import numpy as np
+from django.conf import settings
+
+from knowledge.lru import ByteBudgetLRU
+
+_L1: ByteBudgetLRU | None = None
+_L2 = None
+_INIT_LOCK = threading.Lock()
+_STATS_LOCK = threading.Lock()
+_STATS = {"vector_hits": 0, "vector_misses": 0, "topk_hits": 0, "topk_misses": 0, "disk_hits": 0}
+
+_WS_RE = re.compile(r"\s+")
+
+
+def normalize_question(question: str) -> str:
+    # 全角/半角统一、折叠空白、英文小写：仅格式不同的问题共用同一缓存条目。
+    text = unicodedata.normalize("NFKC", question or "")
+    return _WS_RE.sub(" ", text).strip().lower()
+
+
+def _ttl() -> int:
+    return int(getattr(settings, "RAG_CACHE_TTL_SECONDS", 600) or 0)
+
+
+def _l1() -> ByteBudgetLRU:
+    global _L1
+    with _INIT_LOCK:
+        if _L1 is None:
+            _L1 = ByteBudgetLRU(int(getattr(settings, "RAG_CACHE_MB", 64)) * 1024 * 1024, ttl_seconds=_ttl())
+        return _L1
+
+
+def _l2():
+    global _L2
+    directory = getattr(settings, "RAG_CACHE_DIR", None)
+    if not directory:
+        return None
+    with _INIT_LOCK:
+        if _L2 is None or _L2[0] != str(directory):
+            import diskcache
+
+            _L2 = (
+                str(directory),
+                diskcache.Cache(
+                    str(directory),
+                    size_limit=int(getattr(settings, "RAG_CACHE_DISK_MB", 512)) * 1024 * 1024,
+                    eviction_policy="least-recently-used",
+                ),
+            )
+        return _L2[1]
+
+
+def _count(name: str) -> None:
+    with _STATS_LOCK:
+        _STATS[name] += 1
+
+
+def _get(key: str, decode: Callable[[bytes], object], shared: bool):
+    value = _l1().get(key)
+    if value is not None:
+        return value
+    disk = _l2() if shared else None
+    if disk is None:
+        return None
+    raw = disk.get(key)
+    if raw is None:
+        return None
+    value = decode(raw)
+    _l1().put(key, value, len(raw), ttl_seconds=_ttl())
+    _count("disk_hits")
+    return value
+
+
+def _put(key: str, value, raw: bytes, shared: bool) -> None:
+    _l1().put(key, value, len(raw), ttl_seconds=_ttl())
+    disk = _l2() if shared else None
+    if disk is not None:
+        disk.set(key, raw, expire=_ttl())
+
+
+def get_query_vector(
+    model: str, question: str, embed_fn: Callable[[list[str]], np.ndarray], shared: bool = True
+) -> np.ndarray:
+    """
+    返回形状为 (1, dim) 的问题向量，命中缓存时不调用 embed_fn。
+
+    shared=False 时只用进程内缓存（向量依赖进程内状态的后端，如测试用的 fake embedding）。
+    """
+    return get_query_vectors(model, [question], embed_fn, shared=shared)
+
+
+def get_query_vectors(
+    model: str, questions: list[str], embed_fn: Callable[[list[str]], np.ndarray], shared: bool = True
+) -> np.ndarray:
+    # 批量版本，返回 (len(questions), dim)：未命中缓存的问题合并为一次 embed_fn 调用，同批内重复的问题只向量化一次。
+    texts = [(q or "").strip() for q in questions]
+    if _ttl() <= 0:
+        return np.asarray(embed_fn(texts), dtype=np.float32)
+    keys = [f"qv:{model}:{hashlib.sha256(normalize_question(t).encode('utf-8')).hexdigest()}" for t in texts]
+    first_text: dict[str, str] = {}
+    for key, text in zip(keys, texts):
+        first_text.setdefault(key, text)
+    found: dict[str, np.ndarray] = {}
+    for key in first_text:
+        vec = _get(key, lambda raw: np.frombuffer(raw, dtype=np.float32).reshape(1, -1), shared)
+        if vec is not None:
+            found[key] = vec
+            _count("vector_hits")
+    missing = [key for key in first_text if key not in found]
+    if missing:
+        for _ in missing:
+            _count("vector_misses")
+        vecs = np.asarray(embed_fn([first_text[k] for k in missing]), dtype=np.float32)
+        if vecs.ndim != 2 or vecs.shape[0] != len(missing):
+            return np.asarray(embed_fn(texts), dtype=np.float32)
+        for key, row in zip(missing, vecs):
+            vec = np.ascontiguousarray(row.reshape(1, -1))
+            vec.setflags(write=False)
+            _put(key, vec, vec.tobytes(), shared)
+            found[key] = vec
+    if len(keys) == 1:
+        return found[keys[0]]
+    return np.concatenate([found[k] for k in keys], axis=0)
+
+
+def get_topk_ids(
+    kb_id: int,
+    content_version: str,
+    q_vec: np.ndarray,
+    top_k: int,
+    params: str,
+    compute: Callable[[], list[int]],
+) -> list[int]:
+    # params 为影响结果的其余检索参数（索引配置、混合检索开关、词法查询等）的摘要。
+    if _ttl() <= 0:
+        return compute()
+    vec_hash = hashlib.sha1(np.ascontiguousarray(q_vec, dtype=np.float32).tobytes()).hexdigest()
+    param_hash = hashlib.sha1(params.encode("utf-8")).hexdigest()[:16]
+    key = f"topk:{kb_id}:{content_version}:{vec_hash}:{int(top_k)}:{param_hash}"
+    ids = _get(key, lambda raw: tuple(np.frombuffer(raw, dtype=np.int64).tolist()), True)
+    if ids is not None:
+        _count("topk_hits")
+        return list(ids)
+    _count("topk_misses")
+    ids = [int(i) for i in compute()]
+    _put(key, tuple(ids), np.asarray(ids, dtype=np.int64).tobytes(), True)
+    return ids
+
+
+def retrieval_cache_stats() -> dict:
+    with _STATS_LOCK:
+        stats = dict(_STATS)
+    stats["memory"] = _l1().stats()
+    disk = _l2()
+    stats["disk"] = {"enabled": disk is not None}
+    if disk is not None:
+        stats["disk"]["size_bytes"] = int(disk.volume())
+    return stats
+
+
+def clear_retrieval_cache() -> None:
+    _l1().clear()
+    disk = _l2()
+    if disk is not None:
+        disk.clear()
+    with _STATS_LOCK:
+        for k in _STATS:
+            _STATS[k] = 0
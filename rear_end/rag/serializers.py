@@ -1,15 +1,75 @@
+from django.conf import settings
 from rest_framework import serializers
 import uuid
 
 
+def _validate_kb_ids(attrs):
+    # kb_id / kb_ids 二选一：去重后写回 kb_ids，kb_id 取第一个（历史记录按它归档）。
+    ids = attrs.get("kb_ids") or ([attrs["kb_id"]] if attrs.get("kb_id") is not None else [])
+    if not ids:
+        raise serializers.ValidationError({"kb_id": "请指定 kb_id 或 kb_ids"})
+    ids = list(dict.fromkeys(ids))
+    limit = int(getattr(settings, "RAG_MAX_FEDERATED_KBS", 8))
+    if len(ids) > limit:
+        raise serializers.ValidationError({"kb_ids": f"一次最多检索 {limit} 个知识库"})
+    attrs["kb_ids"] = ids
+    attrs["kb_id"] = ids[0]
+    return attrs
+
+
 class RagChatRequestSerializer(serializers.Serializer):
-    kb_id = serializers.IntegerField()
+    kb_id = serializers.IntegerField(required=False)
+    # 联合检索：同时检索多个知识库，合并结果后只调用一次大模型（与 kb_id 二选一）
+    kb_ids = serializers.ListField(child=serializers.IntegerField(), required=False, allow_empty=False)
     question = serializers.CharField(allow_blank=False, trim_whitespace=True)
     session_id = serializers.UUIDField(required=False, default=uuid.uuid4)
 
+    def validate(self, attrs):
+        return _validate_kb_ids(attrs)
+
+
+class RagBatchSearchRequestSerializer(serializers.Serializer):
+    kb_id = serializers.IntegerField()
+    questions = serializers.ListField(
+        child=serializers.CharField(allow_blank=False, trim_whitespace=True), allow_empty=False
+    )
+    top_k = serializers.IntegerField(required=False, min_value=1)
+
+    def validate_questions(self, value):
+        limit = int(getattr(settings, "RAG_BATCH_MAX_QUESTIONS", 64))
+        if len(value) > limit:
+            raise serializers.ValidationError(f"一次最多 {limit} 个问题")
+        return value
+
+    def validate_top_k(self, value):
+        limit = int(getattr(settings, "RAG_SEARCH_MAX_TOP_K", 50))
+        if value > limit:
+            raise serializers.ValidationError(f"top_k 不能超过 {limit}")
+        return value
+
+
+class RagSearchRequestSerializer(serializers.Serializer):
+    # 纯检索（查询参数）：kb_ids 可重复传入，如 ?kb_ids=1&kb_ids=2
+    kb_id = serializers.IntegerField(required=False)
+    kb_ids = serializers.ListField(child=serializers.IntegerField(), required=False, allow_empty=False)
+    question = serializers.CharField(allow_blank=False, trim_whitespace=True)
+    page = serializers.IntegerField(required=False, default=1, min_value=1)
+    page_size = serializers.IntegerField(required=False, default=10, min_value=1)
+
+    def validate(self, attrs):
+        attrs = _validate_kb_ids(attrs)
+        # 分页建立在 top-k 之上：可翻到的最深位置不超过 RAG_SEARCH_MAX_TOP_K。
+        limit = int(getattr(settings, "RAG_SEARCH_MAX_TOP_K", 50))
+        if attrs["page"] * attrs["page_size"] > limit:
+            raise serializers.ValidationError({"page": f"最多返回前 {limit} 条结果"})
+        return attrs
+
 
 class RagChatResponseSerializer(serializers.Serializer):
     answer = serializers.CharField(allow_blank=False)
     elapsed_ms = serializers.IntegerField()
     token_usage = serializers.DictField()
     session_id = serializers.UUIDField()
+    cache_hit = serializers.BooleanField()
+    # 进入上下文的 chunk 及其余弦相似度（kb_id / chunk_id / score）；未命中阈值时为空
+    sources = serializers.ListField(child=serializers.DictField())
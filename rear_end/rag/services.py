@@ -1,8 +1,12 @@
 from __future__ import annotations
 
 import os
+import heapq
+import json
 import time
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from functools import lru_cache
 from dataclasses import dataclass
 from pathlib import Path
@@ -10,11 +14,29 @@ from pathlib import Path
 import numpy as np
 from django.conf import settings
 
+from knowledge.chunk_texts import lookup_chunk_texts
+from knowledge.lexical import lexical_search, reciprocal_rank_fusion, reciprocal_rank_scores
 from knowledge.models import DocumentChunk, KnowledgeBase
-from knowledge.vectorstore import embed_texts, load_faiss_index, load_faiss_meta, save_faiss_meta
+from knowledge.services import mark_index_degraded
+from knowledge.vectorstore import (
+    cosine_similarities,
+    count_vectors,
+    embed_texts,
+    is_id_mapped,
+    legacy_id_map,
+    load_faiss_index,
+    search_index,
+)
+
+from .answer_cache import answer_cache_enabled, lookup_answer, prompt_hash, store_answer
+from .context_packer import SEPARATOR, ContextPiece, pack_contexts
+from .retrieval_cache import get_query_vectors, get_topk_ids, normalize_question
 
 logger = logging.getLogger(__name__)
 
+# 没有 chunk 达到相关度阈值时直接返回的回答（可用 RAG_NO_MATCH_ANSWER 覆盖）。
+NO_MATCH_ANSWER = "知识库中没有找到与该问题相关的内容。"
+
 
 class RagError(Exception):
     def __init__(self, status_code: int, detail: str):
@@ -27,6 +49,15 @@ class RagError(Exception):
 class RagConfig:
     top_k: int
     max_context_chars: int
+    # 资料的 token 预算（见 context_packer）；max_context_chars 同时作为字符上限。
+    max_context_tokens: int = 4000
+    # 混合检索：向量与 BM25 各取 top_k × hybrid_fanout 个候选，按 RRF（常数 rrf_k）融合后取 top_k。
+    hybrid: bool = True
+    hybrid_fanout: int = 4
+    rrf_k: int = 60
+    # 相关度阈值（余弦相似度）：None 表示不过滤；知识库的 min_score 优先。
+    min_score: float | None = None
+    no_match_answer: str = NO_MATCH_ANSWER
 
 
 def _get_rag_config() -> RagConfig:
@@ -36,7 +67,20 @@ def _get_rag_config() -> RagConfig:
         top_k = 1
     if max_context_chars <= 0:
         max_context_chars = 1000
-    return RagConfig(top_k=top_k, max_context_chars=max_context_chars)
+    max_context_tokens = int(os.getenv("RAG_MAX_CONTEXT_TOKENS", "4000"))
+    if max_context_tokens <= 0:
+        max_context_tokens = 1000
+    min_score = (os.getenv("RAG_MIN_SCORE", "") or "").strip()
+    return RagConfig(
+        top_k=top_k,
+        max_context_chars=max_context_chars,
+        max_context_tokens=max_context_tokens,
+        hybrid=(os.getenv("RAG_HYBRID", "1") or "").strip() == "1",
+        hybrid_fanout=max(1, int(os.getenv("RAG_HYBRID_FANOUT", "4"))),
+        rrf_k=max(1, int(os.getenv("RAG_RRF_K", "60"))),
+        min_score=float(min_score) if min_score else None,
+        no_match_answer=(os.getenv("RAG_NO_MATCH_ANSWER", "") or "").strip() or NO_MATCH_ANSWER,
+    )
 
 
 def _truncate(text: str, max_chars: int) -> str:
@@ -48,9 +92,9 @@ def _truncate(text: str, max_chars: int) -> str:
     return text[:max_chars]
 
 
-def _build_prompt(question: str, contexts: list[str], max_context_chars: int) -> str:
-    context_text = "\n\n---\n\n".join([c for c in contexts if (c or "").strip()])
-    context_text = _truncate(context_text, max_context_chars)
+def _build_prompt(question: str, contexts: list[str]) -> str:
+    # contexts 已由 _pack_for_prompt 按 token / 字符预算装好，这里原样拼接，不再二次截断。
+    context_text = SEPARATOR.join([c for c in contexts if (c or "").strip()])
     return (
         "你是一个检索增强问答助手。请只基于“资料”回答问题；如果资料不足以回答，请明确说明不知道。\n\n"
         f"资料：\n{context_text}\n\n"
@@ -180,152 +224,610 @@ def _stream_answer_openai(prompt: str):
             yield delta
 
 
-def generate_answer(question: str, contexts: list[str], max_context_chars: int) -> str:
+def generate_answer(question: str, contexts: list[str]) -> str:
     backend = (os.getenv("RAG_LLM_BACKEND", "") or "openai").lower()
     if backend == "fake":
         return _generate_answer_fake(question, contexts)
 
-    prompt = _build_prompt(question, contexts, max_context_chars=max_context_chars)
+    prompt = _build_prompt(question, contexts)
     answer, _usage = _generate_answer_openai(prompt)
     return answer
 
 
-def generate_answer_with_usage(question: str, contexts: list[str], max_context_chars: int) -> tuple[str, TokenUsage]:
+def generate_answer_with_usage(question: str, contexts: list[str]) -> tuple[str, TokenUsage]:
     backend = (os.getenv("RAG_LLM_BACKEND", "") or "openai").lower()
     if backend == "fake":
         return _generate_answer_fake(question, contexts), TokenUsage(None, None, None)
 
-    prompt = _build_prompt(question, contexts, max_context_chars=max_context_chars)
+    prompt = _build_prompt(question, contexts)
     return _generate_answer_openai(prompt)
 
 
-def stream_answer(question: str, contexts: list[str], max_context_chars: int):
+def stream_answer(question: str, contexts: list[str]):
     backend = (os.getenv("RAG_LLM_BACKEND", "") or "openai").lower()
     if backend == "fake":
         yield _generate_answer_fake(question, contexts)
         return
 
-    prompt = _build_prompt(question, contexts, max_context_chars=max_context_chars)
+    prompt = _build_prompt(question, contexts)
     yield from _stream_answer_openai(prompt)
 
 
-def retrieve_contexts(kb: KnowledgeBase, question: str, top_k: int) -> list[str]:
+def _embed_questions(questions: list[str]) -> np.ndarray:
+    backend = (os.getenv("KB_EMBEDDING_BACKEND", "") or "openai").lower()
+    if backend == "fake":
+        # fake 向量依赖进程内 hash，不写入跨进程共享的磁盘缓存。
+        return get_query_vectors("fake", questions, embed_texts, shared=False)
+    model = getattr(settings, "OPENAI_EMBEDDING_MODEL", "") or os.getenv("OPENAI_EMBEDDING_MODEL", "")
+    return get_query_vectors(model, questions, embed_texts)
+
+
+@dataclass(frozen=True)
+class _KbHits:
+    # 单个知识库的候选：vector 为 (距离, chunk_id) 升序，lexical 为 (BM25 得分, chunk_id) 降序。
+    vector: list[tuple[float, int]]
+    lexical: list[tuple[float, int]]
+
+
+def _search_kb_hits_batch(
+    kb: KnowledgeBase,
+    index_path: Path,
+    index,
+    q_vecs: np.ndarray,
+    questions: list[str],
+    n_candidates: int,
+    cfg: RagConfig,
+) -> list[_KbHits]:
+    # 只读索引文件与进程内缓存、不访问数据库，可在线程池中并发执行（FAISS 检索期间释放 GIL）。
+    # 多个问题以 (nq, dim) 矩阵一次检索。
+    dist, idx = search_index(index_path, index, q_vecs, n_candidates, config=kb.index_config)
+    out: list[_KbHits] = []
+    for row, question in enumerate(questions):
+        vector = [(float(d), int(i)) for d, i in zip(dist[row].tolist(), idx[row].tolist()) if int(i) >= 0]
+        lexical: list[tuple[float, int]] = []
+        if cfg.hybrid:
+            # 词法检索补充精确词（产品编号、报错原文等）的召回；尚无 BM25 索引的旧知识库退化为纯向量检索。
+            lexical = [(float(score), cid) for cid, score in lexical_search(index_path, question, n_candidates)]
+        out.append(_KbHits(vector=vector, lexical=lexical))
+    return out
+
+
+def _search_kb_hits(
+    kb: KnowledgeBase, index_path: Path, index, q_vec: np.ndarray, question: str, n_candidates: int, cfg: RagConfig
+) -> _KbHits:
+    return _search_kb_hits_batch(kb, index_path, index, q_vec, [question], n_candidates, cfg)[0]
+
+
+def _n_candidates(top_k: int, cfg: RagConfig) -> int:
+    return top_k * cfg.hybrid_fanout if cfg.hybrid else top_k
+
+
+def _search_chunk_ids(
+    kb: KnowledgeBase, index_path: Path, index, q_vec: np.ndarray, question: str, top_k: int, cfg: RagConfig
+) -> list[int]:
+    # 索引内部 id 即 DocumentChunk.id，文本由 _resolve_chunk_texts 按 id 取回。
+    hits = _search_kb_hits(kb, index_path, index, q_vec, question, _n_candidates(top_k, cfg), cfg)
+    selected_ids = [cid for _, cid in hits.vector]
+    lexical_ids = [cid for _, cid in hits.lexical]
+    if lexical_ids:
+        selected_ids = reciprocal_rank_fusion([selected_ids, lexical_ids], k=cfg.rrf_k)
+    return selected_ids[:top_k]
+
+
+def _rank_federated(
+    hits: list[tuple[int, _KbHits]], top_k: int, cfg: RagConfig
+) -> list[tuple[tuple[int, int], float]]:
+    """
+    合并多个知识库的候选，返回按相关度降序的 ((kb_id, chunk_id), RRF 分)。
+
+    各知识库使用同一 embedding 模型，向量距离可直接比较，全局堆取距离最小的候选；BM25 得分依赖各库自身的
+    词频统计，先按各库最高分归一化到 (0, 1] 再全局取堆。两路全局排名再按 RRF 融合，与单库检索的规则一致。
+    """
+    n = _n_candidates(top_k, cfg)
+    vector = heapq.nsmallest(n, ((d, pos, cid) for pos, (_, h) in enumerate(hits) for d, cid in h.vector))
+    rankings = [[(hits[pos][0], cid) for _, pos, cid in vector]]
+    lexical = heapq.nsmallest(
+        n,
+        (
+            (-score / h.lexical[0][0], pos, cid)
+            for pos, (_, h) in enumerate(hits)
+            if h.lexical and h.lexical[0][0] > 0
+            for score, cid in h.lexical
+        ),
+    )
+    if lexical:
+        rankings.append([(hits[pos][0], cid) for _, pos, cid in lexical])
+    return reciprocal_rank_scores(rankings, k=cfg.rrf_k)[:top_k]
+
+
+def _merge_federated(hits: list[tuple[int, _KbHits]], top_k: int, cfg: RagConfig) -> list[tuple[int, int]]:
+    return [key for key, _ in _rank_federated(hits, top_k, cfg)]
+
+
+_FEDERATED_POOL: ThreadPoolExecutor | None = None
+_FEDERATED_POOL_LOCK = threading.Lock()
+
+
+def _federated_pool() -> ThreadPoolExecutor:
+    global _FEDERATED_POOL
+    with _FEDERATED_POOL_LOCK:
+        if _FEDERATED_POOL is None:
+            workers = max(1, int(getattr(settings, "RAG_FEDERATED_WORKERS", 4)))
+            _FEDERATED_POOL = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="rag-federated")
+        return _FEDERATED_POOL
+
+
+def _resolve_chunk_texts(kb: KnowledgeBase, index_path: Path, chunk_ids: list[int]) -> dict[int, str]:
+    # 先读 mmap 的 chunk 文本文件（零数据库查询）；文件缺失或未覆盖的 chunk（旧知识库）才回表补齐。
+    text_by_id = lookup_chunk_texts(index_path, chunk_ids)
+    missing = [cid for cid in chunk_ids if cid not in text_by_id]
+    if missing:
+        rows = DocumentChunk.objects.filter(id__in=missing, document__kb=kb).values_list("id", "text")
+        text_by_id.update({int(i): (t or "") for i, t in rows})
+    return text_by_id
+
+
+def _open_kb_index(kb: KnowledgeBase):
     index_path = Path(kb.faiss_path)
     index = load_faiss_index(index_path)
     if index is None:
         raise RagError(400, "知识库索引不可用")
+    if not is_id_mapped(index):
+        # 旧版索引（位置寻址 + .meta.json）的迁移与知识库规模成正比：请求内只做标记，由后台一致性检查迁移；
+        # 迁移完成前经缓存的 .meta.json 映射只读检索，映射缺失或与索引不一致时才拒绝服务。
+        if kb.index_status != KnowledgeBase.INDEX_DEGRADED:
+            mark_index_degraded(kb.id, "legacy_index")
+        if legacy_id_map(index_path, index) is None:
+            raise RagError(503, "知识库索引正在升级，请稍后重试")
+    if count_vectors(index_path) <= 0:
+        raise RagError(400, "知识库暂无可检索内容")
+    return index_path, index
+
 
-    q_vec = embed_texts([(question or "").strip()])
-    q_vec = np.asarray(q_vec, dtype=np.float32)
-    if q_vec.ndim != 2 or q_vec.shape[0] != 1:
+def _embed_checked(questions: list[str], indexes: list) -> np.ndarray:
+    q_vecs = _embed_questions(questions)
+    if q_vecs.ndim != 2 or q_vecs.shape[0] != len(questions):
         raise RagError(500, "问题向量化失败")
+    for index in indexes:
+        if int(getattr(index, "d", -1)) != int(q_vecs.shape[1]):
+            raise RagError(500, "索引维度与 embedding 不一致，请重建索引")
+    return q_vecs
 
-    if int(getattr(index, "d", -1)) != int(q_vec.shape[1]):
-        raise RagError(500, "索引维度与 embedding 不一致，请重建索引")
-
-    _, idx = index.search(q_vec, int(top_k))
-    idx_list = [int(i) for i in idx[0].tolist() if int(i) >= 0]
-    contexts: list[str] = []
-    chunk_ids = load_faiss_meta(index_path)
-    if chunk_ids is None:
-        ids = list(
-            DocumentChunk.objects.filter(document__kb=kb)
-            .order_by("document_id", "chunk_index")
-            .values_list("id", flat=True)
-        )
-        if ids and int(getattr(index, "ntotal", 0)) == int(len(ids)):
-            save_faiss_meta(index_path, ids)
-            chunk_ids = ids
-    if chunk_ids and int(getattr(index, "ntotal", 0)) == int(len(chunk_ids)):
-        selected_ids = [chunk_ids[i] for i in idx_list if 0 <= i < len(chunk_ids)]
-        rows = DocumentChunk.objects.filter(id__in=selected_ids).values_list("id", "text")
-        text_by_id = {int(i): (t or "") for i, t in rows}
-        for cid in selected_ids:
-            t = (text_by_id.get(int(cid), "") or "").strip()
-            if t:
-                contexts.append(t)
-        if contexts:
-            return contexts
-
-    texts = list(
-        DocumentChunk.objects.filter(document__kb=kb)
-        .order_by("document_id", "chunk_index")
-        .values_list("text", flat=True)
-    )
-    if not texts:
-        raise RagError(400, "知识库暂无可检索内容")
-    for i in idx_list:
-        if 0 <= i < len(texts):
-            t = (texts[i] or "").strip()
-            if t:
-                contexts.append(t)
+
+@dataclass(frozen=True)
+class ScoredContext:
+    kb_id: int
+    chunk_id: int
+    text: str
+    # 问题与 chunk 的余弦相似度；缺少持久化向量（旧知识库尚未补建）时为 None。
+    score: float | None
+
+
+def _min_score(kb: KnowledgeBase, cfg: RagConfig) -> float | None:
+    return kb.min_score if kb.min_score is not None else cfg.min_score
+
+
+def _score_contexts(
+    kb: KnowledgeBase, index_path: Path, q_vec: np.ndarray, chunk_ids: list[int], text_by_id: dict[int, str], cfg: RagConfig
+) -> list[ScoredContext]:
+    # 按检索排名保留非空文本并附上余弦相似度；配置了阈值时丢弃低于阈值（或无法计算相似度）的 chunk。
+    scores = cosine_similarities(index_path, q_vec, chunk_ids)
+    threshold = _min_score(kb, cfg)
+    contexts: list[ScoredContext] = []
+    for cid in chunk_ids:
+        t = (text_by_id.get(cid, "") or "").strip()
+        score = scores.get(cid)
+        if not t or (threshold is not None and (score is None or score < threshold)):
+            continue
+        contexts.append(ScoredContext(kb_id=kb.id, chunk_id=cid, text=t, score=score))
     return contexts
 
 
-def rag_chat(kb: KnowledgeBase, question: str) -> str:
+def _retrieve_scored(kb: KnowledgeBase, question: str, top_k: int) -> tuple[list[ScoredContext], np.ndarray]:
+    # 返回 (带相似度的上下文, 问题向量)；问答路径复用问题向量查回答缓存，不再重复向量化。
+    index_path, index = _open_kb_index(kb)
+
+    # 问题向量与 top-k 结果走检索缓存；内容版本随知识库写入变化，文档增删后自动失效。
+    q_vec = _embed_checked([question], [index])
+
+    cfg = _get_rag_config()
+    lexical_query = normalize_question(question) if cfg.hybrid else ""
+    params = json.dumps(
+        [str(index_path), kb.index_config, cfg.hybrid, cfg.hybrid_fanout, cfg.rrf_k, lexical_query],
+        sort_keys=True,
+        default=str,
+    )
+    selected_ids = get_topk_ids(
+        kb.id,
+        str(kb.content_version),
+        q_vec,
+        int(top_k),
+        params,
+        lambda: _search_chunk_ids(kb, index_path, index, q_vec, question, int(top_k), cfg),
+    )
+    # 相似度由持久化向量精确计算，缓存命中与否结果一致；阈值在缓存之后过滤，调整阈值无需失效检索缓存。
+    text_by_id = _resolve_chunk_texts(kb, index_path, selected_ids)
+    return _score_contexts(kb, index_path, q_vec, selected_ids, text_by_id, cfg), q_vec
+
+
+def retrieve_scored_contexts(kb: KnowledgeBase, question: str, top_k: int) -> list[ScoredContext]:
+    return _retrieve_scored(kb, question, top_k)[0]
+
+
+def retrieve_contexts(kb: KnowledgeBase, question: str, top_k: int) -> list[str]:
+    return [c.text for c in retrieve_scored_contexts(kb, question, top_k)]
+
+
+def _search_kbs(
+    kbs: list[KnowledgeBase], question: str, top_k: int, cfg: RagConfig
+) -> tuple[list[tuple[KnowledgeBase, Path, object]], np.ndarray, list[tuple[int, _KbHits]]]:
+    # 打开各知识库索引并检索候选，返回 (已打开的 (kb, 索引路径, 索引), 问题向量, [(kb_id, 候选)])。
+    # 索引不可用或为空的知识库跳过（全部不可用时返回首个错误）；问题只向量化一次，多个知识库在线程池中并发检索。
+    opened = []
+    first_error: RagError | None = None
+    for kb in kbs:
+        try:
+            opened.append((kb, *_open_kb_index(kb)))
+        except RagError as e:
+            if e.status_code != 400:
+                raise
+            first_error = first_error or e
+    if not opened:
+        raise first_error or RagError(400, "知识库暂无可检索内容")
+
+    q_vec = _embed_checked([question], [index for _, _, index in opened])
+    n = _n_candidates(int(top_k), cfg)
+    if len(opened) == 1:
+        kb, index_path, index = opened[0]
+        return opened, q_vec, [(kb.id, _search_kb_hits(kb, index_path, index, q_vec, question, n, cfg))]
+    pool = _federated_pool()
+    futures = [
+        pool.submit(_search_kb_hits, kb, index_path, index, q_vec, question, n, cfg) for kb, index_path, index in opened
+    ]
+    return opened, q_vec, [(kb.id, f.result()) for (kb, _, _), f in zip(opened, futures)]
+
+
+def _retrieve_scored_federated(
+    kbs: list[KnowledgeBase], question: str, top_k: int
+) -> tuple[list[ScoredContext], np.ndarray]:
+    """
+    联合检索多个知识库：各库检索在线程池中并发执行，候选经归一化后全局合并取 top_k（见 _rank_federated）。
+    相关度阈值按各 chunk 所属知识库的 min_score 分别过滤。
+    """
+    cfg = _get_rag_config()
+    opened, q_vec, hits = _search_kbs(kbs, question, int(top_k), cfg)
+    selected = _merge_federated(hits, int(top_k), cfg)
+
+    # 按知识库分组取文本与相似度（数据库回表只在当前线程进行）。
+    ids_by_kb: dict[int, list[int]] = {}
+    for kb_id, cid in selected:
+        ids_by_kb.setdefault(kb_id, []).append(cid)
+    by_key: dict[tuple[int, int], ScoredContext] = {}
+    for kb, index_path, _ in opened:
+        if kb.id in ids_by_kb:
+            ids = ids_by_kb[kb.id]
+            text_by_id = _resolve_chunk_texts(kb, index_path, ids)
+            for c in _score_contexts(kb, index_path, q_vec, ids, text_by_id, cfg):
+                by_key[(kb.id, c.chunk_id)] = c
+    return [by_key[key] for key in selected if key in by_key], q_vec
+
+
+def retrieve_scored_contexts_federated(kbs: list[KnowledgeBase], question: str, top_k: int) -> list[ScoredContext]:
+    return _retrieve_scored_federated(kbs, question, top_k)[0]
+
+
+def retrieve_contexts_federated(kbs: list[KnowledgeBase], question: str, top_k: int) -> list[str]:
+    return [c.text for c in retrieve_scored_contexts_federated(kbs, question, top_k)]
+
+
+@dataclass(frozen=True)
+class RetrievedChunk:
+    chunk_id: int
+    # RRF 融合分，越大越相关（纯向量检索时按名次计算）；distance 为向量距离，仅由词法检索命中时为 None。
+    score: float
+    distance: float | None
+    text: str
+    # 余弦相似度（见 ScoredContext.score）
+    similarity: float | None = None
+
+
+def retrieve_batch(
+    kb: KnowledgeBase, questions: list[str], top_k: int | None = None
+) -> list[list[RetrievedChunk]]:
+    """
+    批量检索：N 个问题一次向量化（未命中问题向量缓存的部分合并为一次 embedding 调用）、一次 (N, dim) 矩阵检索，
+    全部命中 chunk 的文本一次取回（chunk 文本文件，缺失部分一次回表）。结果与问题一一对应，按相关度降序。
+
+    用于评测与内部工具；不经过 top-k 结果缓存（需要返回距离与分数）。top_k 缺省时取 RAG_TOP_K。
+    """
+    if not questions:
+        return []
+    index_path, index = _open_kb_index(kb)
+    q_vecs = _embed_checked(questions, [index])
+    cfg = _get_rag_config()
+    top_k = int(top_k or cfg.top_k)
+    all_hits = _search_kb_hits_batch(kb, index_path, index, q_vecs, questions, _n_candidates(top_k, cfg), cfg)
+
+    ranked: list[list[tuple[int, float, float | None]]] = []
+    for hits in all_hits:
+        distance = {cid: d for d, cid in hits.vector}
+        rankings = [[cid for _, cid in hits.vector]]
+        if hits.lexical:
+            rankings.append([cid for _, cid in hits.lexical])
+        fused = reciprocal_rank_scores(rankings, k=cfg.rrf_k)[:top_k]
+        ranked.append([(cid, score, distance.get(cid)) for cid, score in fused])
+
+    text_by_id = _resolve_chunk_texts(kb, index_path, list({cid for row in ranked for cid, _, _ in row}))
+    results: list[list[RetrievedChunk]] = []
+    for q_vec, row in zip(q_vecs, ranked):
+        similarity = cosine_similarities(index_path, q_vec, [cid for cid, _, _ in row])
+        results.append(
+            [
+                RetrievedChunk(
+                    chunk_id=cid,
+                    score=score,
+                    distance=dist,
+                    text=text_by_id.get(cid, ""),
+                    similarity=similarity.get(cid),
+                )
+                for cid, score, dist in row
+                if (text_by_id.get(cid, "") or "").strip()
+            ]
+        )
+    return results
+
+
+@dataclass(frozen=True)
+class SearchHit:
+    kb_id: int
+    chunk_id: int
+    document_id: int
+    filename: str
+    chunk_index: int
+    score: float
+    distance: float | None
+    text: str
+    similarity: float | None = None
+
+
+def search_chunks(
+    kbs: KnowledgeBase | list[KnowledgeBase], question: str, offset: int, limit: int
+) -> tuple[list[SearchHit], bool]:
+    """
+    纯检索（不调用大模型）：返回相关度排名第 offset ~ offset+limit 的 chunk 及是否还有下一页。
+
+    检索深度为 offset + limit + 1，耗时只含一次问题向量化与索引检索；文本与文档信息只对当前页的 chunk 取回
+    （文本走 chunk 文本文件，文档名与 chunk 序号一次查询）。多个知识库时与联合问答同样合并排序。
+    """
+    cfg = _get_rag_config()
+    depth = int(offset) + int(limit) + 1
+    opened, q_vec, hits = _search_kbs(_as_kb_list(kbs), question, depth, cfg)
+    ranked = _rank_federated(hits, depth, cfg)
+    has_more = len(ranked) > offset + limit
+    page = ranked[offset : offset + limit]
+
+    distance = {(kb_id, cid): d for kb_id, h in hits for d, cid in h.vector}
+    ids_by_kb: dict[int, list[int]] = {}
+    for (kb_id, cid), _ in page:
+        ids_by_kb.setdefault(kb_id, []).append(cid)
+    text_by_key: dict[tuple[int, int], str] = {}
+    similarity: dict[tuple[int, int], float] = {}
+    for kb, index_path, _ in opened:
+        if kb.id in ids_by_kb:
+            for cid, text in _resolve_chunk_texts(kb, index_path, ids_by_kb[kb.id]).items():
+                text_by_key[(kb.id, cid)] = text
+            for cid, sim in cosine_similarities(index_path, q_vec, ids_by_kb[kb.id]).items():
+                similarity[(kb.id, cid)] = sim
+    meta = {
+        int(cid): (int(doc_id), filename, int(chunk_index))
+        for cid, doc_id, filename, chunk_index in DocumentChunk.objects.filter(
+            id__in=[cid for (_, cid), _ in page], document__kb__in=[kb for kb, _, _ in opened]
+        ).values_list("id", "document_id", "document__filename", "chunk_index")
+    }
+
+    results: list[SearchHit] = []
+    for key, score in page:
+        text = text_by_key.get(key, "") or ""
+        # 已删除（索引尚未同步）或空文本的 chunk 不返回。
+        if key[1] not in meta or not text.strip():
+            continue
+        doc_id, filename, chunk_index = meta[key[1]]
+        results.append(
+            SearchHit(
+                kb_id=key[0],
+                chunk_id=key[1],
+                document_id=doc_id,
+                filename=filename,
+                chunk_index=chunk_index,
+                score=score,
+                distance=distance.get(key),
+                text=text,
+                similarity=similarity.get(key),
+            )
+        )
+    return results, has_more
+
+
+def _as_kb_list(kbs) -> list[KnowledgeBase]:
+    return [kbs] if isinstance(kbs, KnowledgeBase) else list(kbs)
+
+
+def _retrieve_for_chat(
+    kbs: list[KnowledgeBase], question: str, top_k: int
+) -> tuple[list[ScoredContext], np.ndarray]:
+    if len(kbs) == 1:
+        return _retrieve_scored(kbs[0], question, top_k=top_k)
+    return _retrieve_scored_federated(kbs, question, top_k=top_k)
+
+
+def _pack_for_prompt(scored: list[ScoredContext], cfg: RagConfig) -> tuple[list[str], list[ScoredContext]]:
+    """
+    把检索结果打包为 prompt 资料（相邻 chunk 拼接去重叠、按 token 预算装入，见 context_packer），
+    返回 (资料段落, 实际进入 prompt 的 chunk)。只为取 chunk 所属文档与序号查询一次数据库。
+    """
+    positions = {
+        int(cid): (int(doc_id), int(chunk_index))
+        for cid, doc_id, chunk_index in DocumentChunk.objects.filter(id__in=[c.chunk_id for c in scored]).values_list(
+            "id", "document_id", "chunk_index"
+        )
+    }
+    pieces = []
+    for rank, c in enumerate(scored):
+        # 已删除（索引尚未同步）的 chunk 取不到位置：单独成段，不与其他 chunk 拼接。
+        doc_id, chunk_index = positions.get(c.chunk_id, (-c.chunk_id, 0))
+        pieces.append(
+            ContextPiece(
+                key=(c.kb_id, c.chunk_id), document_id=doc_id, chunk_index=chunk_index, text=c.text, score=c.score, rank=rank
+            )
+        )
+    packed = pack_contexts(pieces, max_tokens=cfg.max_context_tokens, max_chars=cfg.max_context_chars)
+    included = {key for block in packed for key in block.keys}
+    return [block.text for block in packed], [c for c in scored if (c.kb_id, c.chunk_id) in included]
+
+
+def _sources(contexts: list[ScoredContext]) -> list[dict]:
+    return [{"kb_id": c.kb_id, "chunk_id": c.chunk_id, "score": c.score} for c in contexts]
+
+
+def _no_match_payload(cfg: RagConfig, t0: float) -> dict:
+    # 没有 chunk 达到相关度阈值：直接返回固定回答，不调用大模型、不读写回答缓存。
+    return {
+        "answer": cfg.no_match_answer,
+        "elapsed_ms": int(max(0.0, (time.perf_counter() - t0) * 1000.0)),
+        "token_usage": _usage_dict(TokenUsage(None, None, None)),
+        "cache_hit": False,
+        "sources": [],
+    }
+
+
+def _usage_dict(usage: TokenUsage) -> dict:
+    return {
+        "prompt_tokens": usage.prompt_tokens,
+        "completion_tokens": usage.completion_tokens,
+        "total_tokens": usage.total_tokens,
+    }
+
+
+def _cache_scope(kbs: list[KnowledgeBase]) -> tuple[int | str, str]:
+    # 单库时范围为知识库 id；联合检索时为各知识库 id 以逗号连接，版本同理，任一知识库变化即失效。
+    if len(kbs) == 1:
+        return kbs[0].id, str(kbs[0].content_version)
+    ordered = sorted(kbs, key=lambda kb: kb.id)
+    return ",".join(str(kb.id) for kb in ordered), ",".join(str(kb.content_version) for kb in ordered)
+
+
+def _answer_cache_key(kbs: list[KnowledgeBase], question: str, contexts: list[str], cfg: RagConfig, q_vec: np.ndarray):
+    """
+    返回 (缓存范围, 内容版本, prompt 哈希, 问题向量)；q_vec 为检索时已算出的问题向量，不再重复向量化。
+
+    回答缓存关闭时返回 None，不构建 prompt、不计算哈希。
+    """
+    if not answer_cache_enabled():
+        return None
+    backend = (os.getenv("RAG_LLM_BACKEND", "") or "openai").lower()
+    model = "fake" if backend == "fake" else _get_llm_config().model
+    prompt = _build_prompt(question, contexts)
+    scope, version = _cache_scope(kbs)
+    return scope, version, prompt_hash(model, prompt), q_vec
+
+
+def rag_chat(kbs: KnowledgeBase | list[KnowledgeBase], question: str) -> dict:
+    # kbs 为单个知识库或知识库列表（联合检索，只构建一个 prompt、调用一次 LLM）。
+    kbs = _as_kb_list(kbs)
     cfg = _get_rag_config()
     t0 = time.perf_counter()
-    contexts = retrieve_contexts(kb, question, top_k=cfg.top_k)
+    scored, q_vec = _retrieve_for_chat(kbs, question, top_k=cfg.top_k)
+    if not scored:
+        return _no_match_payload(cfg, t0)
+    contexts, scored = _pack_for_prompt(scored, cfg)
     t1 = time.perf_counter()
-    answer, usage = generate_answer_with_usage(question, contexts, max_context_chars=cfg.max_context_chars)
+    cache_key = _answer_cache_key(kbs, question, contexts, cfg, q_vec)
+    cached = lookup_answer(*cache_key) if cache_key else None
+    if cached is not None:
+        answer, token_usage = cached.answer, cached.token_usage or _usage_dict(TokenUsage(None, None, None))
+    else:
+        answer, usage = generate_answer_with_usage(question, contexts)
+        token_usage = _usage_dict(usage)
     t2 = time.perf_counter()
     answer = (answer or "").strip()
     if not answer:
         raise RagError(500, "生成回答失败")
+    if cached is None and cache_key:
+        store_answer(*cache_key, answer, token_usage)
     if (os.getenv("RAG_LOG_TIMINGS", "") or "").strip() == "1":
         logger.info(
-            "rag_chat kb=%s retrieve_ms=%.1f generate_ms=%.1f total_ms=%.1f",
-            getattr(kb, "id", None),
+            "rag_chat kb=%s retrieve_ms=%.1f generate_ms=%.1f total_ms=%.1f cache_hit=%s",
+            _cache_scope(kbs)[0],
             (t1 - t0) * 1000.0,
             (t2 - t1) * 1000.0,
             (t2 - t0) * 1000.0,
+            cached.match if cached else "-",
         )
     elapsed_ms = int(max(0.0, (t2 - t0) * 1000.0))
     return {
         "answer": answer,
         "elapsed_ms": elapsed_ms,
-        "token_usage": {
-            "prompt_tokens": usage.prompt_tokens,
-            "completion_tokens": usage.completion_tokens,
-            "total_tokens": usage.total_tokens,
-        },
+        "token_usage": token_usage,
+        "cache_hit": cached is not None,
+        "sources": _sources(scored),
     }
 
 
-def rag_chat_stream(kb: KnowledgeBase, question: str):
+def _replay_answer(answer: str, piece_chars: int = 32):
+    # 命中缓存时按小段回放，前端仍按流式逐步渲染。
+    for i in range(0, len(answer), piece_chars):
+        yield answer[i : i + piece_chars]
+
+
+def rag_chat_stream(kbs: KnowledgeBase | list[KnowledgeBase], question: str):
+    kbs = _as_kb_list(kbs)
     cfg = _get_rag_config()
     t0 = time.perf_counter()
-    contexts = retrieve_contexts(kb, question, top_k=cfg.top_k)
+    scored, q_vec = _retrieve_for_chat(kbs, question, top_k=cfg.top_k)
+    if not scored:
+        state = _no_match_payload(cfg, t0)
+        return _replay_answer(state["answer"]), state
+    contexts, scored = _pack_for_prompt(scored, cfg)
     t1 = time.perf_counter()
+    cache_key = _answer_cache_key(kbs, question, contexts, cfg, q_vec)
+    cached = lookup_answer(*cache_key) if cache_key else None
     answer_parts: list[str] = []
     stream_state = {
         "answer": "",
         "elapsed_ms": 0,
-        "token_usage": {
-            "prompt_tokens": None,
-            "completion_tokens": None,
-            "total_tokens": None,
-        },
+        "token_usage": (cached.token_usage if cached else None) or _usage_dict(TokenUsage(None, None, None)),
+        "cache_hit": cached is not None,
+        "sources": _sources(scored),
     }
 
     def gen():
+        completed = False
         try:
-            for delta in stream_answer(question, contexts, max_context_chars=cfg.max_context_chars):
+            if cached is not None:
+                deltas = _replay_answer(cached.answer)
+            else:
+                deltas = stream_answer(question, contexts)
+            for delta in deltas:
                 if delta:
                     answer_parts.append(delta)
                     yield delta
+            completed = True
         finally:
             t2 = time.perf_counter()
             answer = "".join(answer_parts).strip()
             stream_state["answer"] = answer
             stream_state["elapsed_ms"] = int(max(0.0, (t2 - t0) * 1000.0))
+            if completed and cached is None and cache_key:
+                # 只缓存完整生成的回答；客户端中途断开时不写入。
+                store_answer(*cache_key, answer, stream_state["token_usage"])
             if (os.getenv("RAG_LOG_TIMINGS", "") or "").strip() == "1":
                 logger.info(
-                    "rag_chat_stream kb=%s retrieve_ms=%.1f generate_ms=%.1f total_ms=%.1f",
-                    getattr(kb, "id", None),
+                    "rag_chat_stream kb=%s retrieve_ms=%.1f generate_ms=%.1f total_ms=%.1f cache_hit=%s",
+                    _cache_scope(kbs)[0],
                     (t1 - t0) * 1000.0,
                     (t2 - t1) * 1000.0,
                     (t2 - t0) * 1000.0,
+                    cached.match if cached else "-",
                 )
 
     return gen(), stream_state
@@ -11,6 +11,8 @@ from rest_framework.test import APITestCase
 User = get_user_model()
 
 
+# 上传接口在请求内同步入库，便于直接断言文档与索引。
+@override_settings(KB_INGEST_ASYNC=False)
 class RagChatApiTests(APITestCase):
     def setUp(self):
         os.environ["KB_EMBEDDING_BACKEND"] = "fake"
@@ -160,3 +162,588 @@ class RagChatApiTests(APITestCase):
                 answer = b"".join(stream_resp.streaming_content).decode("utf-8")
                 self.assertTrue(answer.strip())
                 self.assertTrue(stream_resp.headers.get("X-Session-ID"))
+
+
+class RetrievalCacheTests(APITestCase):
+    def setUp(self):
+        from rag.retrieval_cache import clear_retrieval_cache
+
+        os.environ["KB_EMBEDDING_BACKEND"] = "fake"
+        self.user = User.objects.create_user(username="rc_u1", password="StrongPass123!@#")
+        clear_retrieval_cache()
+
+    def tearDown(self):
+        os.environ.pop("KB_EMBEDDING_BACKEND", None)
+
+    def test_question_vector_and_topk_are_cached_until_kb_changes(self):
+        from unittest import mock
+
+        from knowledge.models import Document, DocumentChunk, KnowledgeBase
+        from knowledge.services import bump_content_version
+        from knowledge.vectorstore import add_vectors_to_index, remove_vectors_from_index
+        from rag import services
+        from rag.retrieval_cache import retrieval_cache_stats
+
+        with tempfile.TemporaryDirectory() as faiss_dir, tempfile.TemporaryDirectory() as cache_dir:
+            with override_settings(RAG_CACHE_DIR=cache_dir):
+                kb = KnowledgeBase.objects.create(
+                    user=self.user, name="kb1", faiss_path=str(Path(faiss_dir) / "kb.index")
+                )
+                doc = Document.objects.create(kb=kb, filename="a.txt", file_path="", chunk_count=6)
+                texts = [f"第 {i} 段：安装与配置说明" for i in range(6)]
+                DocumentChunk.objects.bulk_create(
+                    [DocumentChunk(document=doc, chunk_index=i, text=t) for i, t in enumerate(texts)]
+                )
+                ids = list(DocumentChunk.objects.filter(document=doc).order_by("chunk_index").values_list("id", flat=True))
+                add_vectors_to_index(Path(kb.faiss_path), texts, chunk_ids=ids)
+
+                with mock.patch.object(services, "embed_texts", wraps=services.embed_texts) as embed, mock.patch.object(
+                    services, "search_index", wraps=services.search_index
+                ) as search:
+                    first = services.retrieve_contexts(kb, "如何 安装？", top_k=2)
+                    # 仅空白 / 全半角 / 大小写不同的问题命中同一缓存条目。
+                    second = services.retrieve_contexts(kb, " 如何  安装? ", top_k=2)
+                    self.assertEqual(first, second)
+                    self.assertEqual(embed.call_count, 1)
+                    self.assertEqual(search.call_count, 1)
+
+                    # 删除 chunk 后内容版本变化，top-k 重新检索（问题向量仍命中）。
+                    remove_vectors_from_index(Path(kb.faiss_path), ids[:3])
+                    DocumentChunk.objects.filter(id__in=ids[:3]).delete()
+                    bump_content_version(kb.id)
+                    kb.refresh_from_db()
+                    third = services.retrieve_contexts(kb, "如何 安装？", top_k=2)
+                    self.assertEqual(embed.call_count, 1)
+                    self.assertEqual(search.call_count, 2)
+                    self.assertTrue(set(third) <= set(texts[3:]))
+
+                stats = retrieval_cache_stats()
+                self.assertEqual(stats["vector_hits"], 2)
+                self.assertEqual(stats["topk_hits"], 1)
+                self.assertTrue(stats["disk"]["enabled"])
+
+
+@override_settings(KB_INGEST_ASYNC=False)
+class AnswerCacheTests(APITestCase):
+    def setUp(self):
+        from rag.answer_cache import clear_answer_cache
+
+        os.environ["KB_EMBEDDING_BACKEND"] = "fake"
+        os.environ["RAG_LLM_BACKEND"] = "fake"
+        self.user = User.objects.create_user(username="ac_u1", password="StrongPass123!@#")
+        clear_answer_cache()
+
+    def tearDown(self):
+        os.environ.pop("KB_EMBEDDING_BACKEND", None)
+        os.environ.pop("RAG_LLM_BACKEND", None)
+
+    def _login(self) -> str:
+        resp = self.client.post(
+            "/api/users/login", {"username": "ac_u1", "password": "StrongPass123!@#"}, format="json"
+        )
+        return resp.data["access"]
+
+    def _upload(self, access: str, kb_id: int, name: str, body: bytes):
+        resp = self.client.post(
+            "/api/knowledge/upload",
+            {"kb_id": kb_id, "file": SimpleUploadedFile(name, body, content_type="text/plain")},
+            format="multipart",
+            HTTP_AUTHORIZATION=f"Bearer {access}",
+        )
+        self.assertEqual(resp.status_code, 201)
+
+    def test_repeated_question_is_served_from_cache_until_kb_changes(self):
+        from unittest import mock
+
+        from rag import services
+        from rag.models import ChatHistory
+
+        with tempfile.TemporaryDirectory() as faiss_dir, tempfile.TemporaryDirectory() as upload_dir:
+            with override_settings(FAISS_INDEX_ROOT=Path(faiss_dir), KB_UPLOAD_ROOT=Path(upload_dir)):
+                access = self._login()
+                kb_id = self.client.post(
+                    "/api/knowledge/create", {"name": "kb1"}, format="json", HTTP_AUTHORIZATION=f"Bearer {access}"
+                ).data["id"]
+                self._upload(access, kb_id, "a.txt", b"hello cache\n" * 50)
+
+                def ask(path="/api/rag/chat"):
+                    return self.client.post(
+                        path, {"kb_id": kb_id, "question": "hello?"}, format="json", HTTP_AUTHORIZATION=f"Bearer {access}"
+                    )
+
+                with mock.patch.object(
+                    services, "generate_answer_with_usage", wraps=services.generate_answer_with_usage
+                ) as generate, mock.patch.object(services, "stream_answer", wraps=services.stream_answer) as stream:
+                    first = ask()
+                    second = ask()
+                    self.assertFalse(first.data["cache_hit"])
+                    self.assertTrue(second.data["cache_hit"])
+                    self.assertEqual(second.data["answer"], first.data["answer"])
+                    self.assertEqual(generate.call_count, 1)
+
+                    streamed = ask("/api/rag/chat/stream")
+                    self.assertEqual(streamed.headers.get("X-Cache-Hit"), "1")
+                    self.assertEqual(b"".join(streamed.streaming_content).decode("utf-8"), first.data["answer"])
+                    self.assertEqual(stream.call_count, 0)
+
+                    # 上传新文档后内容版本变化，重新生成。
+                    self._upload(access, kb_id, "b.txt", b"another doc\n" * 50)
+                    self.assertFalse(ask().data["cache_hit"])
+                    self.assertEqual(generate.call_count, 2)
+
+                self.assertEqual(
+                    list(ChatHistory.objects.filter(kb_id=kb_id).order_by("id").values_list("cache_hit", flat=True)),
+                    [False, True, True, False],
+                )
+
+    def test_chat_embeds_question_once_and_skips_key_when_cache_disabled(self):
+        from unittest import mock
+
+        from knowledge.models import Document, DocumentChunk, KnowledgeBase
+        from knowledge.vectorstore import add_vectors_to_index
+        from rag import services
+
+        with tempfile.TemporaryDirectory() as faiss_dir:
+            kb = KnowledgeBase.objects.create(user=self.user, name="kb1", faiss_path=str(Path(faiss_dir) / "kb.index"))
+            doc = Document.objects.create(kb=kb, filename="a.txt", file_path="", chunk_count=1)
+            chunk = DocumentChunk.objects.create(document=doc, chunk_index=0, text="hello cache")
+            add_vectors_to_index(Path(kb.faiss_path), ["hello cache"], chunk_ids=[chunk.id])
+
+            # 检索已算出的问题向量直接用于回答缓存，问题向量缓存关闭时也只向量化一次。
+            for answer_cache in (True, False):
+                with override_settings(RAG_CACHE_TTL_SECONDS=0, RAG_ANSWER_CACHE=answer_cache), mock.patch.object(
+                    services, "embed_texts", wraps=services.embed_texts
+                ) as embed, mock.patch.object(services, "prompt_hash", wraps=services.prompt_hash) as key:
+                    services.rag_chat(kb, "hello?")
+                self.assertEqual(embed.call_count, 1)
+                self.assertEqual(key.call_count, 1 if answer_cache else 0)
+
+    def test_semantic_lookup_uses_cosine_threshold(self):
+        import numpy as np
+
+        from rag.answer_cache import lookup_answer, store_answer
+
+        with override_settings(RAG_ANSWER_CACHE_THRESHOLD=0.9):
+            store_answer(1, "v1", "k1", np.array([[1.0, 0.0]], dtype=np.float32), "答案", {"total_tokens": 12})
+            hit = lookup_answer(1, "v1", "k2", np.array([[0.95, 0.1]], dtype=np.float32))
+            self.assertEqual((hit.answer, hit.match, hit.token_usage), ("答案", "semantic", {"total_tokens": 12}))
+            self.assertIsNone(lookup_answer(1, "v1", "k3", np.array([[0.3, 1.0]], dtype=np.float32)))
+            self.assertIsNone(lookup_answer(1, "v2", "k1", np.array([[1.0, 0.0]], dtype=np.float32)))
+            self.assertEqual(lookup_answer(1, "v1", "k1", None).match, "exact")
+
+
+class FederatedRetrievalTests(APITestCase):
+    def setUp(self):
+        from rag.answer_cache import clear_answer_cache
+        from rag.retrieval_cache import clear_retrieval_cache
+
+        os.environ["KB_EMBEDDING_BACKEND"] = "fake"
+        os.environ["RAG_LLM_BACKEND"] = "fake"
+        self.user = User.objects.create_user(username="fed_u1", password="StrongPass123!@#")
+        self.other = User.objects.create_user(username="fed_u2", password="StrongPass123!@#")
+        clear_retrieval_cache()
+        clear_answer_cache()
+
+    def tearDown(self):
+        os.environ.pop("KB_EMBEDDING_BACKEND", None)
+        os.environ.pop("RAG_LLM_BACKEND", None)
+
+    def _kb(self, user, faiss_dir: str, name: str, texts: list[str]):
+        from knowledge.models import Document, DocumentChunk, KnowledgeBase
+        from knowledge.vectorstore import add_vectors_to_index
+
+        kb = KnowledgeBase.objects.create(user=user, name=name, faiss_path=str(Path(faiss_dir) / f"{name}.index"))
+        doc = Document.objects.create(kb=kb, filename="a.txt", file_path="", chunk_count=len(texts))
+        DocumentChunk.objects.bulk_create(
+            [DocumentChunk(document=doc, chunk_index=i, text=t) for i, t in enumerate(texts)]
+        )
+        ids = list(DocumentChunk.objects.filter(document=doc).order_by("chunk_index").values_list("id", flat=True))
+        add_vectors_to_index(Path(kb.faiss_path), texts, chunk_ids=ids)
+        return kb
+
+    def test_merge_normalizes_lexical_scores_per_kb(self):
+        from rag.services import RagConfig, _KbHits, _merge_federated
+
+        # 向量距离跨库直接比较。
+        vector_only = RagConfig(top_k=2, max_context_chars=1000, hybrid=False)
+        hits = [
+            (1, _KbHits(vector=[(0.9, 11), (1.5, 12)], lexical=[])),
+            (2, _KbHits(vector=[(0.1, 21), (2.0, 22)], lexical=[])),
+        ]
+        self.assertEqual(_merge_federated(hits, 2, vector_only), [(2, 21), (1, 11)])
+
+        # BM25 按各库最高分归一化：库 2 的最佳匹配（原始分 1.0）排在库 1 的次优匹配（原始分 2.0）之前。
+        cfg = RagConfig(top_k=3, max_context_chars=1000, hybrid=True, hybrid_fanout=2, rrf_k=60)
+        hits = [
+            (1, _KbHits(vector=[], lexical=[(20.0, 12), (2.0, 11)])),
+            (2, _KbHits(vector=[], lexical=[(1.0, 22)])),
+        ]
+        self.assertEqual(_merge_federated(hits, 3, cfg), [(1, 12), (2, 22), (1, 11)])
+
+    def test_chat_over_several_kbs_builds_one_prompt(self):
+        from unittest import mock
+
+        from rag import services
+        from rag.models import ChatHistory
+
+        with tempfile.TemporaryDirectory() as faiss_dir:
+            kb_a = self._kb(self.user, faiss_dir, "kb_a", [f"产品 A 的第 {i} 条说明" for i in range(4)])
+            kb_b = self._kb(self.user, faiss_dir, "kb_b", [f"产品 B 的第 {i} 条说明" for i in range(4)])
+            empty = self._kb(self.user, faiss_dir, "kb_empty", [])
+            foreign = self._kb(self.other, faiss_dir, "kb_other", ["别人的资料"])
+
+            contexts = services.retrieve_contexts_federated([kb_a, kb_b, empty], "产品 B 的第 2 条说明", top_k=3)
+            self.assertEqual(contexts[0], "产品 B 的第 2 条说明")
+
+            access = self.client.post(
+                "/api/users/login", {"username": "fed_u1", "password": "StrongPass123!@#"}, format="json"
+            ).data["access"]
+            auth = {"HTTP_AUTHORIZATION": f"Bearer {access}"}
+            self.assertEqual(
+                self.client.post(
+                    "/api/rag/chat", {"kb_ids": [kb_a.id, foreign.id], "question": "hi"}, format="json", **auth
+                ).status_code,
+                404,
+            )
+            with mock.patch.object(
+                services, "generate_answer_with_usage", wraps=services.generate_answer_with_usage
+            ) as gen:
+                resp = self.client.post(
+                    "/api/rag/chat",
+                    {"kb_ids": [kb_a.id, kb_b.id], "question": "产品 A 的第 1 条说明"},
+                    format="json",
+                    **auth,
+                )
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(gen.call_count, 1)
+            merged = gen.call_args[0][1]
+            # 同一文档相邻的 chunk 拼接为一段，最相关的一段在前。
+            self.assertIn("产品 A 的第 1 条说明", merged[0].split("\n"))
+            history = ChatHistory.objects.get(user=self.user)
+            self.assertEqual((history.kb_id, history.kb_ids), (kb_a.id, [kb_a.id, kb_b.id]))
+
+            stream = self.client.post(
+                "/api/rag/chat/stream",
+                {"kb_ids": [kb_b.id, kb_a.id], "question": "产品 B 的第 3 条说明"},
+                format="json",
+                **auth,
+            )
+            self.assertEqual(stream.status_code, 200)
+            self.assertIn("产品 B 的第 3 条说明", b"".join(stream.streaming_content).decode("utf-8"))
+
+
+class BatchRetrievalTests(APITestCase):
+    def setUp(self):
+        from rag.retrieval_cache import clear_retrieval_cache
+
+        os.environ["KB_EMBEDDING_BACKEND"] = "fake"
+        self.user = User.objects.create_user(username="batch_u1", password="StrongPass123!@#")
+        clear_retrieval_cache()
+
+    def tearDown(self):
+        os.environ.pop("KB_EMBEDDING_BACKEND", None)
+
+    def test_questions_are_embedded_and_searched_in_one_call(self):
+        from unittest import mock
+
+        from knowledge.models import Document, DocumentChunk, KnowledgeBase
+        from knowledge.vectorstore import add_vectors_to_index
+        from rag import services
+
+        with tempfile.TemporaryDirectory() as faiss_dir:
+            kb = KnowledgeBase.objects.create(user=self.user, name="kb1", faiss_path=str(Path(faiss_dir) / "kb.index"))
+            doc = Document.objects.create(kb=kb, filename="a.txt", file_path="", chunk_count=10)
+            texts = [f"批量检索第 {i} 段" for i in range(10)]
+            DocumentChunk.objects.bulk_create(
+                [DocumentChunk(document=doc, chunk_index=i, text=t) for i, t in enumerate(texts)]
+            )
+            ids = list(DocumentChunk.objects.filter(document=doc).order_by("chunk_index").values_list("id", flat=True))
+            add_vectors_to_index(Path(kb.faiss_path), texts, chunk_ids=ids)
+
+            questions = [texts[3], texts[7], f" {texts[3]} "]
+            with mock.patch.object(services, "embed_texts", wraps=services.embed_texts) as embed, mock.patch.object(
+                services, "search_index", wraps=services.search_index
+            ) as search, self.assertNumQueries(0):
+                results = services.retrieve_batch(kb, questions, top_k=3)
+            # 同批内规范化后相同的问题只向量化一次；全部问题一次矩阵检索。
+            embed.assert_called_once_with([texts[3], texts[7]])
+            self.assertEqual(search.call_count, 1)
+            self.assertEqual(search.call_args[0][2].shape[0], 3)
+
+            self.assertEqual(len(results), 3)
+            for row, expected in zip(results, (3, 7, 3)):
+                self.assertEqual((row[0].chunk_id, row[0].text, row[0].distance), (ids[expected], texts[expected], 0.0))
+                scores = [hit.score for hit in row]
+                self.assertEqual(scores, sorted(scores, reverse=True))
+
+            access = self.client.post(
+                "/api/users/login", {"username": "batch_u1", "password": "StrongPass123!@#"}, format="json"
+            ).data["access"]
+            auth = {"HTTP_AUTHORIZATION": f"Bearer {access}"}
+            resp = self.client.post(
+                "/api/rag/search/batch", {"kb_id": kb.id, "questions": questions, "top_k": 2}, format="json", **auth
+            )
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual([r["hits"][0]["chunk_id"] for r in resp.data["results"]], [ids[3], ids[7], ids[3]])
+            self.assertEqual(len(resp.data["results"][0]["hits"]), 2)
+
+            with override_settings(RAG_BATCH_MAX_QUESTIONS=2):
+                resp = self.client.post(
+                    "/api/rag/search/batch", {"kb_id": kb.id, "questions": questions}, format="json", **auth
+                )
+            self.assertEqual(resp.status_code, 400)
+            resp = self.client.post(
+                "/api/rag/search/batch", {"kb_id": kb.id + 1, "questions": ["x"]}, format="json", **auth
+            )
+            self.assertEqual(resp.status_code, 404)
+
+
+class SearchApiTests(APITestCase):
+    def setUp(self):
+        from rag.retrieval_cache import clear_retrieval_cache
+
+        os.environ["KB_EMBEDDING_BACKEND"] = "fake"
+        self.user = User.objects.create_user(username="search_u1", password="StrongPass123!@#")
+        self.other = User.objects.create_user(username="search_u2", password="StrongPass123!@#")
+        clear_retrieval_cache()
+        access = self.client.post(
+            "/api/users/login", {"username": "search_u1", "password": "StrongPass123!@#"}, format="json"
+        ).data["access"]
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {access}")
+
+    def tearDown(self):
+        os.environ.pop("KB_EMBEDDING_BACKEND", None)
+
+    def _kb(self, user, faiss_dir: str, name: str, texts: list[str]):
+        from knowledge.models import Document, DocumentChunk, KnowledgeBase
+        from knowledge.vectorstore import add_vectors_to_index
+
+        kb = KnowledgeBase.objects.create(user=user, name=name, faiss_path=str(Path(faiss_dir) / f"{name}.index"))
+        doc = Document.objects.create(kb=kb, filename=f"{name}.txt", file_path="", chunk_count=len(texts))
+        DocumentChunk.objects.bulk_create(
+            [DocumentChunk(document=doc, chunk_index=i, text=t) for i, t in enumerate(texts)]
+        )
+        ids = list(DocumentChunk.objects.filter(document=doc).order_by("chunk_index").values_list("id", flat=True))
+        add_vectors_to_index(Path(kb.faiss_path), texts, chunk_ids=ids)
+        return kb, doc, ids
+
+    def test_search_returns_paged_chunks_without_llm(self):
+        from users.models import UserUsage
+
+        with tempfile.TemporaryDirectory() as faiss_dir:
+            texts = [f"检索接口第 {i} 段" for i in range(12)]
+            kb, doc, ids = self._kb(self.user, faiss_dir, "kb1", texts)
+
+            resp = self.client.get("/api/rag/search", {"kb_id": kb.id, "question": texts[5], "page_size": 3})
+            self.assertEqual(resp.status_code, 200)
+            self.assertTrue(resp.data["has_more"])
+            first = resp.data["results"][0]
+            self.assertEqual(
+                (first["kb_id"], first["chunk_id"], first["document_id"], first["filename"], first["chunk_index"]),
+                (kb.id, ids[5], doc.id, "kb1.txt", 5),
+            )
+            self.assertEqual((first["text"], first["distance"]), (texts[5], 0.0))
+            page1 = [r["chunk_id"] for r in resp.data["results"]]
+            self.assertEqual(len(page1), 3)
+
+            resp = self.client.get(
+                "/api/rag/search", {"kb_id": kb.id, "question": texts[5], "page": 2, "page_size": 3}
+            )
+            self.assertEqual(resp.status_code, 200)
+            page2 = [r["chunk_id"] for r in resp.data["results"]]
+            self.assertEqual(len(page2), 3)
+            self.assertFalse(set(page1) & set(page2))
+
+            # 最后一页
+            resp = self.client.get(
+                "/api/rag/search", {"kb_id": kb.id, "question": texts[5], "page": 3, "page_size": 5}
+            )
+            self.assertEqual(len(resp.data["results"]), 2)
+            self.assertFalse(resp.data["has_more"])
+
+            # 纯检索不计入聊天次数
+            self.assertFalse(UserUsage.objects.filter(user=self.user, chat_count__gt=0).exists())
+
+    def test_search_multiple_kbs_and_validation(self):
+        with tempfile.TemporaryDirectory() as faiss_dir:
+            kb1, _, _ = self._kb(self.user, faiss_dir, "kb1", ["甲库第一段", "甲库第二段"])
+            kb2, _, ids2 = self._kb(self.user, faiss_dir, "kb2", ["乙库第一段", "乙库第二段"])
+            other, _, _ = self._kb(self.other, faiss_dir, "kb3", ["他人的段落"])
+
+            resp = self.client.get("/api/rag/search", {"kb_ids": [kb1.id, kb2.id], "question": "乙库第二段"})
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(len(resp.data["results"]), 4)
+            self.assertEqual(
+                (resp.data["results"][0]["kb_id"], resp.data["results"][0]["chunk_id"]), (kb2.id, ids2[1])
+            )
+
+            resp = self.client.get("/api/rag/search", {"kb_ids": [kb1.id, other.id], "question": "x"})
+            self.assertEqual(resp.status_code, 404)
+            resp = self.client.get("/api/rag/search", {"kb_id": kb1.id, "question": "x", "page": 6, "page_size": 10})
+            self.assertEqual(resp.status_code, 400)
+            resp = self.client.get("/api/rag/search", {"kb_id": kb1.id})
+            self.assertEqual(resp.status_code, 400)
+
+
+class RelevanceThresholdTests(APITestCase):
+    def setUp(self):
+        from rag.answer_cache import clear_answer_cache
+        from rag.retrieval_cache import clear_retrieval_cache
+
+        os.environ["KB_EMBEDDING_BACKEND"] = "fake"
+        os.environ["RAG_LLM_BACKEND"] = "fake"
+        self.user = User.objects.create_user(username="thr_u1", password="StrongPass123!@#")
+        clear_retrieval_cache()
+        clear_answer_cache()
+
+    def tearDown(self):
+        for key in ("KB_EMBEDDING_BACKEND", "RAG_LLM_BACKEND", "RAG_MIN_SCORE", "RAG_TOP_K"):
+            os.environ.pop(key, None)
+
+    def _kb(self, faiss_dir: str, texts: list[str]):
+        from knowledge.models import Document, DocumentChunk, KnowledgeBase
+        from knowledge.vectorstore import add_vectors_to_index
+
+        kb = KnowledgeBase.objects.create(user=self.user, name="kb1", faiss_path=str(Path(faiss_dir) / "kb.index"))
+        doc = Document.objects.create(kb=kb, filename="a.txt", file_path="", chunk_count=len(texts))
+        DocumentChunk.objects.bulk_create(
+            [DocumentChunk(document=doc, chunk_index=i, text=t) for i, t in enumerate(texts)]
+        )
+        ids = list(DocumentChunk.objects.filter(document=doc).order_by("chunk_index").values_list("id", flat=True))
+        add_vectors_to_index(Path(kb.faiss_path), texts, chunk_ids=ids)
+        return kb, ids
+
+    def test_contexts_carry_cosine_scores_and_threshold_filters(self):
+        from rag import services
+
+        with tempfile.TemporaryDirectory() as faiss_dir:
+            texts = [f"相关度阈值第 {i} 段" for i in range(6)]
+            kb, ids = self._kb(faiss_dir, texts)
+
+            contexts = services.retrieve_scored_contexts(kb, texts[2], top_k=3)
+            self.assertEqual((contexts[0].chunk_id, contexts[0].text), (ids[2], texts[2]))
+            self.assertAlmostEqual(contexts[0].score, 1.0, places=5)
+            self.assertTrue(all(-1.0 <= c.score <= 1.0 + 1e-6 for c in contexts))
+            self.assertGreater(len(contexts), 1)
+
+            # 知识库阈值优先于全局阈值；阈值在检索缓存之后过滤，缓存命中时同样生效。
+            os.environ["RAG_MIN_SCORE"] = "-1"
+            kb.min_score = 0.999
+            self.assertEqual([c.chunk_id for c in services.retrieve_scored_contexts(kb, texts[2], top_k=3)], [ids[2]])
+            self.assertEqual(services.retrieve_contexts(kb, texts[2], top_k=3), [texts[2]])
+
+    def test_no_match_returns_canned_answer_without_llm(self):
+        from unittest import mock
+
+        from rag import services
+
+        with tempfile.TemporaryDirectory() as faiss_dir:
+            texts = [f"相关度阈值第 {i} 段" for i in range(4)]
+            kb, ids = self._kb(faiss_dir, texts)
+            kb.min_score = 0.999
+            kb.save(update_fields=["min_score"])
+
+            with mock.patch.object(
+                services, "generate_answer_with_usage", side_effect=AssertionError("不应调用大模型")
+            ), mock.patch.object(services, "stream_answer", side_effect=AssertionError("不应调用大模型")):
+                payload = services.rag_chat(kb, "与知识库完全无关的问题")
+                stream, state = services.rag_chat_stream(kb, "与知识库完全无关的问题")
+                streamed = "".join(stream)
+            self.assertEqual(payload["answer"], services.NO_MATCH_ANSWER)
+            self.assertEqual((payload["sources"], payload["cache_hit"]), ([], False))
+            self.assertEqual((streamed, state["answer"]), (services.NO_MATCH_ANSWER, services.NO_MATCH_ANSWER))
+
+            payload = services.rag_chat(kb, texts[1])
+            self.assertNotEqual(payload["answer"], services.NO_MATCH_ANSWER)
+            self.assertEqual([s["chunk_id"] for s in payload["sources"]], [ids[1]])
+
+
+class ContextPackerTests(APITestCase):
+    def setUp(self):
+        from rag.answer_cache import clear_answer_cache
+        from rag.retrieval_cache import clear_retrieval_cache
+
+        os.environ["KB_EMBEDDING_BACKEND"] = "fake"
+        os.environ["RAG_LLM_BACKEND"] = "fake"
+        self.user = User.objects.create_user(username="pack_u1", password="StrongPass123!@#")
+        clear_retrieval_cache()
+        clear_answer_cache()
+
+    def tearDown(self):
+        os.environ.pop("KB_EMBEDDING_BACKEND", None)
+        os.environ.pop("RAG_LLM_BACKEND", None)
+
+    def _text(self, n: int) -> str:
+        return "".join(f"第 {i} 句说明了打包上下文时的一条规则。" for i in range(n))
+
+    def test_adjacent_chunks_are_stitched_without_overlap(self):
+        from knowledge.vectorstore import chunk_text
+        from rag.context_packer import SEPARATOR, ContextPiece, count_tokens, pack_contexts
+
+        text = self._text(40)
+        chunks = chunk_text(text, chunk_size=200, chunk_overlap=50)
+        pieces = [
+            ContextPiece(key=("a", i), document_id=1, chunk_index=i, text=c, score=0.9 - i * 0.01, rank=i)
+            for i, c in enumerate(chunks[:3])
+        ] + [ContextPiece(key=("b", 0), document_id=2, chunk_index=5, text="另一文档的段落。", score=0.95, rank=3)]
+
+        packed = pack_contexts(pieces, max_tokens=10_000, max_chars=100_000)
+        self.assertEqual([p.text for p in packed], ["另一文档的段落。", text[: len(packed[1].text)]])
+        self.assertEqual(packed[1].keys, [("a", 0), ("a", 1), ("a", 2)])
+        self.assertLess(
+            count_tokens(SEPARATOR.join(p.text for p in packed)),
+            count_tokens(SEPARATOR.join(p.text for p in pieces)),
+        )
+
+    def test_budget_keeps_best_blocks_and_cuts_at_sentence_end(self):
+        from rag.context_packer import ContextPiece, count_tokens, pack_contexts
+
+        long_text = self._text(30)
+        pieces = [
+            ContextPiece(key=1, document_id=1, chunk_index=0, text=long_text, score=0.5, rank=1),
+            ContextPiece(key=2, document_id=2, chunk_index=0, text="最相关的短段落。", score=0.9, rank=0),
+            ContextPiece(key=3, document_id=3, chunk_index=0, text="最相关的短段落。", score=0.8, rank=2),
+            ContextPiece(key=4, document_id=4, chunk_index=0, text="次相关的短段落。", score=0.4, rank=3),
+        ]
+        budget = count_tokens(long_text) // 2
+        packed = pack_contexts(pieces, max_tokens=budget, max_chars=100_000)
+        # 长段落放不下时跳过，仍装入后面更短的段落；相同内容只保留一份。
+        self.assertEqual([p.keys for p in packed], [[2], [4]])
+
+        packed = pack_contexts(pieces[:1], max_tokens=budget, max_chars=100_000)
+        self.assertTrue(packed[0].text.endswith("。"))
+        self.assertTrue(long_text.startswith(packed[0].text))
+        self.assertLessEqual(count_tokens(packed[0].text), budget)
+
+    def test_prompt_keeps_packed_contexts_intact(self):
+        from rag.context_packer import SEPARATOR
+        from rag.services import _build_prompt
+
+        # 是否装入由打包器按 token 预算决定，拼 prompt 时不再按字符数二次截断。
+        contexts = [self._text(400), "末尾的短段落。"]
+        self.assertIn(SEPARATOR.join(contexts), _build_prompt("问题", contexts))
+
+    def test_chat_prompt_uses_packed_contexts(self):
+        from unittest import mock
+
+        from knowledge.models import Document, DocumentChunk, KnowledgeBase
+        from knowledge.vectorstore import add_vectors_to_index, chunk_text
+        from rag import services
+
+        text = self._text(12)
+        chunks = chunk_text(text, chunk_size=120, chunk_overlap=30)
+        with tempfile.TemporaryDirectory() as faiss_dir:
+            kb = KnowledgeBase.objects.create(user=self.user, name="kb1", faiss_path=str(Path(faiss_dir) / "kb.index"))
+            doc = Document.objects.create(kb=kb, filename="a.txt", file_path="", chunk_count=len(chunks))
+            DocumentChunk.objects.bulk_create(
+                [DocumentChunk(document=doc, chunk_index=i, text=t) for i, t in enumerate(chunks)]
+            )
+            ids = list(DocumentChunk.objects.filter(document=doc).order_by("chunk_index").values_list("id", flat=True))
+            add_vectors_to_index(Path(kb.faiss_path), chunks, chunk_ids=ids)
+
+            with mock.patch.dict(os.environ, {"RAG_TOP_K": str(len(chunks))}), mock.patch.object(
+                services, "generate_answer_with_usage", wraps=services.generate_answer_with_usage
+            ) as gen:
+                payload = services.rag_chat(kb, chunks[1])
+            self.assertEqual(gen.call_args[0][1], [text])
+            self.assertEqual(sorted(s["chunk_id"] for s in payload["sources"]), ids)
@@ -9,8 +9,8 @@ from knowledge.models import KnowledgeBase
 from users.models import UserUsage, UserSubscription
 from .models import ChatHistory
 
-from .serializers import RagChatRequestSerializer
-from .services import RagError, rag_chat, rag_chat_stream
+from .serializers import RagBatchSearchRequestSerializer, RagChatRequestSerializer, RagSearchRequestSerializer
+from .services import RagError, rag_chat, rag_chat_stream, retrieve_batch, search_chunks
 
 
 def check_chat_limit(user):
@@ -38,6 +38,14 @@ def check_chat_limit(user):
     return True, daily_limit
 
 
+def _get_user_kbs(user, kb_ids: list[int]) -> list[KnowledgeBase] | None:
+    # 按请求顺序返回；任一知识库不存在或不属于当前用户时返回 None。
+    by_id = {kb.id: kb for kb in KnowledgeBase.objects.filter(id__in=kb_ids, user=user)}
+    if len(by_id) != len(kb_ids):
+        return None
+    return [by_id[i] for i in kb_ids]
+
+
 class RagChatView(APIView):
     permission_classes = [IsAuthenticated]
 
@@ -54,11 +62,12 @@ class RagChatView(APIView):
         serializer.is_valid(raise_exception=True)
 
         kb_id = serializer.validated_data["kb_id"]
+        kb_ids = serializer.validated_data["kb_ids"]
         question = serializer.validated_data["question"]
         session_id = serializer.validated_data.get("session_id")
 
-        kb = KnowledgeBase.objects.filter(id=kb_id, user=request.user).first()
-        if kb is None:
+        kbs = _get_user_kbs(request.user, kb_ids)
+        if kbs is None:
             return Response(status=status.HTTP_404_NOT_FOUND)
 
         try:
@@ -80,16 +89,18 @@ class RagChatView(APIView):
             else:
                 full_question = question
             
-            payload = rag_chat(kb, full_question)
+            payload = rag_chat(kbs, full_question)
             # 保存对话记录
             ChatHistory.objects.create(
                 user=request.user,
                 kb_id=kb_id,
+                kb_ids=kb_ids if len(kb_ids) > 1 else None,
                 session_id=session_id,
                 question=question,
                 answer=payload.get('answer', ''),
                 token_usage=payload.get('token_usage'),
-                elapsed_ms=payload.get('elapsed_ms')
+                elapsed_ms=payload.get('elapsed_ms'),
+                cache_hit=payload.get('cache_hit', False)
             )
             # 在响应中添加session_id
             payload['session_id'] = str(session_id)
@@ -115,11 +126,12 @@ class RagChatStreamView(APIView):
         serializer.is_valid(raise_exception=True)
 
         kb_id = serializer.validated_data["kb_id"]
+        kb_ids = serializer.validated_data["kb_ids"]
         question = serializer.validated_data["question"]
         session_id = serializer.validated_data.get("session_id")
 
-        kb = KnowledgeBase.objects.filter(id=kb_id, user=request.user).first()
-        if kb is None:
+        kbs = _get_user_kbs(request.user, kb_ids)
+        if kbs is None:
             return Response(status=status.HTTP_404_NOT_FOUND)
 
         try:
@@ -141,7 +153,7 @@ class RagChatStreamView(APIView):
             else:
                 full_question = question
             
-            stream, stream_state = rag_chat_stream(kb, full_question)
+            stream, stream_state = rag_chat_stream(kbs, full_question)
         except RagError as e:
             return Response({"detail": e.detail}, status=e.status_code)
 
@@ -153,15 +165,100 @@ class RagChatStreamView(APIView):
             ChatHistory.objects.create(
                 user=request.user,
                 kb_id=kb_id,
+                kb_ids=kb_ids if len(kb_ids) > 1 else None,
                 session_id=session_id,
                 question=question,
                 answer=stream_state.get('answer', ''),
                 token_usage=stream_state.get('token_usage'),
-                elapsed_ms=stream_state.get('elapsed_ms')
+                elapsed_ms=stream_state.get('elapsed_ms'),
+                cache_hit=stream_state.get('cache_hit', False)
             )
 
         resp = StreamingHttpResponse(gen(), content_type="text/plain; charset=utf-8")
         resp["Cache-Control"] = "no-cache"
         resp["X-Accel-Buffering"] = "no"
         resp["X-Session-ID"] = str(session_id)
+        resp["X-Cache-Hit"] = "1" if stream_state.get("cache_hit") else "0"
         return resp
+
+
+class RagSearchView(APIView):
+    # 纯检索（不调用大模型、不计入聊天次数）：供搜索框、文档导航等只需要命中片段的场景使用。
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        serializer = RagSearchRequestSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+
+        kb_ids = serializer.validated_data["kb_ids"]
+        question = serializer.validated_data["question"]
+        page = serializer.validated_data["page"]
+        page_size = serializer.validated_data["page_size"]
+
+        kbs = _get_user_kbs(request.user, kb_ids)
+        if kbs is None:
+            return Response(status=status.HTTP_404_NOT_FOUND)
+
+        try:
+            hits, has_more = search_chunks(kbs, question, offset=(page - 1) * page_size, limit=page_size)
+        except RagError as e:
+            return Response({"detail": e.detail}, status=e.status_code)
+
+        results = [
+            {
+                "kb_id": hit.kb_id,
+                "chunk_id": hit.chunk_id,
+                "document_id": hit.document_id,
+                "filename": hit.filename,
+                "chunk_index": hit.chunk_index,
+                "score": hit.score,
+                "distance": hit.distance,
+                "similarity": hit.similarity,
+                "text": hit.text,
+            }
+            for hit in hits
+        ]
+        return Response(
+            {"question": question, "page": page, "page_size": page_size, "has_more": has_more, "results": results},
+            status=status.HTTP_200_OK,
+        )
+
+
+class RagBatchSearchView(APIView):
+    # 批量检索（不调用大模型、不计入聊天次数）：供评测任务与内部工具一次提交多个问题。
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        serializer = RagBatchSearchRequestSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        kb_id = serializer.validated_data["kb_id"]
+        questions = serializer.validated_data["questions"]
+        top_k = serializer.validated_data.get("top_k")
+
+        kb = KnowledgeBase.objects.filter(id=kb_id, user=request.user).first()
+        if kb is None:
+            return Response(status=status.HTTP_404_NOT_FOUND)
+
+        try:
+            batches = retrieve_batch(kb, questions, top_k=top_k)
+        except RagError as e:
+            return Response({"detail": e.detail}, status=e.status_code)
+
+        results = [
+            {
+                "question": question,
+                "hits": [
+                    {
+                        "chunk_id": hit.chunk_id,
+                        "score": hit.score,
+                        "distance": hit.distance,
+                        "similarity": hit.similarity,
+                        "text": hit.text,
+                    }
+                    for hit in hits
+                ],
+            }
+            for question, hits in zip(questions, batches)
+        ]
+        return Response({"kb_id": kb_id, "results": results}, status=status.HTTP_200_OK)
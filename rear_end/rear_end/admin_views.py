@@ -11,10 +11,23 @@ from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from knowledge.models import Document, DocumentChunk, KnowledgeBase
-from knowledge.services import build_kb_index_path, create_empty_index_file, safe_remove_file
-from knowledge.vectorstore import rebuild_index
+from knowledge.models import Document, KnowledgeBase
+from knowledge.services import (
+    build_kb_index_path,
+    bump_content_version,
+    create_empty_index_file,
+    safe_remove_file,
+)
+from knowledge.vectorstore import (
+    embedding_cache_stats,
+    index_cache_stats,
+    remove_index_files,
+    remove_vectors_from_index,
+    schedule_index_tier_migration,
+)
 from rag.models import ChatHistory
+from rag.answer_cache import answer_cache_stats
+from rag.retrieval_cache import retrieval_cache_stats
 from users.models import UserSubscription, UserUsage
 
 User = get_user_model()
@@ -89,6 +102,41 @@ class AdminKnowledgeBaseCreateSerializer(serializers.Serializer):
 class AdminKnowledgeBaseUpdateSerializer(serializers.Serializer):
     name = serializers.CharField(max_length=100, required=False)
     description = serializers.CharField(required=False, allow_blank=True, allow_null=True)
+    index_config = serializers.DictField(required=False)
+    # 检索相关度阈值（余弦相似度）；null 表示沿用全局 RAG_MIN_SCORE
+    min_score = serializers.FloatField(required=False, allow_null=True, min_value=-1.0, max_value=1.0)
+
+    INDEX_TYPES = {"auto", "flat", "ivf", "hnsw"}
+    COMPRESSIONS = {"none", "fp16", "sq8", "pq"}
+
+    def validate_index_config(self, value: dict) -> dict:
+        out: dict = {}
+        for key, raw in value.items():
+            if key == "index_type":
+                v = str(raw or "auto").strip().lower()
+                if v not in self.INDEX_TYPES:
+                    raise serializers.ValidationError("index_type 仅支持 auto / flat / ivf / hnsw")
+                out[key] = v
+            elif key == "compression":
+                v = str(raw or "none").strip().lower()
+                if v not in self.COMPRESSIONS:
+                    raise serializers.ValidationError("compression 仅支持 none / fp16 / sq8 / pq")
+                out[key] = v
+            elif key == "rerank":
+                if not isinstance(raw, bool):
+                    raise serializers.ValidationError("rerank 必须为布尔值")
+                out[key] = raw
+            elif key in {"nprobe", "ef_search", "rerank_factor", "pq_m"}:
+                try:
+                    v = int(raw)
+                except (TypeError, ValueError):
+                    raise serializers.ValidationError(f"{key} 必须为正整数")
+                if v <= 0:
+                    raise serializers.ValidationError(f"{key} 必须为正整数")
+                out[key] = v
+            else:
+                raise serializers.ValidationError(f"不支持的索引配置项：{key}")
+        return out
 
 
 class AdminBaseView(APIView):
@@ -185,6 +233,11 @@ class AdminKnowledgeBasesView(AdminBaseView):
                 "name": kb.name,
                 "description": kb.description,
                 "faiss_path": kb.faiss_path,
+                "index_config": kb.index_config,
+                "min_score": kb.min_score,
+                "index_status": kb.index_status,
+                "index_issue": kb.index_issue,
+                "index_checked_at": kb.index_checked_at,
                 "created_at": kb.created_at,
             }
             for kb in qs
@@ -225,6 +278,8 @@ class AdminKnowledgeBasesView(AdminBaseView):
                 "name": kb.name,
                 "description": kb.description,
                 "faiss_path": kb.faiss_path,
+                "index_config": kb.index_config,
+                "min_score": kb.min_score,
                 "created_at": kb.created_at,
             },
             status=status.HTTP_201_CREATED,
@@ -248,8 +303,20 @@ class AdminKnowledgeBaseDetailView(AdminBaseView):
         if "description" in data:
             kb.description = data.get("description") or ""
             update_fields.append("description")
+        if "index_config" in data:
+            kb.index_config = {**(kb.index_config or {}), **data["index_config"]}
+            update_fields.append("index_config")
+        if "min_score" in data:
+            kb.min_score = data["min_score"]
+            update_fields.append("min_score")
         if update_fields:
             kb.save(update_fields=update_fields)
+        if "index_config" in data or "min_score" in data:
+            # 检索参数变化会改变检索结果：按内容变化处理，使检索 / 问答缓存失效。
+            bump_content_version(kb.id)
+        if "index_config" in data and kb.faiss_path:
+            # 索引类型变化时在后台按新配置重建（基于持久化向量，不调用 embedding）。
+            schedule_index_tier_migration(Path(kb.faiss_path), kb.index_config)
 
         return Response(
             {
@@ -258,6 +325,8 @@ class AdminKnowledgeBaseDetailView(AdminBaseView):
                 "name": kb.name,
                 "description": kb.description,
                 "faiss_path": kb.faiss_path,
+                "index_config": kb.index_config,
+                "min_score": kb.min_score,
                 "created_at": kb.created_at,
             },
             status=status.HTTP_200_OK,
@@ -271,7 +340,7 @@ class AdminKnowledgeBaseDetailView(AdminBaseView):
         faiss_path = kb.faiss_path
         kb.delete()
         if faiss_path:
-            safe_remove_file(faiss_path)
+            remove_index_files(Path(faiss_path))
 
         return Response(status=status.HTTP_204_NO_CONTENT)
 
@@ -304,19 +373,16 @@ class AdminDocumentDetailView(AdminBaseView):
         kb = doc.kb
         faiss_path = kb.faiss_path
         file_path = doc.file_path
+        chunk_ids = list(doc.chunks.values_list("id", flat=True))
 
         doc.delete()
 
         if file_path:
             safe_remove_file(file_path)
 
-        remaining_ids = DocumentChunk.objects.filter(document__kb=kb).order_by(
-            "document_id", "chunk_index"
-        ).values_list("id", flat=True)
-        remaining_texts = DocumentChunk.objects.filter(document__kb=kb).order_by(
-            "document_id", "chunk_index"
-        ).values_list("text", flat=True)
-        rebuild_index(Path(faiss_path), remaining_texts, chunk_ids=remaining_ids)
+        if faiss_path:
+            remove_vectors_from_index(Path(faiss_path), chunk_ids, config=kb.index_config)
+        bump_content_version(kb.id)
 
         return Response(status=status.HTTP_204_NO_CONTENT)
 
@@ -379,7 +445,12 @@ class AdminStatsView(AdminBaseView):
                     "total_users": today_usage['total_chat_count'] or 0,
                     "total_chats": today_usage['sum_chat_count'] or 0
                 }
-            }
+            },
+            # 入库 embedding 缓存命中情况（当前工作进程视角）
+            "embedding_cache": embedding_cache_stats(),
+            "index_cache": index_cache_stats(),
+            "retrieval_cache": retrieval_cache_stats(),
+            "answer_cache": answer_cache_stats(),
         }
         
         return Response(stats, status=status.HTTP_200_OK)
@@ -31,10 +31,79 @@ FAISS_INDEX_ROOT = Path(os.getenv("FAISS_INDEX_ROOT", str(BASE_DIR / "faiss_inde
 # 知识库文档上传存储目录（可通过环境变量覆盖）
 KB_UPLOAD_ROOT = Path(os.getenv("KB_UPLOAD_ROOT", str(BASE_DIR / "uploads")))
 
+# 文档入库任务：上传接口返回 202 + 任务 ID，由 `python manage.py run_ingest_worker` 执行（置 0 时在上传请求内同步执行）
+KB_INGEST_ASYNC = (os.getenv("KB_INGEST_ASYNC", "1") or "").strip() == "1"
+KB_INGEST_WORKERS = int(os.getenv("KB_INGEST_WORKERS", "2"))
+# 每次向量化并回写进度的 chunk 数；running 任务心跳超过 KB_INGEST_STALE_SECONDS 视为 worker 已退出，重新排队
+KB_INGEST_EMBED_BATCH = int(os.getenv("KB_INGEST_EMBED_BATCH", "256"))
+KB_INGEST_STALE_SECONDS = int(os.getenv("KB_INGEST_STALE_SECONDS", "600"))
+# 文本类上传按块读取解码的块大小（字节），抽取时内存占用与文件大小无关
+KB_EXTRACT_BLOCK_BYTES = int(os.getenv("KB_EXTRACT_BLOCK_BYTES", str(1 << 20)))
+# PDF 并行抽取：页数达到阈值时按页区间分给进程池（WORKERS=0 表示 min(4, CPU 核数)，1 表示关闭）
+KB_PDF_PARALLEL_MIN_PAGES = int(os.getenv("KB_PDF_PARALLEL_MIN_PAGES", "64"))
+KB_PDF_WORKERS = int(os.getenv("KB_PDF_WORKERS", "0"))
+KB_PDF_PAGES_PER_TASK = int(os.getenv("KB_PDF_PAGES_PER_TASK", "16"))
+# 入库流水线：阶段间有界队列长度（批次数），以及攒够多少条向量写一次索引
+KB_INGEST_QUEUE_SIZE = int(os.getenv("KB_INGEST_QUEUE_SIZE", "4"))
+KB_INGEST_INDEX_FLUSH = int(os.getenv("KB_INGEST_INDEX_FLUSH", "1024"))
+# 索引一致性检查：run_ingest_worker 空闲时按该间隔（秒）全量检查并离线修复，0 表示关闭（手动执行 check_index_consistency）
+KB_CONSISTENCY_INTERVAL_SECONDS = int(os.getenv("KB_CONSISTENCY_INTERVAL_SECONDS", "3600"))
+
 # 向量化配置（API Key 仅通过环境变量 OPENAI_API_KEY 提供，不在此处保存）
 OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "")
 OPENAI_EMBEDDING_MODEL = os.getenv("OPENAI_EMBEDDING_MODEL", "text-embedding-v4")
 
+# 入库 embedding 内容寻址缓存（按模型 + 文本 sha256 复用向量，多进程共享，超出容量按 LRU 淘汰）
+# KB_EMBEDDING_CACHE_SIZE_MB=0 表示关闭
+KB_EMBEDDING_CACHE_DIR = Path(os.getenv("KB_EMBEDDING_CACHE_DIR", str(BASE_DIR / "embedding_cache")))
+KB_EMBEDDING_CACHE_SIZE_MB = int(os.getenv("KB_EMBEDDING_CACHE_SIZE_MB", "1024"))
+
+# embedding 请求分批：默认值按服务商（dashscope 每批最多 10 条 / openai / 其它）取，见 knowledge.embedding_batcher；
+# 以下为全局覆盖，0 表示沿用服务商默认值。失败批次按指数退避重试 KB_EMBEDDING_MAX_RETRIES 次
+KB_EMBEDDING_BATCH_SIZE = int(os.getenv("KB_EMBEDDING_BATCH_SIZE", "0"))
+KB_EMBEDDING_BATCH_TOKENS = int(os.getenv("KB_EMBEDDING_BATCH_TOKENS", "0"))
+KB_EMBEDDING_CONCURRENCY = int(os.getenv("KB_EMBEDDING_CONCURRENCY", "0"))
+KB_EMBEDDING_MAX_RETRIES = int(os.getenv("KB_EMBEDDING_MAX_RETRIES", "3"))
+
+# FAISS 索引分级：向量数达到 KB_ANN_THRESHOLD 后由 flat 迁移为 ANN 索引（ivf / hnsw），迁移在后台线程执行
+KB_ANN_THRESHOLD = int(os.getenv("KB_ANN_THRESHOLD", "20000"))
+KB_ANN_INDEX_TYPE = os.getenv("KB_ANN_INDEX_TYPE", "ivf")
+KB_IVF_NPROBE = int(os.getenv("KB_IVF_NPROBE", "16"))
+KB_HNSW_M = int(os.getenv("KB_HNSW_M", "32"))
+KB_HNSW_EF_SEARCH = int(os.getenv("KB_HNSW_EF_SEARCH", "64"))
+# 向量编码：none / fp16 / sq8 / pq（可被知识库 index_config.compression 覆盖）；压缩索引检索时取 top_k × KB_RERANK_FACTOR 个候选精确重排
+KB_INDEX_COMPRESSION = os.getenv("KB_INDEX_COMPRESSION", "none")
+KB_RERANK_FACTOR = int(os.getenv("KB_RERANK_FACTOR", "4"))
+# 检索侧以只读 mmap 方式加载 FAISS 索引：按需换页、多 worker 共享页缓存（写路径始终读取私有副本）
+KB_INDEX_MMAP = (os.getenv("KB_INDEX_MMAP", "1") or "").strip() == "1"
+# 分级迁移与增量段合并在后台线程执行（置 0 时同步执行，便于测试与离线脚本）
+KB_INDEX_MIGRATE_ASYNC = (os.getenv("KB_INDEX_MIGRATE_ASYNC", "1") or "").strip() == "1"
+# 追加写入的增量段达到该数量时后台合并回主索引
+KB_SEGMENT_MAX_COUNT = int(os.getenv("KB_SEGMENT_MAX_COUNT", "8"))
+# 进程内已加载索引 / 旧版 meta 的缓存预算（MB），按估算常驻字节数做 LRU 淘汰；mmap 加载的向量编码不计入
+KB_INDEX_CACHE_MB = int(os.getenv("KB_INDEX_CACHE_MB", "1024"))
+KB_META_CACHE_MB = int(os.getenv("KB_META_CACHE_MB", "64"))
+# BM25 词法索引（<index>.bm25）回放后的倒排表缓存预算（MB）
+KB_LEXICAL_CACHE_MB = int(os.getenv("KB_LEXICAL_CACHE_MB", "256"))
+# 检索缓存（问题向量、top-k chunk id）：进程内 LRU 预算与存活时间，TTL=0 表示关闭；
+# 配置 RAG_CACHE_DIR 时启用多进程共享的磁盘层
+RAG_CACHE_TTL_SECONDS = int(os.getenv("RAG_CACHE_TTL_SECONDS", "600"))
+RAG_CACHE_MB = int(os.getenv("RAG_CACHE_MB", "64"))
+RAG_CACHE_DIR = os.getenv("RAG_CACHE_DIR", "")
+RAG_CACHE_DISK_MB = int(os.getenv("RAG_CACHE_DISK_MB", "512"))
+# 问答缓存：同一知识库内容版本下，prompt 完全相同或问题向量余弦相似度不低于阈值时直接返回已生成的回答
+RAG_ANSWER_CACHE = (os.getenv("RAG_ANSWER_CACHE", "1") or "").strip() == "1"
+RAG_ANSWER_CACHE_THRESHOLD = float(os.getenv("RAG_ANSWER_CACHE_THRESHOLD", "0.95"))
+RAG_ANSWER_CACHE_TTL_SECONDS = int(os.getenv("RAG_ANSWER_CACHE_TTL_SECONDS", "3600"))
+RAG_ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("RAG_ANSWER_CACHE_MAX_ENTRIES", "256"))
+RAG_ANSWER_CACHE_MB = int(os.getenv("RAG_ANSWER_CACHE_MB", "32"))
+# 联合检索：一次问答最多同时检索的知识库数，以及并发检索各知识库的线程数
+RAG_MAX_FEDERATED_KBS = int(os.getenv("RAG_MAX_FEDERATED_KBS", "8"))
+RAG_FEDERATED_WORKERS = int(os.getenv("RAG_FEDERATED_WORKERS", "4"))
+# 批量检索接口（/api/rag/search/batch）单次最多的问题数；检索接口的 top_k 与分页深度上限
+RAG_BATCH_MAX_QUESTIONS = int(os.getenv("RAG_BATCH_MAX_QUESTIONS", "64"))
+RAG_SEARCH_MAX_TOP_K = int(os.getenv("RAG_SEARCH_MAX_TOP_K", "50"))
+
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/6.0/howto/deployment/checklist/
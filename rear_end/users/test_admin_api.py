@@ -11,6 +11,8 @@ from rest_framework.test import APITestCase
 User = get_user_model()
 
 
+# 上传接口在请求内同步入库，便于直接断言文档与索引。
+@override_settings(KB_INGEST_ASYNC=False)
 class AdminApiTests(APITestCase):
     def setUp(self):
         os.environ["KB_EMBEDDING_BACKEND"] = "fake"